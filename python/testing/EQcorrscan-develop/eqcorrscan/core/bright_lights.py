@@ -196,25 +196,22 @@ def _rm_similarlags(stations, nodes, lags, threshold):
     .. note:: This is an internal function and \
         should not be called directly.
     """
-    import sys
-
-    netdif = abs((lags.T -
-                  lags.T[0]).sum(axis=1).reshape(1, len(nodes))) > threshold
-    for i in range(len(nodes)):
-        _netdif = abs((lags.T -
-                       lags.T[i]).sum(axis=1).reshape(1, len(nodes)))\
-            > threshold
-        netdif = np.concatenate((netdif, _netdif), axis=0)
-        sys.stdout.write("\r" + str(float(i) / len(nodes) * 100) + "% \r")
-        sys.stdout.flush()
+    from bisect import bisect_left, insort
+
+    # The network moveout difference between nodes i and j is
+    # sum(lags[:, j] - lags[:, i]), so only the summed lags are needed
+    net_lags = lags.sum(axis=0)
     nodes_out = [nodes[0]]
     node_indeces = [0]
-    print "\n"
-    print len(nodes)
-    for i in xrange(1, len(nodes)):
-        if np.all(netdif[i][node_indeces]):
+    kept = [net_lags[0]]
+    for i in range(1, len(nodes)):
+        # The nearest kept moveouts either side are the only ones to check
+        k = bisect_left(kept, net_lags[i])
+        if (k == len(kept) or kept[k] - net_lags[i] > threshold) and \
+                (k == 0 or net_lags[i] - kept[k - 1] > threshold):
             node_indeces.append(i)
             nodes_out.append(nodes[i])
+            insort(kept, net_lags[i])
     lags_out = lags.T[node_indeces].T
     print "Removed " + str(len(nodes) - len(nodes_out)) + " duplicate nodes"
     return stations, nodes_out, lags_out
@@ -339,42 +336,165 @@ def _node_loop(stations, lags, stream, clip_level,
         return (i, 'tmp' + str(instance) + '/node_' + str(i))
 
 
-def _cum_net_resp(node_lis, instance=0):
-    r"""Function to compute the cumulative network response by reading \
-    saved energy .npy files.
+def _station_energies(stations, stream, clip_level):
+    r"""Compute the clipped, RMS normalized uint16 energy of every trace \
+    once, for shifting to each node by _node_block.
 
-    :type node_lis: np.ndarray
-    :param node_lis: List of nodes (ints) to read from
-    :type instance: int
-    :param instance: Instance flag for parallelisation, defaults to 0.
+    Energies are normalized as in _node_loop, but over the whole trace \
+    rather than the part left after each node's lag is removed.
+
+    :type stations: list
+    :param stations: List of stations to use.
+    :type stream: :class: `obspy.Stream`
+    :param stream: Data stream to find the brightness for.
+    :type clip_level: float
+    :param clip_level: Upper limit for energy as a multiplier to the mean \
+        energy.
+
+    :returns: np.ndarray (n_traces, n_samples) of uint16 energies (scaled \
+        to at most 500, so never negative, and already the dtype the node \
+        stacks are summed in), list of the index into stations of each \
+        trace's station
+
+    .. note:: This is an internal function and \
+        should not be called directly.
+    """
+    import warnings
+    energies = []
+    station_index = []
+    for tr in stream:
+        j = [k for k in range(len(stations))
+             if stations[k] == tr.stats.station]
+        # Check that there is only one matching station
+        if len(j) > 1:
+            warnings.warn('Too many stations')
+        if len(j) == 0:
+            warnings.warn('No station match')
+            continue
+        energy = np.square(tr.data.astype(np.float64))
+        energy = np.clip(energy, 0, clip_level * np.mean(energy))
+        energy = np.nan_to_num(energy / _rms(energy))
+        if not max(energy) == 0.0:
+            energy = (500 * (energy / max(energy))).astype(np.uint16)
+        else:
+            energy = energy.astype(np.uint16)
+        energies.append(energy)
+        station_index.append(j[0])
+    return np.array(energies, dtype=np.uint16), station_index
+
+
+# Station energies for the pool workers, set by _init_node_worker
+_energies = None
+
+
+def _init_node_worker(energies):
+    global _energies
+    _energies = energies
 
-    :returns: np.ndarray cum_net_resp, list of indeces used
+
+def _node_block(node_lags, samp_rate, first_node=0):
+    r"""Sum the lagged station energies for a block of nodes.
+
+    Each node's stack is built from offset views of the precomputed \
+    station energies (see _station_energies): the energy at sample \
+    t + lag is added at sample t, with zeros after the end of the data.
+
+    :type node_lags: np.ndarray
+    :param node_lags: Lags in seconds, (n_stations, n_nodes in the block).
+    :type samp_rate: float
+    :param samp_rate: Sampling rate of the data in Hz.
+    :type first_node: int
+    :param first_node: Index of the first node of the block in the grid.
+
+    :returns: list of (node index, energy (np.ndarray)) as from _node_loop
 
     .. note:: This is an internal function to ease parallel processing and \
         should not be called directly.
     """
-    import os
+    energies, station_index = _energies
+    n_samples = energies.shape[1]
+    pads = np.round(node_lags[station_index] * samp_rate).astype(int)
+    stacks = np.zeros((node_lags.shape[1], n_samples), dtype=np.uint16)
+    for j in range(len(station_index)):
+        for k in range(node_lags.shape[1]):
+            pad = min(pads[j, k], n_samples)
+            stacks[k, 0:n_samples - pad] += energies[j, pad:]
+    return [(first_node + k, stacks[k]) for k in range(len(stacks))]
+
+
+def _node_block_star(args):
+    """Unpack arguments for _node_block, for Pool.imap."""
+    return _node_block(*args)
+
+
+def _cum_net_resp(node_energies, n_samples, block_size=64, accumulator=None):
+    r"""Function to compute the cumulative network response, the maximum \
+    energy over all nodes at each sample, as the node energies arrive.
+
+    Node energies are gathered into blocks of block_size nodes, the \
+    maximum and arg-maximum of each block taken along the node axis, then \
+    folded into a running (maximum, node) pair with np.where, so only \
+    block_size node energies are ever held at once. Ties go to the lowest \
+    node index, whatever order the nodes arrive in.
+
+    :type node_energies: iterable
+    :param node_energies: (node index, energy) tuples as returned by \
+        _node_loop, in any order.
+    :type n_samples: int
+    :param n_samples: Length of the energy arrays.
+    :type block_size: int
+    :param block_size: Number of node energies folded in at once.
+    :type accumulator: str
+    :param accumulator: If given, a directory to keep the running maximum \
+        and node index in as memory-mapped .npy files, rather than in RAM.
+
+    :returns: np.ndarray cum_net_resp, np.ndarray of the node index giving \
+        the maximum at each sample
 
-    cum_net_resp = np.load('tmp' + str(instance) +
-                           '/node_' + str(node_lis[0]) + '.npy')[0]
-    os.remove('tmp' + str(instance) + '/node_' + str(node_lis[0]) + '.npy')
-    indeces = np.ones(len(cum_net_resp)) * node_lis[0]
-    for i in node_lis[1:]:
-        node_energy = np.load('tmp' + str(instance) + '/node_' +
-                              str(i) + '.npy')[0]
-        updated_indeces = np.argmax([cum_net_resp, node_energy], axis=0)
-        temp = np.array([cum_net_resp, node_energy])
-        cum_net_resp = np.array([temp[updated_indeces[j]][j]
-                                 for j in xrange(len(updated_indeces))])
-        del temp, node_energy
-        updated_indeces[updated_indeces == 1] = i
-        indeces = updated_indeces
-        os.remove('tmp' + str(instance) + '/node_' + str(i) + '.npy')
+    .. note:: This is an internal function to ease parallel processing and \
+        should not be called directly.
+    """
+    import os
+    if accumulator:
+        if not os.path.isdir(accumulator):
+            os.makedirs(accumulator)
+        cum_net_resp = np.lib.format.open_memmap(
+            os.path.join(accumulator, 'cum_net_resp.npy'), mode='w+',
+            dtype=np.float64, shape=(n_samples,))
+        indeces = np.lib.format.open_memmap(
+            os.path.join(accumulator, 'node_indeces.npy'), mode='w+',
+            dtype=np.int64, shape=(n_samples,))
+    else:
+        cum_net_resp = np.empty(n_samples)
+        indeces = np.empty(n_samples, dtype=np.int64)
+    cum_net_resp[:] = -np.inf
+    indeces[:] = -1
+    block = []
+
+    def _fold(block):
+        block.sort(key=lambda node: node[0])
+        node_ids = np.array([node[0] for node in block])
+        energies = np.array([np.ravel(node[1]) for node in block],
+                            dtype=np.float64)
+        block_max = energies.max(axis=0)
+        block_node = node_ids[np.argmax(energies, axis=0)]
+        update = (block_max > cum_net_resp) | \
+            ((block_max == cum_net_resp) & (block_node < indeces))
+        cum_net_resp[:] = np.where(update, block_max, cum_net_resp)
+        indeces[:] = np.where(update, block_node, indeces)
+
+    for node in node_energies:
+        block.append(node)
+        if len(block) == block_size:
+            _fold(block)
+            block = []
+    if block:
+        _fold(block)
     return cum_net_resp, indeces
 
 
 def _find_detections(cum_net_resp, nodes, threshold, thresh_type,
-                     samp_rate, realstations, length):
+                     samp_rate, realstations, length, node_index=None):
     r"""Function to find detections within the cumulative network response \
     according to Frank et al. (2014).
 
@@ -382,7 +502,8 @@ def _find_detections(cum_net_resp, nodes, threshold, thresh_type,
     :param cum_net_resp: Array of cumulative network response for nodes
     :type nodes: list of tuples
     :param nodes: Nodes associated with the source of energy in the \
-        cum_net_resp
+        cum_net_resp, one per sample, or the whole grid if node_index is \
+        given
     :type threshold: float
     :param threshold: Threshold value
     :type thresh_type: str
@@ -395,6 +516,9 @@ def _find_detections(cum_net_resp, nodes, threshold, thresh_type,
         response, will be reported in the DETECTION
     :type length: float
     :param length: Maximum length of peak to look for in seconds
+    :type node_index: np.ndarray
+    :param node_index: Index into nodes of the node at each sample, as \
+        returned by _cum_net_resp, so nodes are only looked up at peaks
 
     :return: detections as :class: DETECTION
 
@@ -423,7 +547,10 @@ def _find_detections(cum_net_resp, nodes, threshold, thresh_type,
     detections = []
     if peaks:
         for peak in peaks:
-            node = nodes[peak[1]]
+            if node_index is None:
+                node = nodes[peak[1]]
+            else:
+                node = nodes[node_index[peak[1]]]
             detections.append(DETECTION(node[0] + '_' + node[1] + '_' +
                                         node[2], peak[1] / samp_rate,
                                         len(realstations), peak[0], thresh,
@@ -493,7 +620,7 @@ def brightness(stations, nodes, lags, stream, threshold, thresh_type,
                template_length, template_saveloc, coherence_thresh,
                coherence_stations=['all'], coherence_clip=False,
                gap=2.0, clip_level=100, instance=0, pre_pick=0.2,
-               plotsave=True, cores=1):
+               plotsave=True, cores=1, mem_issue=False, node_block=64):
     r"""Function to calculate the brightness function in terms of energy for \
     a day of data over the entire network for a given grid of nodes.
 
@@ -552,6 +679,12 @@ def brightness(stations, nodes, lags, stream, threshold, thresh_type,
                     lightning, electircal spikes) from the energy stack.
     :type gap: float
     :param gap: Minimum inter-event time in seconds for detections
+    :type mem_issue: bool
+    :param mem_issue: If True the cumulative network response is built in \
+        memory-mapped files in tmp<instance>/ rather than in RAM. These \
+        are removed once the detections have been found.
+    :type node_block: int
+    :param node_block: Number of nodes whose energy stacks are made at once.
 
     :return: list of templates as :class: `obspy.Stream` objects
     """
@@ -562,6 +695,7 @@ def brightness(stations, nodes, lags, stream, threshold, thresh_type,
         import matplotlib.pyplot as plt
         plt.ioff()
     # from joblib import Parallel, delayed
+    import os
     from multiprocessing import Pool, cpu_count
     from copy import deepcopy
     from obspy import read as obsread
@@ -596,88 +730,40 @@ def brightness(stations, nodes, lags, stream, threshold, thresh_type,
                             'reduce data volume')
     detections = []
     detect_lags = []
-    parallel = True
     plotvar = True
-    mem_issue = False
-    # Loop through each node in the input
-    # Linear run
+    # Energies are computed once per trace, then shifted and summed for
+    # blocks of nodes, each folded into the cumulative network response as
+    # it is computed
     print 'Computing the energy stacks'
-    if not parallel:
-        for i in range(0, len(nodes)):
-            print i
-            if not mem_issue:
-                j, a = _node_loop(stations, lags[:, i], stream, plot=True)
-                if 'energy' not in locals():
-                    energy = a
-                else:
-                    energy = np.concatenate((energy, a), axis=0)
-                print 'energy: ' + str(np.shape(energy))
-            else:
-                j, filename = _node_loop(stations, lags[:, i], stream, i,
-                                         mem_issue)
-        energy = np.array(energy)
-        print np.shape(energy)
+    energies = _station_energies(stations, stream, clip_level)
+    samp_rate = stream[0].stats.sampling_rate
+    args = ((lags[:, i:i + node_block], samp_rate, i)
+            for i in range(0, len(nodes), node_block))
+    if mem_issue:
+        accumulator = 'tmp' + str(instance)
     else:
-        # Parallel run
-        num_cores = cores
-        if num_cores > len(nodes):
-            num_cores = len(nodes)
-        if num_cores > cpu_count():
-            num_cores = cpu_count()
-        pool = Pool(processes=num_cores)
-        results = [pool.apply_async(_node_loop, args=(stations, lags[:, i],
-                                                      stream, i, clip_level,
-                                                      mem_issue, instance))
-                   for i in range(len(nodes))]
-        pool.close()
-        if not mem_issue:
-            print 'Computing the cumulative network response from memory'
-            energy = [p.get() for p in results]
+        accumulator = None
+    num_cores = min(cores, len(nodes), cpu_count())
+    if num_cores > 1:
+        pool = Pool(processes=num_cores, initializer=_init_node_worker,
+                    initargs=(energies,))
+        try:
+            node_energies = (node for block in pool.imap_unordered(
+                _node_block_star, args) for node in block)
+            cum_net_resp, indeces = _cum_net_resp(
+                node_energies, len(stream[0].data), block_size=node_block,
+                accumulator=accumulator)
+        finally:
+            pool.close()
             pool.join()
-            energy.sort(key=lambda tup: tup[0])
-            energy = [node[1] for node in energy]
-            energy = np.concatenate(energy, axis=0)
-            print energy.shape
-        else:
-            pool.join()
-    # Now compute the cumulative network response and then detect possible
-    # events
-    if not mem_issue:
-        print energy.shape
-        indeces = np.argmax(energy, axis=0)  # Indeces of maximum energy
-        print indeces.shape
-        cum_net_resp = np.array([np.nan] * len(indeces))
-        cum_net_resp[0] = energy[indeces[0]][0]
-        peak_nodes = [nodes[indeces[0]]]
-        for i in range(1, len(indeces)):
-            cum_net_resp[i] = energy[indeces[i]][i]
-            peak_nodes.append(nodes[indeces[i]])
-        del energy, indeces
     else:
-        print 'Reading the temp files and computing network response'
-        node_splits = len(nodes) / num_cores
-        indeces = [range(node_splits)]
-        for i in range(1, num_cores - 1):
-            indeces.append(range(node_splits * i, node_splits * (i + 1)))
-        indeces.append(range(node_splits * (i + 1), len(nodes)))
-        pool = Pool(processes=num_cores)
-        results = [pool.apply_async(_cum_net_resp, args=(indeces[i], instance))
-                   for i in range(num_cores)]
-        pool.close()
-        results = [p.get() for p in results]
-        pool.join()
-        responses = [result[0] for result in results]
-        print np.shape(responses)
-        node_indeces = [result[1] for result in results]
-        cum_net_resp = np.array(responses)
-        indeces = np.argmax(cum_net_resp, axis=0)
-        print indeces.shape
-        print cum_net_resp.shape
-        cum_net_resp = np.array([cum_net_resp[indeces[i]][i]
-                                 for i in range(len(indeces))])
-        peak_nodes = [nodes[node_indeces[indeces[i]][i]]
-                      for i in range(len(indeces))]
-        del indeces, node_indeces
+        _init_node_worker(energies)
+        node_energies = (node for arg in args
+                         for node in _node_block_star(arg))
+        cum_net_resp, indeces = _cum_net_resp(
+            node_energies, len(stream[0].data), block_size=node_block,
+            accumulator=accumulator)
+        _init_node_worker(None)
     if plotvar:
         cum_net_trace = deepcopy(stream[0])
         cum_net_trace.data = cum_net_resp
@@ -696,10 +782,17 @@ def brightness(stations, nodes, lags, stream, threshold, thresh_type,
 
     # Find detection within this network response
     print 'Finding detections in the cumulatve network response'
-    detections = _find_detections(cum_net_resp, peak_nodes, threshold,
+    detections = _find_detections(cum_net_resp, nodes, threshold,
                                   thresh_type, stream[0].stats.sampling_rate,
-                                  realstations, gap)
-    del cum_net_resp
+                                  realstations, gap, node_index=indeces)
+    del cum_net_resp, indeces
+    if accumulator:
+        # Detections are made, so the memory-mapped response can go (still
+        # readable by the plot below until it is unmapped)
+        for accumulator_file in ('cum_net_resp.npy', 'node_indeces.npy'):
+            os.remove(os.path.join(accumulator, accumulator_file))
+        if not os.listdir(accumulator):
+            os.rmdir(accumulator)
     templates = []
     nodesout = []
     good_detections = []
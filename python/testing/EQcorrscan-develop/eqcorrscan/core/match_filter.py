@@ -204,7 +204,190 @@ def _template_loop(template, chan, station, channel, debug=0, i=0):
     return (i, ccc)
 
 
-def _channel_loop(templates, stream, cores=1, debug=0):
+class TemplateBank(object):
+    r"""All template data for a set of templates packed into one contiguous \
+    float32 array which pool workers share rather than being sent pickled \
+    Streams with every task.
+
+    The start of the array is an image buffer for the channel of data being \
+    correlated, so that the day-long data are shared the same way.  Uses \
+    multiprocessing.shared_memory where available (python >= 3.8), and a \
+    multiprocessing RawArray inherited by the pool workers otherwise.
+
+    Attributes:
+        :type table: dict
+        :param table: Maps (template index, station, channel) to a tuple of \
+            (offset, length, delay) of that template channel in data, with \
+            the delay in samples from the start of the template.
+        :type image_len: int
+        :param image_len: Length of the image buffer at the start of data.
+        :type name: str
+        :param name: Name of the shared memory block once published, workers \
+            attach to it by this name.
+    """
+
+    def __init__(self, templates, image_len=0):
+        """Build the offset table and pack the template data."""
+        self.table = {}
+        self.image_len = image_len
+        self.name = None
+        self.data = None
+        self._shm = None
+        self._raw = None
+        self._owner = False
+        self._packed = []
+        offset = image_len
+        for i, template in enumerate(templates):
+            template_start = min([tr.stats.starttime for tr in template])
+            for tr in template:
+                key = (i, tr.stats.station, tr.stats.channel)
+                if key in self.table:
+                    # Only the first matching trace is used, as in \
+                    # _template_loop
+                    continue
+                delay = int(round((tr.stats.starttime - template_start) *
+                                  tr.stats.sampling_rate))
+                self.table[key] = (offset, len(tr.data), delay)
+                self._packed.append((offset, tr.data))
+                offset += len(tr.data)
+        self.size = offset
+
+    def publish(self):
+        """Copy the packed data into shared memory, returns self."""
+        nbytes = max(self.size, 1) * 4
+        try:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.name = self._shm.name
+            buf = self._shm.buf
+        except ImportError:
+            from multiprocessing.sharedctypes import RawArray
+            self._raw = RawArray('f', max(self.size, 1))
+            buf = self._raw
+        self._owner = True
+        self.data = np.frombuffer(buf, dtype=np.float32, count=self.size)
+        for offset, data in self._packed:
+            self.data[offset:offset + len(data)] = data
+        self._packed = []
+        return self
+
+    def set_image(self, data):
+        """Put a channel of data into the shared image buffer."""
+        self.data[0:self.image_len] = data
+
+    def image(self):
+        """View of the shared image buffer."""
+        return self.data[0:self.image_len]
+
+    def template(self, i, station, channel):
+        """Return (view of data, delay in samples) for a template channel."""
+        offset, length, delay = self.table[(i, station, channel)]
+        return self.data[offset:offset + length], delay
+
+    def close(self):
+        """Detach from, and if this is the publisher free, the memory."""
+        self.data = None
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
+        self._raw = None
+
+    def __getstate__(self):
+        """Only the table and the name of the memory block are pickled."""
+        state = self.__dict__.copy()
+        state['data'] = None
+        state['_shm'] = None
+        state['_owner'] = False
+        state['_packed'] = []
+        return state
+
+    def __setstate__(self, state):
+        """Attach to the published memory block by name."""
+        self.__dict__.update(state)
+        if self.name is not None:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            buf = self._shm.buf
+        else:
+            buf = self._raw
+        self.data = np.frombuffer(buf, dtype=np.float32, count=self.size)
+
+
+# Template bank of the current pool worker, set by _attach_bank
+_worker_bank = None
+
+
+def _attach_bank(bank):
+    r"""Pool initializer storing the shared TemplateBank for the worker."""
+    global _worker_bank
+    _worker_bank = bank
+
+
+def _bank_template_loop(i, station, channel, debug=0):
+    r"""Equivalent of _template_loop reading the template and the channel of \
+    data from the worker's shared TemplateBank, so only indices are sent to \
+    the worker.
+
+    :type i: int
+    :param i: Index of the template in the bank.
+    :type station: str
+    :type channel: str
+    :type debug: int
+
+    :returns: tuple of (i, ccc) with ccc as a float16 ndarray
+    """
+    template_data, delay = _worker_bank.template(i, station, channel)
+    chan = _worker_bank.image()
+    image = np.append(chan, np.zeros(delay))[delay:]
+    ccc = normxcorr2(template_data, image).astype(np.float16)
+    # Convert to float16 to save memory for large problems - lose some
+    # accuracy which will affect detections very close to threshold
+    if debug >= 3:
+        print '********* DEBUG:  ' + station + '.' +\
+            channel + ' ccc MAX: ' + str(np.max(ccc[0]))
+    if np.isinf(np.mean(ccc[0])):
+        warnings.warn('Mean of ccc is infinite, check!')
+    return (i, ccc)
+
+
+def _bank_template_loop_star(args):
+    r"""Unpack a tuple of arguments for _bank_template_loop, for use with \
+    Pool.imap_unordered."""
+    return _bank_template_loop(*args)
+
+
+def _cccsum_buffer(n_templates, n_samples, tempdir=False):
+    r"""Allocate a zeroed float32 cccsum matrix, optionally memory-mapped.
+
+    :type n_templates: int
+    :param n_templates: Number of templates (rows)
+    :type n_samples: int
+    :param n_samples: Length of each cccsum (columns)
+    :type tempdir: str or False
+    :param tempdir: If a directory is given the matrix is memory-mapped to an \
+        anonymous file there (e.g. local scratch) rather than held in RAM.
+
+    :return: :class: 'numpy.ndarray' or :class: 'numpy.memmap'
+    """
+    if not tempdir:
+        return np.zeros((n_templates, n_samples), dtype=np.float32)
+    import os
+    import tempfile
+    fd, fname = tempfile.mkstemp(suffix='_cccsums.dat', dir=tempdir)
+    os.close(fd)
+    cccsums = np.memmap(fname, dtype=np.float32, mode='w+',
+                        shape=(n_templates, n_samples))
+    try:
+        # The mapping stays valid, the file goes when the memmap does
+        os.remove(fname)
+    except OSError:
+        warnings.warn('Could not unlink ' + fname + ', remove it yourself')
+    return cccsums
+
+
+def _channel_loop(templates, stream, cores=1, debug=0, tempdir=False):
     r"""
     Loop to generate cross channel correaltion sums for a series of templates \
     hands off the actual correlations to a sister function which can be run \
@@ -221,10 +404,22 @@ def _channel_loop(templates, stream, cores=1, debug=0):
     :param core: Number of cores to loop over
     :type debug: int
     :param debug: Debug level.
+    :type tempdir: str or False
+    :param tempdir: Directory to memory-map the cccsum matrix to, or False \
+        to keep it in memory.
 
     :return: New list of :class: 'numpy.array' objects.  These will contain \
         the correlation sums for each template for this day of data.
     :return: list of ints as number of channels used for each cross-correlation
+
+    .. note:: Each single-channel correlation is added into one float32 \
+        (n_templates, n_samples) matrix as soon as it comes back from the \
+        pool, so peak memory is one cccsum matrix plus whatever results are \
+        in flight, regardless of the number of channels.
+
+    .. note:: Templates are packed into a shared :class:`TemplateBank` \
+        once, and one pool is used for all channels; workers are only sent \
+        (template index, station, channel) for each task.
     """
     import time
     from multiprocessing import Pool
@@ -232,111 +427,231 @@ def _channel_loop(templates, stream, cores=1, debug=0):
     num_cores = cores
     if len(templates) < num_cores:
         num_cores = len(templates)
-    if 'cccs_matrix' in locals():
-        del cccs_matrix
-    # Initialize cccs_matrix, which will be two arrays of len(templates) arrays
-    # where the arrays cccs_matrix[0[:]] will be the cross channel sum for each
-    # template.
-
     # Note: This requires all templates to be the same length, and all channels
     # to be the same length
-    cccs_matrix = np.array([np.array([np.array([0.0] * (len(stream[0].data) -
-                                     len(templates[0][0].data) + 1))] *
-                            len(templates))] * 2)
+    cccsums = _cccsum_buffer(len(templates), len(stream[0].data) -
+                             len(templates[0][0].data) + 1, tempdir)
     # Initialize number of channels array
     no_chans = np.array([0] * len(templates))
 
+    # Templates are shared with the workers once, and each channel of data
+    # once per channel, rather than pickled for every task
+    bank = TemplateBank(templates, image_len=len(stream[0].data)).publish()
+    pool = Pool(processes=num_cores, initializer=_attach_bank,
+                initargs=(bank,))
+    try:
+        for tr in stream:
+            station = tr.stats.station
+            channel = tr.stats.channel
+            if debug >= 1:
+                print "Starting parallel run for station " + station +\
+                    " channel " + channel
+            tic = time.clock()
+            with Timer() as t:
+                bank.set_image(tr.data)
+                # Send off to sister function, summing results as they arrive
+                results = pool.imap_unordered(_bank_template_loop_star,
+                                              [(i, station, channel, debug)
+                                               for i in range(len(templates))])
+                for i, ccc in results:
+                    if not np.all(ccc == 0):
+                        # Check that there are some real numbers in the vector
+                        # rather than being all 0, which is the default case
+                        # for no match of image and template names
+                        no_chans[i] += 1
+                    cccsums[i] += ccc[0]
+                    del ccc
+            if debug >= 1:
+                print "--------- TIMER:    Correlation and summing took: " +\
+                    "%s s" % t.secs
+            toc = time.clock()
+            if debug >= 1:
+                print "--------- TIMER:    Trace loop took " +\
+                    str(toc - tic) + " s"
+    finally:
+        pool.close()
+        pool.join()
+        bank.close()
+    if debug >= 2:
+        print 'cccsums is shaped: ' + str(np.shape(cccsums))
+    return cccsums, no_chans
+
+
+def _fft_chunk_size(nfft, max_memory=2e9):
+    r"""Number of templates to transform at once for an FFT of length nfft.
+
+    Each template in a chunk holds its spectrum, the product with the \
+    image spectrum and the inverse transform, about 24 * nfft bytes.
+
+    :type nfft: int
+    :param nfft: Length of the FFT.
+    :type max_memory: float
+    :param max_memory: Bytes to allow for one chunk.
+
+    :return: int, at least 1.
+    """
+    return max(1, int(max_memory // (24 * nfft)))
+
+
+def _fft_normxcorr_rows(templates, image, pads=None, chunk_size=None):
+    r"""Generator of normalized cross-correlations of many templates with one \
+    image, computed in the frequency domain.
+
+    The image is transformed once and multiplied against the spectra of all \
+    the templates, in chunks of chunk_size templates to bound memory.  \
+    Normalization uses running-window sums of the image, giving the same \
+    result as openCV's TM_CCOEFF_NORMED.
+
+    :type templates: :class: 'numpy.ndarray'
+    :param templates: Array of templates shaped (n_templates, template_len)
+    :type image: :class: 'numpy.ndarray'
+    :param image: 1-D image to scan the templates through
+    :type pads: :class: 'numpy.ndarray'
+    :param pads: Shift, in samples, of the image for each template, as used \
+        for the template delays in _template_loop.  The image is shifted \
+        left and zero padded at the end.
+    :type chunk_size: int
+    :param chunk_size: Number of templates to transform at once, or None \
+        to fit each chunk in about 2 GB (see _fft_chunk_size).
+
+    :return: Yields tuples of (template index, float32 correlation of \
+        length len(image) - template_len + 1).  Windows of zero variance \
+        give zero correlation, templates of zero variance are skipped.
+    """
+    n_templates, template_len = templates.shape
+    out_len = len(image) - template_len + 1
+    if pads is None:
+        pads = np.zeros(n_templates, dtype=int)
+    # Correlations are independent of the image offset, remove it to
+    # keep the running sums well conditioned
+    image = image.astype(np.float64)
+    image -= image.mean()
+    if pads.max() > 0:
+        image = np.append(image, np.zeros(pads.max()))
+    cum = np.concatenate(([0.0], np.cumsum(image)))
+    cum2 = np.concatenate(([0.0], np.cumsum(image ** 2)))
+    win_var = (cum2[template_len:] - cum2[:-template_len]) - \
+        (cum[template_len:] - cum[:-template_len]) ** 2 / template_len
+    # Anything this small is rounding noise from the running sums
+    var_tol = 1000 * np.finfo(np.float64).eps * max(cum2[-1], 1.0)
+    win_std = np.sqrt(np.where(win_var > var_tol, win_var, np.inf))
+    templates = templates - templates.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt(np.sum(templates ** 2, axis=1))
+    nfft = 2 ** int(np.ceil(np.log2(len(image) + template_len - 1)))
+    image_fft = np.fft.rfft(image, nfft)
+    if chunk_size is None:
+        chunk_size = _fft_chunk_size(nfft)
+    for start in range(0, n_templates, chunk_size):
+        end = min(start + chunk_size, n_templates)
+        template_fft = np.fft.rfft(templates[start:end, ::-1], nfft, axis=1)
+        full = np.fft.irfft(template_fft * image_fft, nfft, axis=1)
+        del template_fft
+        for j in range(start, end):
+            if norms[j] == 0:
+                continue
+            first = template_len - 1 + pads[j]
+            ccc = (full[j - start, first:first + out_len] /
+                   (norms[j] * win_std[pads[j]:pads[j] + out_len])).\
+                astype(np.float32)
+            yield j, np.clip(ccc, -1.0, 1.0, out=ccc)
+        del full
+
+
+def _fft_normxcorr(templates, image, pads=None, chunk_size=None):
+    r"""Normalized cross-correlation of many templates with one image in the \
+    frequency domain.  See _fft_normxcorr_rows for details.
+
+    :return: :class: 'numpy.ndarray' of float32 correlations shaped \
+        (n_templates, len(image) - template_len + 1).
+    """
+    ccc = np.zeros((templates.shape[0], len(image) - templates.shape[1] + 1),
+                   dtype=np.float32)
+    for j, row in _fft_normxcorr_rows(templates, image, pads, chunk_size):
+        ccc[j] = row
+    return ccc
+
+
+def _fft_channel_loop(templates, stream, cores=1, debug=0, tempdir=False,
+                      chunk_size=None):
+    r"""
+    Frequency-domain equivalent of _channel_loop.  Each channel of data is \
+    Fourier transformed once and correlated against all the templates for \
+    that channel in one vectorized pass, rather than one openCV call and \
+    one pickled copy of the day per template.
+
+    :type templates: :class: 'obspy.Stream'
+    :param templates: A list of templates, where each one should be an \
+        obspy.Stream object containing multiple traces of seismic data and \
+        the relevant header information.
+    :param stream: A single obspy.Stream object containing daylong seismic \
+        data to be correlated through using the templates.
+    :type cores: int
+    :param cores: Unused, kept for call compatibility with _channel_loop.
+    :type debug: int
+    :param debug: Debug level.
+    :type tempdir: str or False
+    :param tempdir: Directory to memory-map the cccsum matrix to, or False \
+        to keep it in memory.
+    :type chunk_size: int
+    :param chunk_size: Number of templates transformed at once, reduce this \
+        if memory is tight.  None sizes chunks from the FFT length to use \
+        about 2 GB.
+
+    :return: New list of :class: 'numpy.array' objects.  These will contain \
+        the correlation sums for each template for this day of data.
+    :return: list of ints as number of channels used for each cross-correlation
+    """
+    import time
+    from eqcorrscan.utils.timer import Timer
+    template_len = len(templates[0][0].data)
+    cccsums = _cccsum_buffer(len(templates), len(stream[0].data) -
+                             template_len + 1, tempdir)
+    no_chans = np.array([0] * len(templates))
+    template_starts = [min([tr.stats.starttime for tr in template])
+                       for template in templates]
     for tr in stream:
-        tr_data = tr.data
         station = tr.stats.station
         channel = tr.stats.channel
         if debug >= 1:
-            print "Starting parallel run for station " + station + " channel " +\
-                channel
+            print "Starting fft correlation for station " + station +\
+                " channel " + channel
         tic = time.clock()
+        template_array = np.zeros((len(templates), template_len))
+        pads = np.zeros(len(templates), dtype=int)
+        used = []
+        for i, template in enumerate(templates):
+            template_data = template.select(station=station,
+                                            channel=channel)[0]
+            if np.all(np.isnan(template_data.data)):
+                # Null traces padded in by match_filter
+                continue
+            delay = template_data.stats.starttime - template_starts[i]
+            pads[i] = int(round(delay * template_data.stats.sampling_rate))
+            template_array[i] = template_data.data
+            used.append(i)
+        if len(used) == 0:
+            continue
         with Timer() as t:
-            # Send off to sister function
-            pool = Pool(processes=num_cores)
-            results = [pool.apply_async(_template_loop,
-                                        args=(templates[i], tr_data, station,
-                                              channel, debug, i))
-                       for i in range(len(templates))]
-            pool.close()
-        if debug >= 1:
-            print "--------- TIMER:    Correlation loop took: %s s" % t.secs
-            print " I have " + str(len(results)) + " results"
-        with Timer() as t:
-            cccs_list = [p.get() for p in results]
-            pool.join()
-        if debug >= 1:
-            print "--------- TIMER:    Getting results took: %s s" % t.secs
-        with Timer() as t:
-            # Sort by placeholder returned from _template_loop
-            cccs_list.sort(key=lambda tup: tup[0])
-        if debug >= 1:
-            print "--------- TIMER:    Sorting took: %s s" % t.secs
-        with Timer() as t:
-            cccs_list = [ccc[1] for ccc in cccs_list]
-        if debug >= 1:
-            print "--------- TIMER:    Extracting arrays took: %s s" % t.secs
-        if debug >= 3:
-            print 'cccs_list is shaped: ' + str(np.shape(cccs_list))
-        with Timer() as t:
-            cccs = np.concatenate(cccs_list, axis=0)
-        if debug >= 1:
-            print "--------- TIMER:    cccs_list conversion: %s s" % t.secs
-        del cccs_list
-        if debug >= 2:
-            print 'After looping through templates the cccs is shaped: ' +\
-                str(np.shape(cccs))
-            print 'cccs is using: ' + str(cccs.nbytes / 1000000) +\
-                ' MB of memory'
-        cccs_matrix[1] = np.reshape(cccs, (1, len(templates),
-                                    max(np.shape(cccs))))
-        del cccs
-        if debug >= 2:
-            print 'cccs_matrix shaped: ' + str(np.shape(cccs_matrix))
-            print 'cccs_matrix is using ' + str(cccs_matrix.nbytes / 1000000) +\
-                ' MB of memory'
-        # Now we have an array of arrays with the first dimensional index
-        # giving the channel, the second dimensional index giving the
-        # template and the third dimensional index giving the position
-        # in the ccc, e.g.:
-        # np.shape(cccsums)=(len(stream), len(templates), len(ccc))
-
-        if debug >= 2:
-            print 'cccs_matrix as a np.array is shaped: ' +\
-                str(np.shape(cccs_matrix))
-        # First work out how many channels were used
-        for i in range(0, len(templates)):
-            if not np.all(cccs_matrix[1][i] == 0):
-                # Check that there are some real numbers in the vector rather
-                # than being all 0, which is the default case for no match
-                # of image and template names
-                no_chans[i] += 1
-        # Now sum along the channel axis for each template to give the
-        # cccsum values for each template for each day
-        with Timer() as t:
-            cccsums = cccs_matrix.sum(axis=0).astype(np.float32)
+            # Sum each template's correlation straight into cccsums
+            for j, ccc in _fft_normxcorr_rows(template_array[used], tr.data,
+                                              pads[used], chunk_size):
+                if np.any(ccc != 0):
+                    no_chans[used[j]] += 1
+                cccsums[used[j]] += ccc
         if debug >= 1:
-            print "--------- TIMER:    Summing took %s s" % t.secs
-        if debug >= 2:
-            print 'cccsums is shaped thus: ' + str(np.shape(cccsums))
-        cccs_matrix[0] = cccsums
-        del cccsums
+            print "--------- TIMER:    Correlation and summing took: %s s" %\
+                t.secs
         toc = time.clock()
         if debug >= 1:
             print "--------- TIMER:    Trace loop took " + str(toc - tic) +\
                 " s"
-    if debug >= 2:
-        print 'cccs_matrix is shaped: ' + str(np.shape(cccs_matrix))
-    cccsums = cccs_matrix[0]
     return cccsums, no_chans
 
 
 def match_filter(template_names, template_list, st, threshold,
                  threshold_type, trig_int, plotvar, plotdir='.', cores=1,
-                 tempdir=False, debug=0, plot_format='jpg'):
+                 tempdir=False, debug=0, plot_format='jpg', backend='opencv',
+                 chunk_size=None):
     r"""Over-arching code to run the correlations of given templates with a \
     day of seismic data and output the detections based on a given threshold.
 
@@ -374,12 +689,23 @@ def match_filter(template_names, template_list, st, threshold,
     :param plotdir: Path to plotting folder, plots will be output here, \
         defaults to run location.
     :type tempdir: String or False
-    :param tempdir: Directory to put temporary files, or False
+    :param tempdir: Directory to put temporary files, or False.  If given, \
+        the cccsum matrix is memory-mapped there (ideally local scratch) \
+        rather than held in RAM.
     :type cores: int
     :param cores: Number of cores to use
     :type debug: int
     :param debug: Debug output level, the bigger the number, the more the \
         output.
+    :type backend: str
+    :param backend: Correlation engine, either 'opencv' to correlate each \
+        template-channel pair with openCV in parallel, or 'fft' to correlate \
+        all templates with each channel in one batched frequency-domain pass.
+    :type chunk_size: int
+    :param chunk_size: For the 'fft' backend, number of templates \
+        transformed at once.  Each costs about 24 * nfft bytes (nfft is the \
+        next power of two above the day length), so None picks as many as \
+        fit in about 2 GB.
 
     :return: :class: 'DETECTIONS' detections for each channel formatted as \
         :class: 'obspy.UTCDateTime' objects.
@@ -470,7 +796,14 @@ def match_filter(template_names, template_list, st, threshold,
                 template += nulltrace
     if debug >= 2:
         print 'Starting the correlation run for this day'
-    [cccsums, no_chans] = _channel_loop(templates, stream, cores, debug)
+    if backend == 'fft':
+        [cccsums, no_chans] = _fft_channel_loop(templates, stream, cores,
+                                                debug, tempdir, chunk_size)
+    elif backend == 'opencv':
+        [cccsums, no_chans] = _channel_loop(templates, stream, cores, debug,
+                                            tempdir)
+    else:
+        raise ValueError('Unknown correlation backend: ' + str(backend))
     if len(cccsums[0]) == 0:
         raise ValueError('Correlation has not run, zero length cccsum')
     outtoc = time.clock()
@@ -483,6 +816,8 @@ def match_filter(template_names, template_list, st, threshold,
         print ' '.join(['Correlated with', str(len(stream)),
                         'channels of data'])
     detections = []
+    rawthreshs = []
+    peak_threshs = []
     for i, cccsum in enumerate(cccsums):
         template = templates[i]
         if threshold_type == 'MAD':
@@ -533,34 +868,36 @@ def match_filter(template_names, template_list, st, threshold,
                 np.save(template_names[i] +
                         stream[0].stats.starttime.datetime.strftime('%Y%j'),
                         cccsum)
-        tic = time.clock()
         if debug >= 4:
             np.save('cccsum_' + str(i) + '.npy', cccsum)
-        if debug >= 3 and max(cccsum) > rawthresh:
-            peaks = findpeaks.find_peaks2_short(cccsum, rawthresh,
-                                                trig_int * stream[0].stats.
-                                                sampling_rate, debug,
-                                                stream[0].stats.starttime,
-                                                stream[0].stats.sampling_rate)
-        elif max(cccsum) > rawthresh:
-            peaks = findpeaks.find_peaks2_short(cccsum, rawthresh,
-                                                trig_int * stream[0].stats.
-                                                sampling_rate, debug)
+        rawthreshs.append(rawthresh)
+        if max(cccsum) > rawthresh:
+            peak_threshs.append(rawthresh)
         else:
-            print 'No peaks found above threshold'
-            peaks = False
-        toc = time.clock()
-        if debug >= 1:
-            print ' '.join(['Finding peaks took:', str(toc - tic), 's'])
-        if peaks:
-            for peak in peaks:
-                detecttime = stream[0].stats.starttime +\
-                    peak[1] / stream[0].stats.sampling_rate
-                detections.append(DETECTION(template_names[i],
-                                            detecttime,
-                                            no_chans[i], peak[0], rawthresh,
-                                            'corr'))
-    del stream, templates
+            # Nothing positive over threshold, don't look for any peaks
+            peak_threshs.append(np.inf)
+    # Find peaks for all templates at once, returns a list of lists of
+    # tuples in the form [(cccsum, sample)]
+    tic = time.clock()
+    all_peaks = findpeaks.multi_find_peaks(cccsums, peak_threshs,
+                                           trig_int * stream[0].stats.
+                                           sampling_rate, debug,
+                                           stream[0].stats.starttime,
+                                           stream[0].stats.sampling_rate)
+    toc = time.clock()
+    if debug >= 1:
+        print ' '.join(['Finding peaks took:', str(toc - tic), 's'])
+    for i, peaks in enumerate(all_peaks):
+        if not peaks:
+            print 'No peaks found above threshold for ' + template_names[i]
+        for peak in peaks:
+            detecttime = stream[0].stats.starttime +\
+                peak[1] / stream[0].stats.sampling_rate
+            detections.append(DETECTION(template_names[i],
+                                        detecttime,
+                                        no_chans[i], peak[0], rawthreshs[i],
+                                        'corr'))
+    del stream, templates, cccsums
     return detections
 
 
@@ -103,6 +103,117 @@ def test_match_filter(samp_rate=20.0, debug=0):
         return False
 
 
+def test_fft_backend(samp_rate=20.0, debug=0):
+    """
+    Check that the frequency-domain correlation backend gives the same \
+    cross-channel correlation sums and channel counts as the openCV one.
+    """
+    from eqcorrscan.core import match_filter
+    import numpy as np
+
+    templates, data, seeds = generate_synth_data(nsta=5, ntemplates=3,
+                                                 nseeds=20,
+                                                 samp_rate=samp_rate,
+                                                 t_length=6.0, max_amp=5.0,
+                                                 debug=debug)
+    cccsums, no_chans = match_filter._channel_loop(templates, data, 1, debug)
+    fft_cccsums, fft_no_chans = match_filter._fft_channel_loop(templates,
+                                                               data, 1, debug)
+    assert fft_cccsums.shape == cccsums.shape
+    assert np.all(fft_no_chans == no_chans)
+    # openCV path is rounded through float16 for each channel
+    assert np.allclose(fft_cccsums, cccsums, atol=0.01)
+    # Chunking is only a memory bound, results don't depend on it
+    one_cccsums, one_no_chans = match_filter._fft_channel_loop(
+        templates, data, 1, debug, chunk_size=1)
+    assert np.all(one_no_chans == fft_no_chans)
+    assert np.allclose(one_cccsums, fft_cccsums, atol=1e-6)
+    assert match_filter._fft_chunk_size(2 ** 24) == 4
+    assert match_filter._fft_chunk_size(2 ** 40) == 1
+    return True
+
+
+def test_cum_net_resp():
+    """
+    Check that the streaming max-reduction of node energies matches the \
+    maximum over the full energy array, whatever order nodes arrive in.
+    """
+    from eqcorrscan.core import bright_lights
+    import numpy as np
+    import shutil
+    import tempfile
+
+    np.random.seed(42)
+    # Small integer energies give plenty of ties between nodes
+    energy = np.random.randint(0, 20, (50, 1000)).astype(np.uint16)
+    order = np.random.permutation(50)
+    cum_net_resp, indeces = bright_lights._cum_net_resp(
+        [(i, energy[i].reshape(1, -1)) for i in order], 1000, block_size=8)
+    assert np.array_equal(indeces, np.argmax(energy, axis=0))
+    assert np.array_equal(cum_net_resp, energy.max(axis=0))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mm_resp, mm_indeces = bright_lights._cum_net_resp(
+            [(i, energy[i]) for i in order], 1000, block_size=7,
+            accumulator=tmp_dir)
+        assert np.array_equal(mm_indeces, indeces)
+        assert np.array_equal(mm_resp, cum_net_resp)
+    finally:
+        shutil.rmtree(tmp_dir)
+    # Looking nodes up at the peaks matches a node list for every sample
+    nodes = [(str(i), '0', '0') for i in range(50)]
+    by_sample = bright_lights._find_detections(
+        cum_net_resp.astype(float), [nodes[i] for i in indeces], 15, 'abs',
+        100., ['STA'], 0.5)
+    by_index = bright_lights._find_detections(
+        cum_net_resp.astype(float), nodes, 15, 'abs', 100., ['STA'], 0.5,
+        node_index=indeces)
+    assert len(by_index) > 0
+    assert [(d.template_name, d.detect_time) for d in by_index] == \
+        [(d.template_name, d.detect_time) for d in by_sample]
+    return True
+
+
+def test_node_block():
+    """
+    Check the shifted station energies against _node_loop, exactly for \
+    zero lags and to within the normalization change otherwise, and that \
+    _rm_similarlags keeps nodes whose moveouts differ.
+    """
+    from eqcorrscan.core import bright_lights
+    from obspy import Stream, Trace
+    import numpy as np
+
+    np.random.seed(42)
+    stations = ['STA%d' % i for i in range(4)]
+    stream = Stream([Trace(np.random.randn(2000) * 100,
+                           header={'station': sta, 'sampling_rate': 100.})
+                     for sta in stations])
+    lags = np.random.uniform(0, 1, (4, 10))
+    lags[:, 0] = 0
+    energies = bright_lights._station_energies(stations, stream, 100)
+    # Converted once here, not in every _node_block
+    assert energies[0].dtype == np.uint16
+    bright_lights._init_node_worker(energies)
+    try:
+        blocks = bright_lights._node_block(lags, 100., first_node=0)
+    finally:
+        bright_lights._init_node_worker(None)
+    for i, energy in blocks:
+        node_energy = bright_lights._node_loop(stations, lags[:, i], stream,
+                                               100, i)[1][0]
+        if i == 0:
+            assert np.array_equal(energy, node_energy)
+        else:
+            assert np.abs(energy.astype(int) - node_energy).max() <= 8
+    net_lags = np.array([[0., 0.1, 0.05, 1.0, 1.02, 2.0]])
+    nodes = [(str(i), '0', '0') for i in range(6)]
+    stations, nodes_out, lags_out = bright_lights._rm_similarlags(
+        ['STA0'], nodes, net_lags, 0.08)
+    assert nodes_out == [nodes[0], nodes[1], nodes[3], nodes[5]]
+    return True
+
+
 def generate_synth_data(nsta=5, ntemplates=3, nseeds=100, samp_rate=20.0,
                         t_length=3.0, max_amp=10.0, debug=0):
     """
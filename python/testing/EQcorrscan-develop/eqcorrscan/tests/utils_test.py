@@ -0,0 +1,148 @@
+"""
+A series of test functions for the utils functions in EQcorrscan.
+"""
+
+from __future__ import division
+
+
+def test_multi_find_peaks():
+    """
+    Check that the vectorized peak finder returns the same peaks as \
+    find_peaks2_short run row by row.
+    """
+    from eqcorrscan.utils import findpeaks
+    import numpy as np
+
+    np.random.seed(42)
+    cccsums = np.random.randn(5, 5000).astype(np.float32)
+    # Rounding gives plenty of tied values to check ordering on
+    cccsums[1] = np.round(cccsums[1], 1)
+    cccsums[3] = 0
+    thresholds = [2.0, 1.5, 3.0, 1.0, 2.5]
+    all_peaks = findpeaks.multi_find_peaks(cccsums, thresholds, 20)
+    assert len(all_peaks) == len(cccsums)
+    for cccsum, thresh, peaks in zip(cccsums, thresholds, all_peaks):
+        assert peaks == findpeaks.find_peaks2_short(cccsum, thresh, 20)
+    return True
+
+
+def test_align_traces_array():
+    """
+    Check that the batched aligner finds known shifts, and that iterating \
+    on the stack keeps them.
+    """
+    from eqcorrscan.utils import stacking
+    import numpy as np
+
+    np.random.seed(42)
+    master = np.random.randn(200) * np.hanning(200)
+    known = np.array([0, 3, -4, 7, -1, 0])
+    data = np.array([np.roll(master, shift) for shift in known])
+    data[2] *= -1
+    data += np.random.randn(*data.shape) * 0.05
+    shifts, ccs = stacking.align_traces_array(data, master, 10)
+    # obspy convention: delayed traces have negative shifts
+    assert np.array_equal(shifts, -known)
+    assert ccs[2] < -0.9 and np.all(np.abs(ccs) > 0.9)
+    # Positive only can't line up the flipped trace at its true shift
+    shifts, ccs = stacking.align_traces_array(data, master, 10,
+                                              positive=True)
+    assert np.all(ccs > 0)
+    shifts, ccs = stacking.align_traces_array(np.delete(data, 2, axis=0),
+                                              master, 10, iterate=True)
+    # Shifts relative to the stack only differ from the known ones by a \
+    # constant
+    assert len(set(shifts + np.delete(known, 2))) == 1
+    return True
+
+
+def test_stacking():
+    """
+    Check the array-backed stacks against a direct sum, and that chunked \
+    stacking gives the same result.
+    """
+    from eqcorrscan.utils import stacking
+    from obspy import Stream, Trace
+    import numpy as np
+
+    np.random.seed(42)
+    streams = []
+    for i in range(25):
+        st = Stream()
+        for sta in ['ABC', 'DEF', 'GHI']:
+            if sta == 'GHI' and i % 3 == 0:
+                continue
+            st += Trace(np.random.randn(300), header={'station': sta,
+                                                      'channel': 'EHZ'})
+        streams.append(st)
+    stack = stacking.linstack(streams)
+    for tr in stack:
+        direct = np.sum([st.select(station=tr.stats.station)[0].data /
+                         np.sqrt(np.mean(st.select(
+                             station=tr.stats.station)[0].data ** 2))
+                         for st in streams
+                         if st.select(station=tr.stats.station)], axis=0)
+        assert np.allclose(tr.data, direct)
+    chunked = stacking.stack_chunks(iter(streams), streams[1], chunk_size=7)
+    for tr, chunk_tr in zip(stack, chunked):
+        assert np.allclose(tr.data, chunk_tr.data)
+    pws = stacking.PWS_stack(streams)
+    chunked = stacking.stack_chunks(iter(streams), streams[1], method='PWS',
+                                    chunk_size=4)
+    for tr, chunk_tr in zip(pws, chunked):
+        assert np.allclose(tr.data, chunk_tr.data)
+    # Identical traces are perfectly coherent, so PWS == linear stack
+    same = [streams[0].copy() for i in range(5)]
+    for tr, pws_tr in zip(stacking.linstack(same), stacking.PWS_stack(same)):
+        assert np.allclose(tr.data, pws_tr.data)
+    return True
+
+
+def test_template_bank():
+    """
+    Check the batched synthetics against seis_sim, one S-P time at a time, \
+    and the Streams made from the bank.
+    """
+    from eqcorrscan.utils import synth_seis
+    import numpy as np
+
+    SP = np.arange(0, 300, 13)
+    for flength, phaseout in [(False, 'all'), (100, 'all'), (100, 'S')]:
+        synths, lengths = synth_seis.seis_sim_bank(SP, flength=flength,
+                                                   phaseout=phaseout)
+        for i, sp in enumerate(SP):
+            synth = synth_seis.seis_sim(int(sp), flength=flength,
+                                        phaseout=phaseout)
+            assert lengths[i] == len(synth)
+            assert np.allclose(synths[i, 0:lengths[i]], synth)
+    np.random.seed(42)
+    travel_times = np.random.random([3, 20]) * 2
+    bank = synth_seis.template_bank(['ABC', 'DEF', 'GHI'], range(20),
+                                    travel_times, phase='S', samp_rate=20.,
+                                    flength=40, phaseout='both')
+    assert bank['synthetics']['SYN_Z'].shape[0] <= 60
+    templates = synth_seis.template_grid(['ABC', 'DEF', 'GHI'], range(20),
+                                         travel_times, phase='S',
+                                         samp_rate=20., flength=40,
+                                         phaseout='both')
+    assert len(templates) == 20
+    for i, template in enumerate(templates):
+        assert len(template) == 6
+        for j, station in enumerate(['ABC', 'DEF', 'GHI']):
+            tr = template.select(station=station, channel='SYN_H')[0]
+            SP_time = travel_times[j][i] - travel_times[j][i] / 1.68
+            assert np.allclose(tr.data, synth_seis.seis_sim(
+                int(SP_time * 20.), flength=40, phaseout='S'))
+            assert abs(tr.stats.starttime.timestamp -
+                       (travel_times[j][i] - SP_time)) < 1e-6
+    return True
+
+
+if __name__ == '__main__':
+    """
+    Run utils tests
+    """
+    test_multi_find_peaks()
+    test_align_traces_array()
+    test_stacking()
+    test_template_bank()
@@ -34,7 +34,7 @@ def cross_chan_coherence(st1, st2, i=0):
     :param st1: Stream one
     :type st2: obspy Stream
     :param st2: Stream two
-    :type i: int
+    :type i: int or tuple
     :param i: index used for parallel async processing, returned unaltered
 
     :returns: cross channel coherence, float - normalized by number of\
@@ -77,33 +77,22 @@ def distance_matrix(stream_list, cores=1):
     from multiprocessing import Pool
 
     # Initialize square matrix
-    dist_mat = np.array([np.array([0.0] * len(stream_list))] *
-                        len(stream_list))
-    for i, master in enumerate(stream_list):
-        # Start a parallel processing pool
-        pool = Pool(processes=cores)
-        # Parallel processing
-        results = [pool.apply_async(cross_chan_coherence, args=(master,
-                                                                stream_list[j],
-                                                                j))
-                   for j in range(len(stream_list))]
-        pool.close()
-        # Extract the results when they are done
-        dist_list = [p.get() for p in results]
-        # Close and join all the processes back to the master process
-        pool.join()
-        # Sort the results by the input j
-        dist_list.sort(key=lambda tup: tup[1])
-        # Sort the list into the dist_mat structure
-        for j in range(i, len(stream_list)):
-            if i == j:
-                dist_mat[i, j] = 0.0
-            else:
-                dist_mat[i, j] = 1 - dist_list[j][0]
-    # Reshape the distance matrix
-    for i in range(1, len(stream_list)):
-        for j in range(i):
-            dist_mat[i, j] = dist_mat.T[i, j]
+    dist_mat = np.zeros((len(stream_list), len(stream_list)))
+    # One pool for the whole matrix, and only the upper triangle is computed
+    pool = Pool(processes=cores)
+    results = [pool.apply_async(cross_chan_coherence,
+                                args=(stream_list[i], stream_list[j],
+                                      (i, j)))
+               for i in range(len(stream_list))
+               for j in range(i + 1, len(stream_list))]
+    pool.close()
+    # Extract the results when they are done
+    for p in results:
+        cccoh, (i, j) = p.get()
+        dist_mat[i, j] = 1 - cccoh
+        dist_mat[j, i] = dist_mat[i, j]
+    # Close and join all the processes back to the master process
+    pool.join()
     return dist_mat
 
 
@@ -292,6 +292,94 @@ def find_peaks2_short(arr, thresh, trig_int, debug=0, starttime=False,
         return peaks
 
 
+def multi_find_peaks(arr, thresh, trig_int, debug=0, starttime=False,
+                     samp_rate=1.0):
+    r"""Vectorized equivalent of find_peaks2_short for a whole matrix of \
+    data, e.g. the (n_templates, n_samples) cccsums from match_filter.
+
+    Contiguous runs of samples with absolute value above each row's \
+    threshold are found for the whole matrix at once, the peak of each run \
+    taken with a sort rather than a Python loop, then peaks closer than \
+    trig_int are removed greedily from the highest down using a sorted list \
+    of accepted peaks, which is O(n log n) rather than O(n^2).
+
+    :type arr: ndarray
+    :param arr: 2-D numpy array, peaks are found along each row.  A 1-D \
+        array is treated as a single row.
+    :type thresh: float or list
+    :param thresh: Threshold for each row, or a single threshold for all.
+    :type trig_int: int
+    :param trig_int: The minimum difference in samples between triggers,\
+        if multiple peaks within this window this code will find the highest.
+    :type debug: int
+    :param debug: Optional, debug level 0-5
+    :type starttime: osbpy.UTCDateTime
+    :param starttime: Starttime for plotting, only used if debug > 2.
+    :type samp_rate: float
+    :param samp_rate: Sampling rate in Hz, only used for plotting if debug > 2.
+
+    :return: List of lists of tuples of peak values and locations, one list \
+        per row, identical to calling find_peaks2_short on each row.
+    """
+    import bisect
+    import numpy as np
+    from obspy import UTCDateTime
+    if not starttime:
+        starttime = UTCDateTime(0)
+    arr = np.atleast_2d(arr)
+    n_rows, n_samples = arr.shape
+    thresh = np.array(thresh, dtype=np.float64).reshape(-1, 1) * \
+        np.ones((n_rows, 1))
+    image = np.abs(arr)
+    mask = (image >= thresh) & (image != 0)
+    # Rows without anything strictly over threshold give no peaks
+    live = np.any(image > thresh, axis=1)
+    mask[~live] = False
+    # Flag the start of every run, runs cannot span rows
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    run_id = np.cumsum(starts.ravel())[mask.ravel()] - 1
+    flat_inds = np.flatnonzero(mask)
+    values = arr.ravel()[flat_inds]
+    # Highest value in each run, first occurrence on ties as np.argmax
+    order = np.lexsort((flat_inds, -values, run_id))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = run_id[order][1:] != run_id[order][:-1]
+    peak_inds = flat_inds[order[first]]
+    peak_vals = values[order[first]]
+    peak_rows = peak_inds // n_samples
+    peak_cols = peak_inds % n_samples
+    # Greedy trig_int suppression, highest first, earliest first on ties
+    order = np.lexsort((peak_cols, -peak_vals, peak_rows))
+    all_peaks = [[] for i in range(n_rows)]
+    accepted = [[] for i in range(n_rows)]
+    for k in order:
+        row = peak_rows[k]
+        col = peak_cols[k]
+        taken = accepted[row]
+        pos = bisect.bisect_left(taken, col)
+        if pos > 0 and col - taken[pos - 1] < trig_int:
+            continue
+        if pos < len(taken) and taken[pos] - col < trig_int:
+            continue
+        taken.insert(pos, col)
+        all_peaks[row].append((peak_vals[k], col))
+    for row in range(n_rows):
+        all_peaks[row].sort(key=lambda time: time[1])
+        if debug > 0:
+            print ' '.join(['Row', str(row), 'found', str(len(all_peaks[row])),
+                            'peaks'])
+        if debug >= 3 and all_peaks[row]:
+            from eqcorrscan.utils import EQcorrscan_plotting
+            _fname = ''.join(['peaks_', str(row), '_',
+                              starttime.datetime.strftime('%Y-%m-%d'),
+                              '.pdf'])
+            plot_image = np.where(mask[row], image[row], 0)
+            EQcorrscan_plotting.peaks_plot(plot_image, starttime, samp_rate,
+                                           True, all_peaks[row], _fname)
+    return all_peaks
+
+
 def find_peaks_dep(arr, thresh, trig_int, debug=0, starttime=False,
                    samp_rate=1.0):
     r"""Function to determine peaks in an array of data above a certain \
@@ -27,37 +27,127 @@ This file is part of EQcorrscan.
 import numpy as np
 
 
-def linstack(streams):
+class StreamStacker(object):
+    """
+    Running linear (and optionally phase) stacks of Streams, kept as one \
+    array per trace of a template Stream.
+
+    Streams can be added in as many chunks as wanted, so very large sets \
+    of Streams never need to be held in memory at once. Each chunk is \
+    packed into one (n_streams, n_samples) array per stachan and summed, \
+    with the Hilbert transforms for the phase stack done along axis 1 of \
+    that array.
+
+    :type template: obspy.Stream
+    :param template: Stream giving the stachans (first trace of each \
+        station/channel in each added Stream is stacked onto the matching \
+        template trace) and lengths of the stacks
+    :type normalize: bool
+    :param normalize: Normalize each trace by its RMS before stacking
+    :type phase: bool
+    :param phase: Also accumulate the phase stack needed for pws()
+    """
+    def __init__(self, template, normalize=True, phase=False):
+        self.template = template.copy()
+        self.normalize = normalize
+        self.phase = phase
+        self.linear_sums = [np.zeros(tr.stats.npts) for tr in template]
+        self.phase_sums = [np.zeros(tr.stats.npts, dtype=np.complex128)
+                           for tr in template]
+        self.counts = np.zeros(len(template), dtype=int)
+
+    def add(self, streams):
+        """
+        Add a chunk of Streams to the stacks.
+
+        Traces longer than the template trace are cut to its length and \
+        shorter ones zero padded.
+
+        :type streams: list of obspy.Stream
+        :param streams: Streams to add
+        """
+        lookups = []
+        for stream in streams:
+            lookup = {}
+            for tr in stream:
+                lookup.setdefault((tr.stats.station, tr.stats.channel),
+                                  tr.data)
+            lookups.append(lookup)
+        for j, tr in enumerate(self.template):
+            key = (tr.stats.station, tr.stats.channel)
+            rows = [lookup[key] for lookup in lookups if key in lookup]
+            if len(rows) == 0:
+                continue
+            data = np.zeros((len(rows), tr.stats.npts))
+            for i, row in enumerate(rows):
+                npts = min(len(row), tr.stats.npts)
+                data[i, 0:npts] = row[0:npts]
+            if self.normalize:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    data = np.nan_to_num(
+                        data / np.sqrt(np.mean(data ** 2,
+                                               axis=1))[:, np.newaxis])
+            self.linear_sums[j] += data.sum(axis=0)
+            if self.phase:
+                from scipy.signal import hilbert
+                analytic = hilbert(data, axis=1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    phasors = np.nan_to_num(analytic / np.abs(analytic))
+                self.phase_sums[j] += phasors.sum(axis=0)
+            self.counts[j] += len(rows)
+
+    def linear(self):
+        """
+        :returns: obspy.Stream of the linear stacks (sums)
+        """
+        stack = self.template.copy()
+        for tr, linear_sum in zip(stack, self.linear_sums):
+            tr.data = linear_sum.copy()
+        return stack
+
+    def pws(self, weight=2):
+        """
+        Phase weighted stack (Schimmel & Paulssen 1997): the linear stack \
+        weighted by the coherence of the instantaneous phases, \
+        abs(mean(exp(i * phase))) ** weight.
+
+        :type weight: float
+        :param weight: Exponent to the phase stack used for weighting.
+
+        :returns: obspy.Stream
+        """
+        if not self.phase:
+            raise ValueError('StreamStacker made with phase=False')
+        stack = self.template.copy()
+        for tr, linear_sum, phase_sum, count in zip(
+                stack, self.linear_sums, self.phase_sums, self.counts):
+            coherence = np.abs(phase_sum / max(count, 1)) ** weight
+            tr.data = linear_sum * coherence
+        return stack
+
+
+def _largest_stream(streams):
+    return streams[np.argmax([len(stream) for stream in streams])]
+
+
+def linstack(streams, normalize=True):
     """
     Function to compute the linear stack of a series of seismic streams of \
     multiplexed data.
 
     :type streams: list of Streams
     :param stream: List of streams to stack
+    :type normalize: bool
+    :param normalize: Normalize traces by their RMS before stacking
 
     :returns: stack - Stream
     """
-    # import matplotlib.pyplot as plt
-    stack = streams[np.argmax([len(stream) for stream in streams])].copy()
-    for tr in stack:
-        tr.data = tr.data / np.sqrt(np.mean(np.square(tr.data)))
-        tr.data = np.nan_to_num(tr.data)
-    for i in range(1, len(streams)):
-        # print "Stacking stream "+str(i)
-        for tr in stack:
-            # print tr.stats.station+'.'+tr.stats.channel
-            matchtr = streams[i].select(station=tr.stats.station,
-                                        channel=tr.stats.channel)
-            if matchtr:
-                # Normalize the data before stacking
-                norm = matchtr[0].data /\
-                    np.sqrt(np.mean(np.square(matchtr[0].data)))
-                norm = np.nan_to_num(norm)
-                tr.data = np.sum((norm, tr.data), axis=0)
-    return stack
-
-
-def PWS_stack(streams, weight=2):
+    stacker = StreamStacker(_largest_stream(streams), normalize=normalize)
+    stacker.add(streams)
+    return stacker.linear()
+
+
+def PWS_stack(streams, weight=2, normalize=True):
     """
     Function to compute the phase weighted stack of a series of streams.
     Recommend aligning the traces before stacking.
@@ -66,39 +156,165 @@ def PWS_stack(streams, weight=2):
     :param streams: List of Stream to stack
     :type weight: float
     :param weight: Exponent to the phase stack used for weighting.
+    :type normalize: bool
+    :param normalize: Normalize traces by their RMS before stacking
 
     :return: obspy.Stream
     """
-    from scipy.signal import hilbert
-    # First get the linear stack which we will weight by the phase stack
-    Linstack = linstack(streams)
-    # Compute the instantaneous phase
-    instaphases = []
-    print "Computing instantaneous phase"
-    for stream in streams:
-        instaphase = stream.copy()
-        for tr in instaphase:
-            analytic = hilbert(tr.data)
-            envelope = np.sqrt(np.sum((np.square(analytic),
-                                       np.square(tr.data)), axis=0))
-            tr.data = analytic / envelope
-        instaphases.append(instaphase)
-    # Compute the phase stack
-    print "Computing the phase stack"
-    Phasestack = linstack(instaphases)
-    # print type(Phasestack)
-    # Compute the phase-weighted stack
-    for tr in Phasestack:
-        tr.data = Linstack.select(station=tr.stats.station)[0].data *\
-            np.abs(tr.data ** weight)
-    return Phasestack
-
-
-def align_traces(trace_list, shift_len, master=False):
+    stacker = StreamStacker(_largest_stream(streams), normalize=normalize,
+                            phase=True)
+    stacker.add(streams)
+    return stacker.pws(weight=weight)
+
+
+def stack_chunks(stream_iter, template, method='linear', weight=2,
+                 normalize=True, chunk_size=100):
+    """
+    Stack Streams from an iterator (e.g. a generator reading them from \
+    disk) chunk_size at a time, so they are never all in memory.
+
+    :type stream_iter: iterable of obspy.Stream
+    :param stream_iter: Streams to stack
+    :type template: obspy.Stream
+    :param template: Stream giving the stachans and lengths of the stack
+    :type method: str
+    :param method: 'linear' or 'PWS'
+    :type weight: float
+    :param weight: Exponent of the phase stack for method='PWS'
+    :type normalize: bool
+    :param normalize: Normalize traces by their RMS before stacking
+    :type chunk_size: int
+    :param chunk_size: Number of Streams packed and added at once
+
+    :returns: obspy.Stream
+    """
+    if method not in ('linear', 'PWS'):
+        raise ValueError('method must be linear or PWS')
+    stacker = StreamStacker(template, normalize=normalize,
+                            phase=method == 'PWS')
+    chunk = []
+    for stream in stream_iter:
+        chunk.append(stream)
+        if len(chunk) == chunk_size:
+            stacker.add(chunk)
+            chunk = []
+    if chunk:
+        stacker.add(chunk)
+    if method == 'PWS':
+        return stacker.pws(weight=weight)
+    return stacker.linear()
+
+
+def _shift_cc(data, master, shift_len):
+    """
+    Normalized cross-correlation of every row of data with master for \
+    shifts of up to shift_len samples, from one batch of FFTs.
+
+    :type data: numpy.ndarray
+    :param data: 2D array (n_traces, n_samples)
+    :type master: numpy.ndarray
+    :param master: 1D array of n_samples
+    :type shift_len: int
+    :param shift_len: Maximum shift in samples
+
+    :returns: numpy.ndarray (n_traces, 2 * shift_len + 1) of correlations, \
+        column shift_len + k holding the correlation at a shift of k
+    """
+    npts = data.shape[1]
+    data = data - data.mean(axis=1)[:, np.newaxis]
+    master = master - master.mean()
+    norm = np.sqrt(np.sum(data ** 2, axis=1) * np.sum(master ** 2))
+    norm[norm == 0] = np.inf
+    nfft = int(2 ** np.ceil(np.log2(npts + shift_len + 1)))
+    cross = np.fft.irfft(np.fft.rfft(data, nfft) *
+                         np.conj(np.fft.rfft(master, nfft)), nfft)
+    # Negative lags are wrapped to the end of the irfft output
+    cc = np.concatenate((cross[:, nfft - shift_len:],
+                         cross[:, 0:shift_len + 1]), axis=1)
+    return cc / norm[:, np.newaxis]
+
+
+def _apply_shifts(data, shifts):
+    """
+    Delay each row of data by shift samples, zero filling the ends.
+    """
+    shifted = np.zeros(data.shape)
+    npts = data.shape[1]
+    for i, shift in enumerate(shifts):
+        if shift >= 0:
+            shifted[i, shift:] = data[i, 0:npts - shift]
+        else:
+            shifted[i, 0:npts + shift] = data[i, -shift:]
+    return shifted
+
+
+def align_traces_array(data, master, shift_len, positive=False,
+                       iterate=False, max_iter=10):
+    """
+    Align all rows of an array to a master with one batched FFT \
+    correlation, rather than one xcorr call per trace.
+
+    The traces and master are demeaned and the correlations normalized by \
+    their whole energies. Shifts follow obspy's correlate(master, trace) \
+    and xcorr_max: a trace delayed by k samples relative to the master has \
+    a shift of -k, so trace[i - shift] lines up with master[i].
+
+    With iterate=True the shifted traces are stacked (each normalized to \
+    unit RMS, as in linstack) and re-aligned to that stack, repeatedly, \
+    until no shifts change or max_iter re-alignments have been done.
+
+    :type data: numpy.ndarray
+    :param data: 2D array (n_traces, n_samples)
+    :type master: numpy.ndarray
+    :param master: 1D array of n_samples to align to first
+    :type shift_len: int
+    :param shift_len: Length to allow shifting within in samples
+    :type positive: bool
+    :param positive: Only use positive correlations, otherwise the \
+        largest absolute correlation is used
+    :type iterate: bool
+    :param iterate: Re-align to the linear stack until shifts converge
+    :type max_iter: int
+    :param max_iter: Maximum number of re-alignments to the stack
+
+    :returns: (numpy.ndarray of int shifts in samples, numpy.ndarray of \
+        correlations at those shifts)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim != 2 or len(master) != data.shape[1]:
+        raise ValueError('data must be 2D with rows the length of master')
+    shift_len = min(int(shift_len), data.shape[1] - 1)
+    rows = np.arange(data.shape[0])
+    shifts = None
+    for i in range(max_iter + 1 if iterate else 1):
+        cc = _shift_cc(data, np.asarray(master, dtype=np.float64), shift_len)
+        if positive:
+            index = np.argmax(cc, axis=1)
+        else:
+            index = np.argmax(np.abs(cc), axis=1)
+        new_shifts = shift_len - index
+        ccs = cc[rows, index]
+        if shifts is not None and np.array_equal(new_shifts, shifts):
+            break
+        shifts = new_shifts
+        if iterate:
+            aligned = _apply_shifts(data, shifts)
+            rms = np.sqrt(np.mean(aligned ** 2, axis=1))
+            rms[rms == 0] = np.inf
+            master = np.sum(aligned / rms[:, np.newaxis], axis=0)
+    return shifts, ccs
+
+
+def align_traces(trace_list, shift_len, master=False, positive=False,
+                 iterate=False):
     """
     Function to allign traces relative to each other based on their \
     cross-correlation value.
 
+    All traces are correlated with the master in one batch (see \
+    align_traces_array). Traces shorter than the longest are zero padded \
+    at the end.
+
     :type trace_list: list of Traces
     :param trace_list: List of traces to allign
     :type shift_len: int
@@ -106,31 +322,36 @@ def align_traces(trace_list, shift_len, master=False):
     :type master: obspy.Trace
     :param master: Master trace to align to, if set to False will align to \
         the largest amplitude trace (default)
+    :type positive: bool
+    :param positive: Only use positive correlations
+    :type iterate: bool
+    :param iterate: Re-align to the linear stack until shifts converge
 
     :returns: list of shifts for best allignment in seconds
     """
-    from obspy.signal.cross_correlation import xcorr
-    from copy import deepcopy
-    traces = deepcopy(trace_list)
     if not master:
         # Use trace with largest MAD amplitude as master
-        master = traces[0]
+        master = trace_list[0]
         MAD_master = np.median(np.abs(master.data))
-        for i in range(1, len(traces)):
-            if np.median(np.abs(traces[i])) > MAD_master:
-                master = traces[i]
+        for i in range(1, len(trace_list)):
+            if np.median(np.abs(trace_list[i].data)) > MAD_master:
+                master = trace_list[i]
                 MAD_master = np.median(np.abs(master.data))
     else:
         print 'Using master given by user'
-    shifts = []
-    ccs = []
-    for i in range(len(traces)):
-        if not master.stats.sampling_rate == traces[i].stats.sampling_rate:
+    for tr in trace_list:
+        if not master.stats.sampling_rate == tr.stats.sampling_rate:
             raise ValueError('Sampling rates not the same')
-        shift, cc = xcorr(master, traces[i], shift_len)
-        shifts.append(shift/master.stats.sampling_rate)
-        ccs.append(cc)
-    return shifts, ccs
+    npts = max([tr.stats.npts for tr in trace_list] + [master.stats.npts])
+    data = np.zeros((len(trace_list), npts))
+    for i, tr in enumerate(trace_list):
+        data[i, 0:tr.stats.npts] = tr.data
+    master_data = np.zeros(npts)
+    master_data[0:master.stats.npts] = master.data
+    shifts, ccs = align_traces_array(data, master_data, shift_len,
+                                     positive=positive, iterate=iterate)
+    shifts = [shift / master.stats.sampling_rate for shift in shifts]
+    return shifts, list(ccs)
 
 
 if __name__ == "__main__":
@@ -57,7 +57,7 @@ def seis_sim(SP, amp_ratio=1.5, flength=False, phaseout='all'):
     elif 2.5*SP < 100.0:
         additional_length = 100
     else:
-        additional_length = 2.5 * SP
+        additional_length = int(2.5 * SP)
     synth = np.zeros(SP + 10 + additional_length)
     # Make the array begin 10 samples before the P
     # and at least 2.5 times the S-P samples after the S arrival
@@ -136,6 +136,160 @@ def SVD_sim(SP, lowcut, highcut, samp_rate,
     return V, s, U, stachans
 
 
+def _additional_length(SP, flength):
+    """
+    Samples after the P in seis_sim for an array of S-P times.
+    """
+    additional = np.maximum((2.5 * SP).astype(int), 100)
+    if flength:
+        additional[(2.5 * SP < flength) & (100 < flength)] = flength
+    return additional
+
+
+def seis_sim_bank(SP, amp_ratio=1.5, flength=False, phaseout='all'):
+    """
+    Array version of seis_sim for many S-P times at once.
+
+    The spike models for every S-P time are laid out in one array and \
+    convolved with the damped sine together.  Rows match seis_sim for the \
+    same arguments, zero-padded to the longest when flength is not set.
+
+    :type SP: np.ndarray
+    :param SP: S-P times in samples
+    :type amp_ratio: float
+    :param amp_ratio: S:P amplitude ratio
+    :type flength: int
+    :param flength: Fixed length in samples, defaults to False
+    :type phaseout: str
+    :param phaseout: Either 'P', 'S' or 'all', as for seis_sim
+
+    :returns: np.ndarray (len(SP), npts) of synthetics, np.ndarray of the \
+        length of each synthetic
+    """
+    SP = np.atleast_1d(np.asarray(SP, dtype=int))
+    if len(SP) == 0:
+        return np.zeros((0, flength or 0)), np.zeros(0, dtype=int)
+    rows = np.arange(len(SP))[:, np.newaxis]
+    lengths = SP + 10 + _additional_length(SP, flength)
+    spikes = np.zeros((len(SP), lengths.max()))
+    spikes[:, 10] = 1.0
+    # S spikes as np.arange(amp_ratio, 0, -step) would give them
+    step = -(amp_ratio / (10 + SP / 3.0).astype(int))
+    n_spikes = np.ceil(-amp_ratio / step).astype(int)
+    k = np.arange(n_spikes.max())[np.newaxis, :]
+    S_spikes = amp_ratio + k * step[:, np.newaxis]
+    S_spikes[:, 1::2] = 0
+    S_spikes[:, 2::4] *= -1
+    keep = k < n_spikes[:, np.newaxis]
+    spikes[np.broadcast_to(rows, keep.shape)[keep],
+           (10 + SP[:, np.newaxis] + k)[keep]] = S_spikes[keep]
+    sine_x = np.arange(0, 10.0, 0.5)
+    damped_sine = np.exp(-sine_x) * np.sin(2 * np.pi * sine_x)
+    lengths += len(damped_sine) - 1
+    synths = np.zeros((len(SP), lengths.max()))
+    for i, amp in enumerate(damped_sine):
+        synths[:, i:i + spikes.shape[1]] += amp * spikes
+    synths /= np.max(np.abs(synths), axis=1)[:, np.newaxis]
+    if not flength:
+        return synths, lengths
+    if phaseout == 'S':
+        synths = np.concatenate(
+            (synths, np.zeros((len(SP), SP.max() + flength))), axis=1)
+        synths = synths[rows, SP[:, np.newaxis] + np.arange(flength)]
+    else:
+        synths = synths[:, 0:flength]
+    return synths, np.ones(len(SP), dtype=int) * flength
+
+
+def template_bank(stations, nodes, travel_times, phase, PS_ratio=1.68,
+                  samp_rate=100, flength=False, phaseout='all'):
+    """
+    Array version of template_grid: synthetics for every node and station \
+    without building obspy objects.
+
+    Synthetics are computed once for each distinct S-P time in samples \
+    (see seis_sim_bank) and indexed by node and station.  Use bank_streams \
+    to get the Streams template_grid would return.
+
+    Arguments are as for template_grid.
+
+    :returns: dict of: stations, nodes, samp_rate; channels, list of \
+        channel names; synthetics, dict of {channel: np.ndarray (n_synth, \
+        npts)}; lengths, np.ndarray (n_synth) of synthetic lengths; index, \
+        np.ndarray (n_nodes, n_stations) of the row of synthetics for each \
+        node and station, -1 where flength is too short for a synthetic; \
+        offsets, dict of {channel: np.ndarray (n_nodes, n_stations)} of \
+        start times in seconds.
+    """
+    import warnings
+    if phase not in ['S', 'P']:
+        raise IOError('Phase is neither P nor S')
+    tt = np.asarray(travel_times, dtype=float).T
+    if phase == 'P':
+        SP_time = (tt * PS_ratio) - tt
+        start = tt
+    else:
+        SP_time = tt - (tt / PS_ratio)
+        start = tt - SP_time
+    if phaseout == 'S':
+        start = start + SP_time
+    SP = (SP_time * samp_rate).astype(int)
+    valid = np.ones(SP.shape, dtype=bool)
+    if flength and phaseout == 'all':
+        valid = SP_time * samp_rate < flength - 11
+        for j in np.nonzero(~valid.all(axis=0))[0]:
+            for i in range(np.sum(~valid[:, j])):
+                warnings.warn('Cannot make a bulk synthetic with this ' +
+                              'fixed length for station ' + stations[j])
+    unique_SP, index = np.unique(SP[valid], return_inverse=True)
+    bank_index = -np.ones(SP.shape, dtype=int)
+    bank_index[valid] = index
+    bank = {'stations': list(stations), 'nodes': list(nodes),
+            'samp_rate': samp_rate, 'index': bank_index, 'synthetics': {},
+            'offsets': {}}
+    if phaseout == 'both':
+        bank['channels'] = ['SYN_Z', 'SYN_H']
+        for channel, _phaseout, offset in [('SYN_Z', 'P', start - SP_time),
+                                           ('SYN_H', 'S', start)]:
+            bank['synthetics'][channel], bank['lengths'] = seis_sim_bank(
+                unique_SP, amp_ratio=1.5, flength=flength,
+                phaseout=_phaseout)
+            bank['offsets'][channel] = offset
+    else:
+        bank['channels'] = ['SYN']
+        bank['synthetics']['SYN'], bank['lengths'] = seis_sim_bank(
+            unique_SP, amp_ratio=1.5, flength=flength, phaseout=phaseout)
+        bank['offsets']['SYN'] = start
+    return bank
+
+
+def bank_streams(bank):
+    """
+    Generator of the Stream for each node of a template_bank, in node order.
+
+    :type bank: dict
+    :param bank: From template_bank
+
+    :returns: :class:obspy.Stream
+    """
+    from obspy import Stream, Trace, UTCDateTime
+    for i in range(bank['index'].shape[0]):
+        st = Stream()
+        for j, station in enumerate(bank['stations']):
+            row = bank['index'][i, j]
+            if row < 0:
+                continue
+            for channel in bank['channels']:
+                st += Trace(
+                    data=bank['synthetics'][channel][
+                        row, 0:bank['lengths'][row]].copy(),
+                    header={'station': station, 'channel': channel,
+                            'sampling_rate': bank['samp_rate'],
+                            'starttime': UTCDateTime(0) +
+                            bank['offsets'][channel][i, j]})
+        yield st
+
+
 def template_grid(stations, nodes, travel_times, phase, PS_ratio=1.68,
                   samp_rate=100, flength=False, phaseout='all'):
     """
@@ -173,72 +327,10 @@ def template_grid(stations, nodes, travel_times, phase, PS_ratio=1.68,
 
     :returns: List of :class:obspy.Stream
     """
-    import warnings
-    if phase not in ['S', 'P']:
-        raise IOError('Phase is neither P nor S')
-    from obspy import Stream, Trace
-    # Initialize empty list for templates
-    templates = []
-    # Loop through the nodes, for every node generate a template!
-    for i, node in enumerate(nodes):
-        st = []  # Empty list to be filled with synthetics
-        # Loop through stations
-        for j, station in enumerate(stations):
-            tr = Trace()
-            tr.stats.sampling_rate = samp_rate
-            tr.stats.station = station
-            tr.stats.channel = 'SYN'
-            tt = travel_times[j][i]
-            if phase == 'P':
-                # If the input travel-time is the P-wave travel-time
-                SP_time = (tt * PS_ratio) - tt
-                if phaseout == 'S':
-                    tr.stats.starttime += tt + SP_time
-                else:
-                    tr.stats.starttime += tt
-            elif phase == 'S':
-                # If the input travel-time is the S-wave travel-time
-                SP_time = tt - (tt / PS_ratio)
-                if phaseout == 'S':
-                    tr.stats.starttime += tt
-                else:
-                    tr.stats.starttime += tt - SP_time
-            else:
-                raise IOError('Input grid is not P or S')
-            # Set start-time of trace to be travel-time for P-wave
-            # Check that the template length is long enough to include the SP
-            if flength and SP_time * samp_rate < flength - 11 \
-               and phaseout == 'all':
-                tr.data = seis_sim(SP=int(SP_time*samp_rate), amp_ratio=1.5,
-                                   flength=flength, phaseout=phaseout)
-                st.append(tr)
-            elif flength and phaseout == 'all':
-                warnings.warn('Cannot make a bulk synthetic with this fixed ' +
-                              'length for station '+station)
-            elif phaseout == 'all':
-                tr.data = seis_sim(SP=int(SP_time*samp_rate), amp_ratio=1.5,
-                                   flength=flength, phaseout=phaseout)
-                st.append(tr)
-            elif phaseout in ['P', 'S']:
-                tr.data = seis_sim(SP=int(SP_time * samp_rate), amp_ratio=1.5,
-                                   flength=flength, phaseout=phaseout)
-                st.append(tr)
-            elif phaseout == 'both':
-                for _phaseout in ['P', 'S']:
-                    _tr = tr.copy()
-                    _tr.data = seis_sim(SP=int(SP_time * samp_rate),
-                                        amp_ratio=1.5, flength=flength,
-                                        phaseout=_phaseout)
-                    if _phaseout == 'P':
-                        _tr.stats.channel = 'SYN_Z'
-                        # starttime defaults to S-time
-                        _tr.stats.starttime = _tr.stats.starttime - SP_time
-                    elif _phaseout == 'S':
-                        _tr.stats.channel = 'SYN_H'
-                    st.append(_tr)
-        templates.append(Stream(st))
-        # Stream(st).plot(size=(800,600))
-    return templates
+    return list(bank_streams(template_bank(
+        stations=stations, nodes=nodes, travel_times=travel_times,
+        phase=phase, PS_ratio=PS_ratio, samp_rate=samp_rate, flength=flength,
+        phaseout=phaseout)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+"""
+Timing comparisons of the rewritten EQcorrscan internals against the
+originals on synthetic data. Run from the EQcorrscan-develop directory so
+the vendored package is the one imported.
+"""
+from __future__ import division
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+
+def benchmark_match_filter_backends(nsta=5, ntemplates=10, samp_rate=20.,
+                                    t_length=6., cores=1):
+    """
+    Compare the openCV and fft correlation backends of match_filter
+
+    :param nsta: Number of synthetic stations
+    :param ntemplates: Number of synthetic templates
+    :param samp_rate: Sampling rate of the synthetic day
+    :param t_length: Template length in seconds
+    :param cores: Cores given to the openCV backend
+    :return: dict of timings and the max abs difference in cccsums
+    """
+    from eqcorrscan.core import match_filter
+    from eqcorrscan.tests.core_test import generate_synth_data
+
+    templates, data, seeds = generate_synth_data(nsta=nsta,
+                                                 ntemplates=ntemplates,
+                                                 nseeds=50,
+                                                 samp_rate=samp_rate,
+                                                 t_length=t_length,
+                                                 max_amp=5.)
+    tic = timer()
+    cccsums, no_chans = match_filter._channel_loop(templates, data, cores)
+    cv_time = timer() - tic
+    tic = timer()
+    fft_cccsums, fft_no_chans = match_filter._fft_channel_loop(templates,
+                                                               data)
+    fft_time = timer() - tic
+    results = {'opencv': cv_time, 'fft': fft_time,
+               'max_diff': np.max(np.abs(cccsums - fft_cccsums))}
+    print('openCV: %.3f s, fft: %.3f s, speedup %.1fx, max cccsum diff %.4f'
+          % (cv_time, fft_time, cv_time / fft_time, results['max_diff']))
+    return results
+
+
+def benchmark_find_peaks(ntemplates=50, nsamples=864000, thresh=2.5,
+                         trig_int=100):
+    """
+    Compare find_peaks2_short row by row with multi_find_peaks on a noisy
+    cccsum matrix with many threshold crossings
+
+    :param ntemplates: Number of cccsum rows
+    :param nsamples: Samples per row (a day at 10 Hz by default)
+    :param thresh: Threshold, in standard deviations of the noise
+    :param trig_int: Trigger interval in samples
+    :return: dict of timings
+    """
+    from eqcorrscan.utils import findpeaks
+
+    cccsums = np.random.randn(ntemplates, nsamples).astype(np.float32)
+    tic = timer()
+    old_peaks = [findpeaks.find_peaks2_short(cccsum, thresh, trig_int)
+                 for cccsum in cccsums]
+    loop_time = timer() - tic
+    tic = timer()
+    new_peaks = findpeaks.multi_find_peaks(cccsums, thresh, trig_int)
+    vec_time = timer() - tic
+    results = {'find_peaks2_short': loop_time, 'multi_find_peaks': vec_time,
+               'identical': old_peaks == new_peaks}
+    print('find_peaks2_short: %.3f s, multi_find_peaks: %.3f s, '
+          'speedup %.1fx, identical peaks: %s'
+          % (loop_time, vec_time, loop_time / vec_time,
+             results['identical']))
+    return results
+
+
+def benchmark_align_traces(ntraces=2000, npts=500, shift_len=20):
+    """
+    Compare one obspy correlate/xcorr_max call per trace with the batched
+    FFT aligner on randomly delayed copies of a master
+
+    :param ntraces: Number of traces to align
+    :param npts: Samples per trace
+    :param shift_len: Maximum shift in samples
+    :return: dict of timings and whether the shifts are identical
+    """
+    from obspy.signal.cross_correlation import correlate, xcorr_max
+    from eqcorrscan.utils import stacking
+
+    master = np.random.randn(npts) * np.hanning(npts)
+    delays = np.random.randint(-shift_len, shift_len + 1, ntraces)
+    data = np.array([np.roll(master, delay) for delay in delays])
+    data += np.random.randn(ntraces, npts) * 0.2
+    tic = timer()
+    old_shifts = [xcorr_max(correlate(master, tr, shift_len))[0]
+                  for tr in data]
+    loop_time = timer() - tic
+    tic = timer()
+    shifts, ccs = stacking.align_traces_array(data, master, shift_len)
+    batch_time = timer() - tic
+    results = {'xcorr_loop': loop_time, 'align_traces_array': batch_time,
+               'identical': list(shifts) == list(old_shifts)}
+    print('xcorr loop: %.3f s, align_traces_array: %.3f s, speedup %.1fx, '
+          'identical shifts: %s' % (loop_time, batch_time,
+                                    loop_time / batch_time,
+                                    results['identical']))
+    return results
+
+
+def _select_linstack(streams):
+    # The original linstack: select and re-allocate per trace and stream
+    stack = streams[0].copy()
+    for tr in stack:
+        tr.data = np.nan_to_num(tr.data / np.sqrt(np.mean(tr.data ** 2)))
+    for stream in streams[1:]:
+        for tr in stack:
+            matchtr = stream.select(station=tr.stats.station,
+                                    channel=tr.stats.channel)
+            if matchtr:
+                norm = matchtr[0].data / np.sqrt(
+                    np.mean(np.square(matchtr[0].data)))
+                tr.data = np.sum((np.nan_to_num(norm), tr.data), axis=0)
+    return stack
+
+
+def benchmark_linstack(nstreams=2000, nsta=10, npts=1000):
+    """
+    Compare the select-per-trace linear stack with the array-backed one
+
+    :param nstreams: Number of Streams (family members) to stack
+    :param nsta: Stations per Stream
+    :param npts: Samples per trace
+    :return: dict of timings and the max abs difference of the stacks
+    """
+    from obspy import Stream, Trace
+    from eqcorrscan.utils import stacking
+
+    streams = [Stream([Trace(np.random.randn(npts),
+                             header={'station': 'STA%02d' % j,
+                                     'channel': 'EHZ'})
+                       for j in range(nsta)]) for i in range(nstreams)]
+    tic = timer()
+    old_stack = _select_linstack(streams)
+    loop_time = timer() - tic
+    tic = timer()
+    new_stack = stacking.linstack(streams)
+    array_time = timer() - tic
+    results = {'select_linstack': loop_time, 'linstack': array_time,
+               'max_diff': max([np.max(np.abs(a.data - b.data))
+                                for a, b in zip(old_stack, new_stack)])}
+    print('select linstack: %.3f s, array linstack: %.3f s, speedup %.1fx, '
+          'max diff %.2e' % (loop_time, array_time, loop_time / array_time,
+                             results['max_diff']))
+    return results
+
+
+def _loop_det_stat(basis, data, inc):
+    # det_statistic from subspace_internal.py: one window at a time
+    from scipy.linalg.blas import sgemv, sdot
+
+    basis = basis.T.astype(np.float32)
+    data = data.astype(np.float32)
+    ulen = basis.shape[1]
+    dat_imax = len(data) - ulen + 1
+    stats = np.zeros(dat_imax, dtype=np.float32)
+    for i in range(0, dat_imax, inc):
+        xp = data[i:i + ulen]
+        xp_norm = sdot(xp, xp)
+        pt = sgemv(1.0, basis, xp)
+        stats[i] = sdot(pt, pt) / xp_norm
+    return stats[::inc]
+
+
+def benchmark_subspace_statistic(ulen=400, dimension=10, npts=864000,
+                                 nchans=3):
+    """
+    Compare the per-window subspace statistic with the batched FFT one in
+    python/workflow/util/subspace_stat.py, for a single channel and a
+    multiplexed detector
+
+    :param ulen: Detector length in samples (per channel)
+    :param dimension: Number of basis vectors
+    :param npts: Samples of data per channel
+    :param nchans: Channels of the multiplexed detector
+    :return: dict of timings and max abs differences
+    """
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), '..', 'workflow', 'util'))
+    from subspace_stat import subspace_statistic, multiplex
+
+    results = {}
+    for name, chans in (('single', 1), ('multiplexed', nchans)):
+        basis = np.linalg.qr(np.random.randn(ulen * chans, dimension))[0]
+        data = multiplex([np.random.randn(npts) for i in range(chans)])
+        tic = timer()
+        old_stats = _loop_det_stat(basis, data, chans)
+        loop_time = timer() - tic
+        tic = timer()
+        new_stats = subspace_statistic(basis, data, inc=chans)
+        fft_time = timer() - tic
+        results[name] = {'loop': loop_time, 'fft': fft_time,
+                         'max_diff': np.max(np.abs(old_stats - new_stats))}
+        print('%s: loop det_stat: %.3f s, fft statistic: %.3f s, speedup '
+              '%.1fx, max diff %.2e' % (name, loop_time, fft_time,
+                                        loop_time / fft_time,
+                                        results[name]['max_diff']))
+    return results
+
+
+def benchmark_template_grid(nsta=10, nnodes=5000, samp_rate=100.,
+                            flength=300):
+    """
+    Compare calling seis_sim for every node and station with the batched \
+    template bank
+
+    :param nsta: Number of stations
+    :param nnodes: Number of grid nodes
+    :param samp_rate: Sampling rate of the synthetics
+    :param flength: Template length in samples
+    :return: dict of timings and the max abs difference of the synthetics
+    """
+    from eqcorrscan.utils import synth_seis
+
+    travel_times = np.random.random([nsta, nnodes]) * 3.
+    SP = ((travel_times - travel_times / 1.68) * samp_rate).astype(int)
+    tic = timer()
+    old_synths = [[synth_seis.seis_sim(SP[j, i], flength=flength)
+                   for j in range(nsta)] for i in range(nnodes)]
+    loop_time = timer() - tic
+    tic = timer()
+    bank = synth_seis.template_bank(['STA%02d' % j for j in range(nsta)],
+                                    range(nnodes), travel_times, phase='S',
+                                    samp_rate=samp_rate, flength=flength)
+    bank_time = timer() - tic
+    synths = bank['synthetics']['SYN']
+    results = {'seis_sim_loop': loop_time, 'template_bank': bank_time,
+               'n_synthetics': synths.shape[0],
+               'max_diff': max([np.max(np.abs(
+                   old_synths[i][j] - synths[bank['index'][i, j]]))
+                   for i in range(nnodes) for j in range(nsta)])}
+    print('seis_sim loop: %.3f s, template bank: %.3f s (%d distinct '
+          'synthetics), speedup %.1fx, max diff %.2e' %
+          (loop_time, bank_time, results['n_synthetics'],
+           loop_time / bank_time, results['max_diff']))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_match_filter_backends()
+    benchmark_find_peaks()
+    benchmark_align_traces()
+    benchmark_linstack()
+    benchmark_subspace_statistic()
+    benchmark_template_grid()
@@ -20,14 +20,17 @@ from itertools import chain
 from timeit import default_timer as timer
 from scipy.cluster.hierarchy import fcluster
 
-from obspy import UTCDateTime, Catalog, Stream, read, read_events
+from obspy import UTCDateTime, Catalog, Stream, Trace, read, read_events
 
 from eqcorrscan.core.match_filter import Detection, Family, Party, Template
 from eqcorrscan.utils.pre_processing import shortproc
-from eqcorrscan.utils.clustering import distance_matrix
 from eqcorrscan.core.bright_lights import _rms
 from eqcorrscan.core.template_gen import template_gen
 from eqcorrscan.utils import pre_processing
+from waveform_index import grab_day_wavs, merge_day
+from day_cache import processed_day
+from dist_mat import distance_matrix as fft_distance_matrix
+from dist_mat import sparse_distance_matrix
 
 
 def date_generator(start_date, end_date):
@@ -36,29 +39,6 @@ def date_generator(start_date, end_date):
     for n in range(int((end_date - start_date).days) + 1):
         yield start_date + timedelta(n)
 
-def grab_day_wavs(wav_dirs, dto, stachans):
-    # Helper to recursively crawl paths searching for waveforms for a dict of
-    # stachans for one day
-
-    st = Stream()
-    wav_files = []
-    for path, dirs, files in chain.from_iterable(os.walk(path)
-                                                 for path in wav_dirs):
-        print('Looking in %s' % path)
-        for sta, chans in iter(stachans.items()):
-            for chan in chans:
-                for filename in fnmatch.filter(files,
-                                               '*.%s.*.%s*%d.%03d'
-                                                       % (
-                                               sta, chan, dto.year,
-                                               dto.julday)):
-                    wav_files.append(os.path.join(path, filename))
-    print('Reading into memory')
-    for wav in wav_files:
-        st += read(wav)
-    return st
-
-
 def sc3ml2qml(zipdir, outdir, stylesheet, prog='xalan'):
     """
     Converting Steve's zipped sc3ml to individual-event qml files
@@ -219,13 +199,18 @@ def asdf_create(asdf_name, wav_dirs, sta_dir):
 
 
 def test_snr_distribution(cat, wav_dirs, prepick=0.05, length=1.0,
-                          start=False, end=False):
+                          start=False, end=False, cache_dir=None,
+                          clean=True):
     """
     Get a feel for what the distribution of SNRs for events in a catalog is.
     This should give us an idea of what our ideal threshold should be in
     generating templates
     :param cat: Catalog of interest
     :param wav_dirs: Waveform directories
+    :param cache_dir: Optional day_cache directory for processed day data
+    :param clean: Passed to grab_day_wavs (or processed_day when cached).
+        If False raw data are only merged (see merge_day), keeping traces
+        shorter than 0.8 * daylong
     :return:
     """
 
@@ -261,15 +246,22 @@ def test_snr_distribution(cat, wav_dirs, prepick=0.05, length=1.0,
                     stachans[pk.waveform_id.station_code].append(chan_code)
         print('Reading waveforms')
         wav_ds = ['%s%d' % (d, dto.year) for d in wav_dirs]
-        st = grab_day_wavs(wav_ds, dto, stachans)
-        print('Merging')
-        st.merge(fill_value='interpolate')
-        print('Preprocessing')
         try:
-            st1 = pre_processing.dayproc(st, lowcut=1., highcut=20.,
-                                         filt_order=3, samp_rate=100.,
-                                         num_cores=6, starttime=dto,
-                                         ignore_length=True)
+            if cache_dir:
+                st1 = processed_day(wav_ds, dto, stachans, cache_dir,
+                                    lowcut=1., highcut=20., filt_order=3,
+                                    samp_rate=100., clean=clean,
+                                    num_cores=6)
+            else:
+                st = grab_day_wavs(wav_ds, dto, stachans, clean=clean)
+                if not clean:
+                    print('Merging')
+                    merge_day(st)
+                print('Preprocessing')
+                st1 = pre_processing.dayproc(st, lowcut=1., highcut=20.,
+                                             filt_order=3, samp_rate=100.,
+                                             num_cores=6, starttime=dto,
+                                             ignore_length=True)
         except NotImplementedError or Exception as e:
             print('Found error in dayproc, noting date and continuing')
             print(e)
@@ -302,11 +294,68 @@ def test_snr_distribution(cat, wav_dirs, prepick=0.05, length=1.0,
     return snrs
 
 
+def _cut_template(picks, st, length, prepick, min_snr=None,
+                  noise_amps=None):
+    """
+    Cut a template from a processed day Stream without copying the data
+
+    Each trace of the template is a view on the day-long data starting at
+    pick time - prepick and length * sampling_rate samples long, as in
+    template_gen. Channels whose max amplitude over the rms of the whole day
+    is below min_snr are left out.
+
+    :param picks: List of obspy Picks for the event
+    :param st: Processed day-long Stream
+    :param length: Template length in seconds
+    :param prepick: Seconds before the pick to start the template
+    :param min_snr: Minimum signal to noise ratio to keep a channel
+    :param noise_amps: Optional dict of {trace id: rms} so the day rms is
+        only calculated once per trace rather than once per event
+    :return: (template Stream, number of bytes of waveform data copied)
+    """
+    template = Stream()
+    bytes_copied = 0
+    if noise_amps is None:
+        noise_amps = {}
+    for pk in picks:
+        trs = st.select(station=pk.waveform_id.station_code,
+                        channel=pk.waveform_id.channel_code)
+        if len(trs) == 0:
+            continue
+        tr = trs[0]
+        df = tr.stats.sampling_rate
+        start = int(np.ceil((pk.time - prepick - tr.stats.starttime) * df
+                            - 1e-6))
+        npts = int(length * df)
+        if start < 0 or start + npts > tr.stats.npts:
+            print('No data provided for %s.%s starting at %s' %
+                  (tr.stats.station, tr.stats.channel,
+                   str(pk.time - prepick)))
+            continue
+        data = tr.data[start:start + npts]
+        if min_snr is not None:
+            if tr.id not in noise_amps:
+                noise_amps[tr.id] = _rms(tr.data)
+            if np.max(np.abs(data)) / noise_amps[tr.id] < min_snr:
+                print('Signal-to-noise ratio below threshold for %s.%s' %
+                      (tr.stats.station, tr.stats.channel))
+                continue
+        # Header is copied, the data is a view on the day
+        stats = tr.stats.copy()
+        stats.starttime = tr.stats.starttime + start / df
+        stats.npts = npts
+        template += Trace(data=data, header=stats)
+        if not np.shares_memory(data, tr.data):
+            bytes_copied += data.nbytes
+    return template, bytes_copied
+
+
 def mseed_2_templates(wav_dirs, cat, outdir, length, prepick,
                       highcut=None, lowcut=None, f_order=None,
                       samp_rate=None, min_snr=2.,
                       start=None, end=None, miniseed=True,
-                      asdf_file=False, debug=1):
+                      asdf_file=False, cache_dir=None, zero_copy=True,
+                      clean=True, debug=1):
     """
     Function to generate individual mseed files for each event in a catalog
     from a pyasdf file or continuous data.
@@ -322,6 +371,14 @@ def mseed_2_templates(wav_dirs, cat, outdir, length, prepick,
     :param samp_rate: Sampling rate for the templates
     :param start: start date as %Y/%m/%d if desired
     :param end: same as above. Defaults to full length of catalog.
+    :param cache_dir: Optional day_cache directory. Processed miniseed days
+        are read from (and added to) the cache instead of re-running dayproc
+    :param zero_copy: Cut templates as views on the processed day (see
+        _cut_template) rather than running template_gen on a deepcopy of
+        the day for every event
+    :param clean: Passed to grab_day_wavs (or processed_day when cached)
+        for miniseed data. If False raw data are only merged (see
+        merge_day), keeping traces shorter than 0.8 * daylong
     :return:
     """
 
@@ -354,52 +411,63 @@ def mseed_2_templates(wav_dirs, cat, outdir, length, prepick,
                 if chan_code not in stachans[pk.waveform_id.station_code]:
                     stachans[pk.waveform_id.station_code].append(chan_code)
         wav_read_start = timer()
-        # Be sure to go +/- 10 sec to account for GeoNet shit timing
-        if asdf_file:
-            with pyasdf.ASDFDataSet(asdf_file) as ds:
-                st = Stream()
-                for sta, chans in iter(stachans.items()):
-                    for station in ds.ifilter(ds.q.station == sta,
-                                              ds.q.channel == chans,
-                                              ds.q.starttime >= q_start,
-                                              ds.q.endtime <= q_end):
-                        st += station.raw_recording
-        elif miniseed:
+        if cache_dir and miniseed and not asdf_file:
             wav_ds = ['%s%d' % (d, dto.year) for d in wav_dirs]
-            st = grab_day_wavs(wav_ds, dto, stachans)
-        wav_read_stop = timer()
-        print('Reading waveforms took %.3f seconds' % (wav_read_stop
-                                                       - wav_read_start))
-        print('Looping through stachans to merge/resamp')
-        stachans = [(tr.stats.station, tr.stats.channel) for tr in st]
-        for stachan in list(set(stachans)):
-            tmp_st = st.select(station=stachan[0], channel=stachan[1])
-            if len(tmp_st) > 1 and len(set([tr.stats.sampling_rate for tr in tmp_st])) > 1:
-                print('Traces from %s.%s have differing samp rates' % (stachan[0], stachan[1]))
-                for tr in tmp_st:
-                    st.remove(tr)
-                tmp_st.resample(sampling_rate=samp_rate)
-                st += tmp_st
-        st.merge(fill_value='interpolate')
-        resamp_stop = timer()
-        print('Resample/merge took %s secs' % str(resamp_stop - wav_read_stop))
-        print('Preprocessing...')
-        # Process the stream
-        try:
-            st1 = pre_processing.dayproc(st, lowcut=lowcut, highcut=highcut,
-                                         filt_order=f_order, samp_rate=samp_rate,
-                                         starttime=dto, debug=debug, ignore_length=True,
-                                         num_cores=4)
-        except NotImplementedError or Exception as e:
-            print('Found error in dayproc, noting date and continuing')
-            print(e)
-            with open('%s/dayproc_errors.txt' % outdir, mode='a') as fo:
-                fo.write('%s\n%s\n' % (str(date), e))
-            continue
+            try:
+                st1 = processed_day(wav_ds, dto, stachans, cache_dir,
+                                    lowcut=lowcut, highcut=highcut,
+                                    filt_order=f_order, samp_rate=samp_rate,
+                                    clean=clean, num_cores=4, debug=debug)
+            except NotImplementedError or Exception as e:
+                print('Found error in dayproc, noting date and continuing')
+                print(e)
+                with open('%s/dayproc_errors.txt' % outdir, mode='a') as fo:
+                    fo.write('%s\n%s\n' % (str(date), e))
+                continue
+            print('Reading/processing took %.3f seconds'
+                  % (timer() - wav_read_start))
+        else:
+            # Be sure to go +/- 10 sec to account for GeoNet shit timing
+            if asdf_file:
+                with pyasdf.ASDFDataSet(asdf_file) as ds:
+                    st = Stream()
+                    for sta, chans in iter(stachans.items()):
+                        for station in ds.ifilter(ds.q.station == sta,
+                                                  ds.q.channel == chans,
+                                                  ds.q.starttime >= q_start,
+                                                  ds.q.endtime <= q_end):
+                            st += station.raw_recording
+            elif miniseed:
+                wav_ds = ['%s%d' % (d, dto.year) for d in wav_dirs]
+                st = grab_day_wavs(wav_ds, dto, stachans, clean=clean,
+                                   samp_rate=samp_rate)
+            wav_read_stop = timer()
+            print('Reading waveforms took %.3f seconds' % (wav_read_stop
+                                                           - wav_read_start))
+            print('Looping through stachans to merge/resamp')
+            merge_day(st, samp_rate)
+            resamp_stop = timer()
+            print('Resample/merge took %s secs' % str(resamp_stop - wav_read_stop))
+            print('Preprocessing...')
+            # Process the stream
+            try:
+                st1 = pre_processing.dayproc(st, lowcut=lowcut, highcut=highcut,
+                                             filt_order=f_order, samp_rate=samp_rate,
+                                             starttime=dto, debug=debug, ignore_length=True,
+                                             num_cores=4)
+            except NotImplementedError or Exception as e:
+                print('Found error in dayproc, noting date and continuing')
+                print(e)
+                with open('%s/dayproc_errors.txt' % outdir, mode='a') as fo:
+                    fo.write('%s\n%s\n' % (str(date), e))
+                continue
         print('Feeding stream to template_gen...')
+        day_bytes = sum([tr.data.nbytes for tr in st1])
+        noise_amps = {}
         for event in tmp_cat:
-            print('Copying stream to keep away from the trim...')
-            trim_st = copy.deepcopy(st1)
+            if not zero_copy:
+                print('Copying stream to keep away from the trim...')
+                trim_st = copy.deepcopy(st1)
             ev_name = str(event.resource_id).split('/')[-1]
             pk_stachans = ['%s.%s' % (pk.waveform_id.station_code,
                                       pk.waveform_id.channel_code)
@@ -410,8 +478,17 @@ def mseed_2_templates(wav_dirs, cat, outdir, length, prepick,
             if len(dups) > 0:
                 print('Event %s still has dup picks. Skipping' % ev_name)
                 continue
-            template = template_gen(event.picks, trim_st, length=length,
-                                    prepick=prepick, min_snr=min_snr)
+            if zero_copy:
+                template, bytes_copied = _cut_template(
+                    event.picks, st1, length=length, prepick=prepick,
+                    min_snr=min_snr, noise_amps=noise_amps)
+            else:
+                template = template_gen(event.picks, trim_st, length=length,
+                                        prepick=prepick, min_snr=min_snr)
+                bytes_copied = day_bytes
+                del trim_st
+            print('Template %s: %d bytes of waveform data copied' %
+                  (ev_name, bytes_copied))
             if len([tr for tr in template
                     if tr.stats.channel[-1] == 'Z']) < 6:
                 print('Skipping template with fewer than 6 Z-comp traces')
@@ -420,8 +497,7 @@ def mseed_2_templates(wav_dirs, cat, outdir, length, prepick,
             print('Writing event %s to file...' % ev_name)
             template.write('%s/%s.mseed' % (outdir, ev_name),
                            format="MSEED")
-            del trim_st
-        del tmp_cat, st1, st
+        del tmp_cat, st1
 
 
 def template_spectrograms(temp_dir, num_evs):
@@ -742,7 +818,7 @@ def mseed_2_Party(wav_dir, cat, temp_cat, lowcut, highcut, filt_order,
 
 def make_dist_mat(directory, highcut, lowcut, samp_rate,
                   filt_order, raw_prepick, corr_prepick,
-                  length, shift, outfile, cores):
+                  length, shift, outfile, cores, corr_floor=None):
     """
     Taking a directory of templates, processing wavs and computing correlation
     clustering prior to creating subspace
@@ -755,8 +831,11 @@ def make_dist_mat(directory, highcut, lowcut, samp_rate,
     :param corr_prepick: Output prepick before correlations
     :param length: Length of temp to be correlating
     :param shift: Shift length in secs allowed during correlations
-    :param outfile: Filename for output distance matrix
+    :param outfile: Filename for output distance matrix (.npy)
     :param method: Method for heirarchical clustering
+    :param corr_floor: If given, only keep pairs correlated at or above this
+        and save them as a sparse edge list (.npz) instead of the full matrix.
+        Read back with dist_mat.load_sparse_distance_matrix
     :return:
     """
 
@@ -774,10 +853,16 @@ def make_dist_mat(directory, highcut, lowcut, samp_rate,
                     endtime=tr.stats.starttime + back_clip)
     temp_sts = [x[0] for x in temp_list]
     print('Starting distance matrix computations')
-    dist_mat = distance_matrix(temp_sts, allow_shift=True, shift_len=shift,
-                               cores=cores)
-    print('Saving matrix to %s' % outfile)
-    np.save(outfile, dist_mat)
+    # Written block by block to outfile, so rerunning after a crash picks up
+    # where it left off
+    if corr_floor is not None:
+        dist_mat = sparse_distance_matrix(temp_sts, corr_floor,
+                                          shift_len=shift, cores=cores,
+                                          outfile=outfile)
+    else:
+        dist_mat = fft_distance_matrix(temp_sts, shift_len=shift,
+                                       cores=cores, outfile=outfile)
+    print('Distance matrix saved to %s' % outfile)
     return
 
 def cluster_temp_list(directory, dist_mat, method):
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+"""
+On-disk cache of processed (resampled, detrended, filtered) day-long traces
+so that the same raw days aren't run through dayproc again for every stage
+of the workflow.
+
+Each station/channel/day is stored as float32 .npy data plus a small json
+header, under a name hashed from the station, channel, day and processing
+parameters. Cached data are memory-mapped when read back.
+"""
+from __future__ import division
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+from waveform_index import grab_day_wavs, merge_day
+
+
+# Bump if the way data are processed before caching changes
+CACHE_VERSION = 2
+
+
+def _params(lowcut, highcut, filt_order, samp_rate, clean=True):
+    return {'lowcut': lowcut, 'highcut': highcut, 'filt_order': filt_order,
+            'samp_rate': samp_rate, 'clean': clean,
+            'version': CACHE_VERSION}
+
+
+def cache_key(station, channel, dto, params):
+    """
+    Hash identifying one processed station/channel/day
+
+    :param station: Station code
+    :param channel: Channel code
+    :param dto: UTCDateTime of the start of the day
+    :param params: Dict of processing parameters
+    :return: Hex digest string
+    """
+    key = json.dumps([station, channel, dto.strftime('%Y-%m-%d'), params],
+                     sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _entry_base(cache_dir, station, channel, dto, params):
+    return os.path.join(cache_dir, dto.strftime('%Y-%m-%d'), '%s.%s.%s' % (
+        station, channel, cache_key(station, channel, dto, params)[:16]))
+
+
+def _atomic_save(path, obj, write):
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        write(f, obj)
+    os.rename(tmp, path)
+
+
+def store_stachan(st, station, channel, dto, params, cache_dir):
+    """
+    Cache the processed traces for one station/channel/day
+
+    An empty Stream is cached too, so days with no data aren't re-read.
+
+    :param st: Stream of processed traces for this station/channel
+    :param station: Station code
+    :param channel: Channel code
+    :param dto: UTCDateTime of the start of the day
+    :param params: Dict of processing parameters (see cache_key)
+    :param cache_dir: Root directory of the cache
+    """
+    base = _entry_base(cache_dir, station, channel, dto, params)
+    if not os.path.isdir(os.path.dirname(base)):
+        os.makedirs(os.path.dirname(base))
+    header = {'params': params, 'traces': []}
+    for i, tr in enumerate(st):
+        npy = '%s_%d.npy' % (base, i)
+        _atomic_save(npy, tr.data.astype(np.float32), np.save)
+        header['traces'].append(
+            {'file': os.path.basename(npy), 'network': tr.stats.network,
+             'station': tr.stats.station, 'location': tr.stats.location,
+             'channel': tr.stats.channel,
+             'starttime': str(tr.stats.starttime),
+             'sampling_rate': tr.stats.sampling_rate})
+    # Header goes last: an entry only counts once its header exists
+    _atomic_save(base + '.json', header,
+                 lambda f, h: f.write(json.dumps(h).encode('utf-8')))
+
+
+def load_stachan(station, channel, dto, params, cache_dir, mmap=True):
+    """
+    Read one cached station/channel/day
+
+    :param station: Station code
+    :param channel: Channel code
+    :param dto: UTCDateTime of the start of the day
+    :param params: Dict of processing parameters (see cache_key)
+    :param cache_dir: Root directory of the cache
+    :param mmap: Memory-map the data (copy-on-write) rather than reading it
+    :return: Stream, or None if this station/channel/day isn't cached
+    """
+    base = _entry_base(cache_dir, station, channel, dto, params)
+    try:
+        with open(base + '.json', 'r') as f:
+            header = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    st = Stream()
+    for stats in header['traces']:
+        try:
+            data = np.load(os.path.join(os.path.dirname(base),
+                                        stats['file']),
+                           mmap_mode='c' if mmap else None)
+        except (IOError, OSError, ValueError):
+            return None
+        st += Trace(data=data, header={
+            'network': stats['network'], 'station': stats['station'],
+            'location': stats['location'], 'channel': stats['channel'],
+            'starttime': UTCDateTime(stats['starttime']),
+            'sampling_rate': stats['sampling_rate']})
+    # Mark as recently used for evict()
+    os.utime(base + '.json', None)
+    return st
+
+
+def cache_size(cache_dir):
+    """
+    Total size of the cache
+
+    :param cache_dir: Root directory of the cache
+    :return: Size in bytes
+    """
+    return sum(os.path.getsize(os.path.join(path, f))
+               for path, dirs, files in os.walk(cache_dir) for f in files)
+
+
+def evict(cache_dir, max_bytes, debug=0):
+    """
+    Delete the least recently used entries until the cache fits in max_bytes
+
+    :param cache_dir: Root directory of the cache
+    :param max_bytes: Size to trim the cache down to
+    :param debug: Verbosity
+    :return: Number of entries removed
+    """
+    entries = []
+    total = 0
+    for path, dirs, files in os.walk(cache_dir):
+        for f in files:
+            total += os.path.getsize(os.path.join(path, f))
+            if f.endswith('.json'):
+                header = os.path.join(path, f)
+                base = header[:-len('.json')]
+                size = os.path.getsize(header) + sum(
+                    os.path.getsize(os.path.join(path, g)) for g in files
+                    if g.startswith(os.path.basename(base) + '_'))
+                entries.append((os.path.getmtime(header), base, size))
+    removed = 0
+    for used, base, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        # Remove the header first so a half-deleted entry is a cache miss
+        os.remove(base + '.json')
+        path = os.path.dirname(base)
+        for g in os.listdir(path):
+            if g.startswith(os.path.basename(base) + '_'):
+                os.remove(os.path.join(path, g))
+        total -= size
+        removed += 1
+    if debug > 0:
+        print('Evicted %d cache entries, cache is now %.1f MB'
+              % (removed, total / 1e6))
+    return removed
+
+
+def processed_day(wav_dirs, dto, stachans, cache_dir, lowcut, highcut,
+                  filt_order, samp_rate, clean=True, max_bytes=None,
+                  num_cores=1, debug=0):
+    """
+    Return one day of processed data, from the cache where possible
+
+    Station/channels not yet cached are read with grab_day_wavs exactly as
+    the uncached callers do (passing clean through; raw data are only
+    merged, see merge_day), run through dayproc (ignore_length=True), then
+    cached for next time. Stachans removed as too short are cached as
+    empty. clean is part of the cache key.
+
+    :param wav_dirs: List of waveform directories (as for grab_day_wavs)
+    :param dto: UTCDateTime of the start of the day
+    :param stachans: Dict of {station: [channels]}
+    :param cache_dir: Root directory of the cache
+    :param lowcut: dayproc lowcut
+    :param highcut: dayproc highcut
+    :param filt_order: dayproc filt_order
+    :param samp_rate: dayproc samp_rate
+    :param clean: Passed to grab_day_wavs. If False only merge_day is run
+        before dayproc, so short traces are kept
+    :param max_bytes: If given, evict old entries to keep the cache this size
+    :param num_cores: Cores for dayproc
+    :param debug: Verbosity
+    :return: obspy.core.stream.Stream
+    """
+    from eqcorrscan.utils import pre_processing
+
+    params = _params(lowcut, highcut, filt_order, samp_rate, clean)
+    st = Stream()
+    missing = {}
+    for sta, chans in iter(stachans.items()):
+        for chan in chans:
+            cached = load_stachan(sta, chan, dto, params, cache_dir)
+            if cached is None:
+                missing.setdefault(sta, []).append(chan)
+            else:
+                st += cached
+    n_missing = sum([len(chans) for chans in missing.values()])
+    print('%d stachans cached, processing %d for %s' %
+          (sum([len(chans) for chans in stachans.values()]) - n_missing,
+           n_missing, dto.strftime('%Y-%m-%d')))
+    if n_missing == 0:
+        return st
+    # Read as for the uncached path, so with clean traces shorter than
+    # 0.8 * daylong are dropped (and cached as missing) in both
+    raw = grab_day_wavs(wav_dirs, dto, missing, clean=clean,
+                        samp_rate=samp_rate)
+    if not clean:
+        merge_day(raw, samp_rate)
+    if len(raw) > 0:
+        new_st = pre_processing.dayproc(raw, lowcut=lowcut, highcut=highcut,
+                                        filt_order=filt_order,
+                                        samp_rate=samp_rate, starttime=dto,
+                                        debug=debug, ignore_length=True,
+                                        num_cores=num_cores)
+    else:
+        new_st = Stream()
+    for sta, chans in iter(missing.items()):
+        for chan in chans:
+            chan_st = new_st.select(station=sta, channel=chan)
+            store_stachan(chan_st, sta, chan, dto, params, cache_dir)
+            # Hand back the cached copy so first and later runs match
+            st += load_stachan(sta, chan, dto, params, cache_dir)
+    if max_bytes:
+        evict(cache_dir, max_bytes, debug=debug)
+    return st
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+"""
+Resumable day-by-day matched filter detection runs. Each day's Party is
+written to its own file as soon as that day is done and recorded in a
+manifest, so a job which dies part way through can simply be resubmitted.
+
+Days can also be handed out from a sqlite queue on the shared filesystem
+(init_queue/run_queue) so that array tasks claim days as they free up
+rather than each running a fixed slice of the date range.
+
+Merge the per-day files afterwards with merge_day_parties, or from the shell:
+
+    python detection_runs.py merge <out_dir> <outfile>
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+import json
+import glob
+import fcntl
+import shutil
+import sqlite3
+import tempfile
+
+from timeit import default_timer as timer
+from obspy import UTCDateTime
+from waveform_index import prefetch_day_wavs
+
+
+MANIFEST = 'manifest.jsonl'
+
+
+def day_party_file(out_dir, dto):
+    # One file per day, named so that they sort by date
+    return os.path.join(out_dir, 'Party_%s.tgz' % dto.strftime('%Y-%m-%d'))
+
+
+def _write_party_atomic(party, filename):
+    """
+    Write a Party so that filename either doesn't exist or is complete
+
+    The Party is written into a temporary directory beside filename (same
+    filesystem) then renamed into place.
+
+    :param party: eqcorrscan.core.match_filter.Party
+    :param filename: Final path of the Party tarball
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(filename),
+                               prefix='.tmp_party_')
+    try:
+        tmp_base = os.path.join(tmp_dir, 'Party')
+        party.write(tmp_base)
+        # Older Party.write appends .tgz to the name it is given
+        written = glob.glob(tmp_base + '*')
+        os.rename(written[0], filename)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _append_manifest(out_dir, record):
+    # Array instances share out_dir, so lock the manifest while appending
+    with open(os.path.join(out_dir, MANIFEST), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(out_dir):
+    """
+    Read the records of all completed days in out_dir
+
+    Days whose Party file has since gone missing are not returned, nor are
+    days recorded with no data (no files found may just mean the archive
+    or its index wasn't ready), so those are run again.
+
+    :param out_dir: Directory holding the per-day Party files
+    :return: Dict of {'YYYY-MM-DD': record dict}
+    """
+    manifest = os.path.join(out_dir, MANIFEST)
+    records = {}
+    if not os.path.isfile(manifest):
+        return records
+    with open(manifest, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partial line from a job killed mid-write
+                continue
+            if record['file'] and not os.path.isfile(
+                    os.path.join(out_dir, record['file'])):
+                records.pop(record['date'], None)
+                continue
+            if record['status'] == 'no data':
+                records.pop(record['date'], None)
+                continue
+            records[record['date']] = record
+    return records
+
+
+def run_days(tribe, wav_dirs, dates, stachans, out_dir, threads=4,
+             **detect_kwargs):
+    """
+    Run Tribe.detect over a list of days, skipping days already completed
+
+    Each day's Party is written atomically to out_dir/Party_YYYY-MM-DD.tgz
+    and a record appended to out_dir/manifest.jsonl. Days with no detections
+    are recorded too (with file None) so they aren't re-run. Days with no
+    data are recorded but run again next time.
+
+    :param tribe: eqcorrscan.core.match_filter.Tribe
+    :param wav_dirs: List of waveform root directories (see prefetch_day_wavs)
+    :param dates: List of datetimes or UTCDateTimes for the start of each day
+    :param stachans: Dict of {station: [channels]}
+    :param out_dir: Directory for per-day Party files and the manifest
+    :param threads: Threads used to read each day's waveforms
+    :param detect_kwargs: Passed to Tribe.detect
+    :return: List of date strings run by this call
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    done = read_manifest(out_dir)
+    day_dtos = [UTCDateTime(day) for day in dates]
+    todo = [dto for dto in day_dtos
+            if dto.strftime('%Y-%m-%d') not in done]
+    print('%d of %d days already done, running %d' %
+          (len(day_dtos) - len(todo), len(day_dtos), len(todo)))
+    ran = []
+    for dto, st in prefetch_day_wavs(wav_dirs, todo, stachans,
+                                     threads=threads):
+        _detect_day(tribe, dto, st, out_dir, **detect_kwargs)
+        ran.append(dto.strftime('%Y-%m-%d'))
+    return ran
+
+
+def _detect_day(tribe, dto, st, out_dir, **detect_kwargs):
+    """
+    Detect on one day of data, write its Party and add it to the manifest
+
+    :return: The manifest record for the day
+    """
+    day_start = timer()
+    day_str = dto.strftime('%Y-%m-%d')
+    record = {'date': day_str, 'file': None, 'detections': 0}
+    if len(st) == 0:
+        print('No data for %s' % day_str)
+        record['status'] = 'no data'
+    else:
+        print('Starting correlation runs for %s' % str(dto))
+        party = tribe.detect(stream=st, **detect_kwargs)
+        record['detections'] = len(party)
+        record['status'] = 'done'
+        if len(party) > 0:
+            filename = day_party_file(out_dir, dto)
+            _write_party_atomic(party, filename)
+            record['file'] = os.path.basename(filename)
+    record['runtime'] = timer() - day_start
+    _append_manifest(out_dir, record)
+    return record
+
+
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    status TEXT,
+    worker TEXT,
+    claimed REAL,
+    finished REAL,
+    runtime REAL,
+    attempts INTEGER DEFAULT 0
+);
+"""
+
+
+def _connect_queue(queue_file):
+    # Workers block on each other's claims rather than erroring
+    conn = sqlite3.connect(queue_file, timeout=600.,
+                           isolation_level=None)
+    conn.executescript(_QUEUE_SCHEMA)
+    return conn
+
+
+def init_queue(queue_file, dates):
+    """
+    Add days to a shared day queue, leaving days already queued untouched
+
+    Safe for every array instance to call with the full date list.
+
+    :param queue_file: Path to the sqlite queue on a shared filesystem
+    :param dates: List of datetimes or UTCDateTimes for the start of each day
+    :return: queue_file
+    """
+    if not os.path.isdir(os.path.dirname(os.path.abspath(queue_file))):
+        os.makedirs(os.path.dirname(os.path.abspath(queue_file)))
+    conn = _connect_queue(queue_file)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(
+        "INSERT OR IGNORE INTO days (date, status) VALUES (?, 'pending')",
+        [(UTCDateTime(day).strftime('%Y-%m-%d'),) for day in dates])
+    conn.execute('COMMIT')
+    conn.close()
+    return queue_file
+
+
+def claim_day(queue_file, worker, stale_after=86400., max_attempts=2):
+    """
+    Atomically claim the earliest day still to be run
+
+    Days claimed more than stale_after seconds ago and never finished (the
+    worker was killed) are put back in the queue first, as are failed and
+    no data days which have had fewer than max_attempts goes.
+
+    :param queue_file: Path to the sqlite queue
+    :param worker: Name recorded against the claim, e.g. the array task id
+    :param stale_after: Seconds after which an unfinished claim is requeued
+    :param max_attempts: Number of times a day is tried before giving up
+    :return: UTCDateTime of the claimed day or None if the queue is empty
+    """
+    conn = _connect_queue(queue_file)
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute(
+        "UPDATE days SET status = 'pending' WHERE "
+        "((status = 'running' AND claimed < ?) OR "
+        "status IN ('failed', 'no data')) "
+        "AND attempts < ?", (now - stale_after, max_attempts))
+    row = conn.execute("SELECT date FROM days WHERE status = 'pending' "
+                       "ORDER BY date LIMIT 1").fetchone()
+    if row:
+        conn.execute("UPDATE days SET status = 'running', worker = ?, "
+                     "claimed = ?, attempts = attempts + 1 WHERE date = ?",
+                     (str(worker), now, row[0]))
+    conn.execute('COMMIT')
+    conn.close()
+    if row:
+        return UTCDateTime(row[0])
+    return None
+
+
+def finish_day(queue_file, dto, status='done', runtime=None):
+    """
+    Record that a claimed day has finished (or failed)
+
+    :param queue_file: Path to the sqlite queue
+    :param dto: UTCDateTime of the day
+    :param status: 'done', 'failed' or 'no data'
+    :param runtime: Seconds spent on the day
+    """
+    conn = _connect_queue(queue_file)
+    conn.execute('UPDATE days SET status = ?, finished = ?, runtime = ? '
+                 'WHERE date = ?', (status, time.time(), runtime,
+                                    dto.strftime('%Y-%m-%d')))
+    conn.close()
+
+
+def queue_summary(queue_file):
+    """
+    Count of days in each status and the mean runtime of finished days
+
+    :param queue_file: Path to the sqlite queue
+    :return: Dict of {status: (number of days, mean runtime)}
+    """
+    conn = _connect_queue(queue_file)
+    summary = {row[0]: (row[1], row[2]) for row in conn.execute(
+        'SELECT status, COUNT(*), AVG(runtime) FROM days GROUP BY status')}
+    conn.close()
+    return summary
+
+
+def run_queue(tribe, wav_dirs, queue_file, stachans, out_dir, worker,
+              stale_after=86400., threads=4, **detect_kwargs):
+    """
+    Claim and run days from a shared queue until it is empty
+
+    Any number of workers (e.g. SLURM array tasks) can run this on the same
+    queue_file, so long-running days no longer hold up a fixed slice of the
+    date range. Results are written as in run_days, and days already in the
+    out_dir manifest are marked done without being re-run.
+
+    :param tribe: eqcorrscan.core.match_filter.Tribe
+    :param wav_dirs: List of waveform root directories (see prefetch_day_wavs)
+    :param queue_file: Path to a queue made by init_queue
+    :param stachans: Dict of {station: [channels]}
+    :param out_dir: Directory for per-day Party files and the manifest
+    :param worker: Name of this worker, recorded in the queue
+    :param stale_after: Seconds after which another worker's unfinished
+        claim is taken over. A day is claimed (for prefetch) while the one
+        before it is still running, so make this longer than the two
+        slowest days back to back
+    :param threads: Threads used to read each day's waveforms
+    :param detect_kwargs: Passed to Tribe.detect
+    :return: List of date strings run by this worker
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    done = read_manifest(out_dir)
+
+    def _claims():
+        while True:
+            dto = claim_day(queue_file, worker, stale_after=stale_after)
+            if dto is None:
+                return
+            if dto.strftime('%Y-%m-%d') in done:
+                finish_day(queue_file, dto, runtime=0.)
+                continue
+            yield dto
+
+    ran = []
+    # The next day is claimed as soon as the current one starts, so it can
+    # be read in the background
+    for dto, st in prefetch_day_wavs(wav_dirs, _claims(), stachans,
+                                     threads=threads, skip_errors=True):
+        if st is None:
+            # Unreadable day: fail it now rather than leave it (and the day
+            # claimed for prefetch) running until stale_after
+            finish_day(queue_file, dto, status='failed')
+            continue
+        try:
+            record = _detect_day(tribe, dto, st, out_dir, **detect_kwargs)
+        except Exception as e:
+            print('Detection failed for %s: %s' % (str(dto), e))
+            finish_day(queue_file, dto, status='failed')
+            continue
+        # No data is requeued like a failure, and left as 'no data' in the
+        # queue summary once out of attempts, rather than counted as done
+        finish_day(queue_file, dto, status=record['status'],
+                   runtime=record['runtime'])
+        ran.append(record['date'])
+    print('Worker %s ran %d days. Queue: %s' %
+          (str(worker), len(ran), queue_summary(queue_file)))
+    return ran
+
+
+def merge_day_parties(out_dir, outfile=None, start=None, end=None):
+    """
+    Combine the per-day Party files listed in the manifest into one Party
+
+    :param out_dir: Directory holding the per-day Party files
+    :param outfile: If given, write the merged Party here
+    :param start: Optional UTCDateTime, only merge days from this date
+    :param end: Optional UTCDateTime, only merge days up to this date
+    :return: eqcorrscan.core.match_filter.Party
+    """
+    from eqcorrscan.core.match_filter import Party
+
+    records = read_manifest(out_dir)
+    party = Party()
+    for day_str in sorted(records):
+        record = records[day_str]
+        day = UTCDateTime(day_str)
+        if not record['file'] or (start and day < start) or \
+                (end and day > end):
+            continue
+        party += Party().read(os.path.join(out_dir, record['file']))
+    print('Merged %d families with %d detections' %
+          (len(party.families), len(party)))
+    if outfile:
+        party.write(outfile)
+    return party
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'merge':
+        print('Usage: python detection_runs.py merge <out_dir> <outfile>')
+        sys.exit(1)
+    merge_day_parties(sys.argv[2], outfile=sys.argv[3])
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+"""
+Template distance matrices computed in blocks with batched FFTs
+
+All templates are packed into one array per stachan, so each trace is only
+Fourier transformed once. Correlations are then done for one block of the
+upper triangle at a time, in parallel, into a memory-mapped .npy file which
+can be resumed if the run is killed.
+
+Values match eqcorrscan's distance_matrix with allow_shift=True: for each
+channel in common the demeaned traces are correlated, normalized by their
+overall energies, for shifts up to shift_len and the value with the largest
+absolute correlation kept. The distance is 1 - the mean over channels.
+
+For very large template sets sparse_distance_matrix keeps only the pairs
+correlated above a floor, as a scipy.sparse matrix/edge list.
+"""
+from __future__ import division
+
+import os
+import numpy as np
+
+from timeit import default_timer as timer
+from multiprocessing import Pool
+
+
+def pack_templates(stream_list):
+    """
+    Pack templates into one zero-filled, demeaned, unit-energy array per
+    stachan
+
+    :param stream_list: List of obspy Streams (templates)
+    :return: (dict of {(sta, chan): ndarray (n_templates, npts)},
+        dict of {(sta, chan): boolean ndarray (n_templates,)} of which
+        templates have that channel)
+    """
+    lengths = {}
+    for st in stream_list:
+        for tr in st:
+            key = (tr.stats.station, tr.stats.channel)
+            lengths[key] = min(lengths.get(key, tr.stats.npts), tr.stats.npts)
+    data = {key: np.zeros((len(stream_list), npts))
+            for key, npts in lengths.items()}
+    present = {key: np.zeros(len(stream_list), dtype=bool)
+               for key in lengths}
+    for i, st in enumerate(stream_list):
+        for tr in st:
+            key = (tr.stats.station, tr.stats.channel)
+            if present[key][i]:
+                # Only the first trace of each channel, as in the old code
+                continue
+            trace = tr.data[0:lengths[key]].astype(np.float64)
+            trace = trace - trace.mean()
+            norm = np.sqrt(np.sum(trace ** 2))
+            if norm == 0:
+                continue
+            data[key][i] = trace / norm
+            present[key][i] = True
+    return data, present
+
+
+def _blocks(n, block_size):
+    # Upper triangle (including the diagonal) of blocks, in order
+    edges = list(range(0, n, block_size)) + [n]
+    return [(edges[a], edges[a + 1], edges[b], edges[b + 1])
+            for a in range(len(edges) - 1) for b in range(a, len(edges) - 1)]
+
+
+# Packed data for the pool workers, set by _init_worker
+_spectra = None
+
+
+def _init_worker(spectra):
+    global _spectra
+    _spectra = spectra
+
+
+def _block_coherence(block):
+    """
+    Mean cross-channel coherence between rows i0:i1 and j0:j1
+
+    :return: (block, ndarray (i1 - i0, j1 - j0) of coherence)
+    """
+    i0, i1, j0, j1 = block
+    cccoh = np.zeros((i1 - i0, j1 - j0))
+    kchan = np.zeros((i1 - i0, j1 - j0))
+    for spec, present, nfft, shift in _spectra:
+        rows = np.nonzero(present[i0:i1])[0]
+        cols = np.nonzero(present[j0:j1])[0]
+        if len(rows) == 0 or len(cols) == 0:
+            continue
+        cross = np.fft.irfft(spec[i0 + rows][:, None, :] *
+                             np.conj(spec[j0 + cols])[None, :, :], nfft)
+        # Lags -shift..shift, with negative lags wrapped to the end
+        lags = np.concatenate((cross[:, :, nfft - shift:],
+                               cross[:, :, 0:shift + 1]), axis=-1)
+        peak = np.argmax(np.abs(lags), axis=-1)
+        cccoh[np.ix_(rows, cols)] += lags[
+            np.arange(len(rows))[:, None], np.arange(len(cols))[None, :],
+            peak]
+        kchan[np.ix_(rows, cols)] += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cccoh = np.where(kchan > 0, cccoh / np.maximum(kchan, 1), 0.)
+    return block, cccoh
+
+
+def _template_spectra(stream_list, shift_len):
+    # Spectra of the packed templates, one entry per stachan
+    samp_rate = stream_list[0][0].stats.sampling_rate
+    shift = int(shift_len * samp_rate)
+    data, present = pack_templates(stream_list)
+    spectra = []
+    for key in sorted(data):
+        npts = data[key].shape[1]
+        nfft = int(2 ** np.ceil(np.log2(npts + shift + 1)))
+        spectra.append((np.fft.rfft(data[key], nfft), present[key], nfft,
+                        min(shift, npts - 1)))
+    return spectra
+
+
+def _run_blocks(spectra, todo, cores):
+    """
+    Generator of (block, coherence) for the blocks in todo, in the order
+    they finish
+    """
+    if cores > 1:
+        pool = Pool(processes=cores, initializer=_init_worker,
+                    initargs=(spectra,))
+        try:
+            for result in pool.imap_unordered(_block_coherence, todo):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(spectra)
+        for block in todo:
+            yield _block_coherence(block)
+
+
+def distance_matrix(stream_list, shift_len=0., cores=1, outfile=None,
+                    block_size=64, debug=0):
+    """
+    Distance matrix (1 - cross-channel coherence) for a list of templates
+
+    :param stream_list: List of obspy Streams, all at the same sampling rate
+    :param shift_len: Maximum shift, in seconds, allowed between traces
+    :param cores: Number of processes to compute blocks with
+    :param outfile: Optional .npy file to hold the matrix as a memmap. If a
+        partially finished run with the same outfile exists, only the
+        blocks not yet done are computed
+    :param block_size: Number of templates per block side
+    :param debug: Verbosity
+    :return: ndarray (or np.memmap if outfile is given) of distances
+    """
+    n = len(stream_list)
+    spectra = _template_spectra(stream_list, shift_len)
+    blocks = _blocks(n, block_size)
+    done = set()
+    if outfile:
+        if not outfile.endswith('.npy'):
+            outfile += '.npy'
+        progress = outfile + '.done'
+        if os.path.isfile(outfile) and os.path.isfile(progress):
+            dist_mat = np.load(outfile, mmap_mode='r+')
+            if dist_mat.shape != (n, n):
+                raise IOError('%s is for %d templates, not %d' %
+                              (outfile, dist_mat.shape[0], n))
+            with open(progress, 'r') as f:
+                done = set([tuple(int(x) for x in line.split())
+                            for line in f if len(line.split()) == 4])
+        else:
+            dist_mat = np.lib.format.open_memmap(outfile, mode='w+',
+                                                 dtype=np.float64,
+                                                 shape=(n, n))
+            open(progress, 'w').close()
+        progress = open(progress, 'a')
+    else:
+        dist_mat = np.zeros((n, n))
+        progress = None
+    todo = [block for block in blocks if block not in done]
+    print('Computing %d of %d blocks for %d templates' %
+          (len(todo), len(blocks), n))
+    tic = timer()
+    try:
+        for k, ((i0, i1, j0, j1), cccoh) in enumerate(
+                _run_blocks(spectra, todo, cores)):
+            dist_mat[i0:i1, j0:j1] = 1 - cccoh
+            dist_mat[j0:j1, i0:i1] = (1 - cccoh).T
+            if progress:
+                dist_mat.flush()
+                progress.write('%d %d %d %d\n' % (i0, i1, j0, j1))
+                progress.flush()
+            if debug > 0:
+                print('Block %d of %d done, %.1f s' % (k + 1, len(todo),
+                                                       timer() - tic))
+    finally:
+        if progress:
+            progress.close()
+    np.fill_diagonal(dist_mat, 0.)
+    if outfile:
+        dist_mat.flush()
+    return dist_mat
+
+
+def sparse_distance_matrix(stream_list, corr_floor, shift_len=0., cores=1,
+                           outfile=None, block_size=64, debug=0):
+    """
+    Distance matrix keeping only pairs correlated at or above corr_floor
+
+    Pairs which aren't stored have distance > 1 - corr_floor. The diagonal
+    isn't stored. Memory is that of the kept pairs rather than n * n.
+
+    :param stream_list: List of obspy Streams, all at the same sampling rate
+    :param corr_floor: Minimum cross-channel coherence of pairs to keep
+    :param shift_len: Maximum shift, in seconds, allowed between traces
+    :param cores: Number of processes to compute blocks with
+    :param outfile: Optional .npz file for the edge list (see
+        load_sparse_distance_matrix). Finished blocks are kept in
+        <outfile>.parts so a killed run can be resumed
+    :param block_size: Number of templates per block side
+    :param debug: Verbosity
+    :return: scipy.sparse.csr_matrix of distances (symmetric)
+    """
+    n = len(stream_list)
+    spectra = _template_spectra(stream_list, shift_len)
+    blocks = _blocks(n, block_size)
+    parts = None
+    todo = blocks
+    if outfile:
+        if not outfile.endswith('.npz'):
+            outfile += '.npz'
+        parts = outfile + '.parts'
+        if not os.path.isdir(parts):
+            os.makedirs(parts)
+        todo = [block for block in blocks if not os.path.isfile(
+            os.path.join(parts, '%d_%d_%d_%d.npz' % block))]
+    print('Computing %d of %d blocks for %d templates' %
+          (len(todo), len(blocks), n))
+    rows = []
+    cols = []
+    dists = []
+    tic = timer()
+    for k, (block, cccoh) in enumerate(_run_blocks(spectra, todo, cores)):
+        i0, i1, j0, j1 = block
+        keep = cccoh >= corr_floor
+        if i0 == j0:
+            # Upper triangle only of the diagonal blocks
+            keep &= np.triu(np.ones(keep.shape, dtype=bool), k=1)
+        i, j = np.nonzero(keep)
+        edges = (i + i0, j + j0, 1 - cccoh[keep])
+        if parts:
+            tmp = os.path.join(parts, '.%d_%d_%d_%d.npz' % block)
+            np.savez(tmp, row=edges[0], col=edges[1], dist=edges[2])
+            os.rename(tmp, os.path.join(parts, '%d_%d_%d_%d.npz' % block))
+        else:
+            rows.append(edges[0])
+            cols.append(edges[1])
+            dists.append(edges[2])
+        if debug > 0:
+            print('Block %d of %d done, %.1f s' % (k + 1, len(todo),
+                                                   timer() - tic))
+    if parts:
+        for block in blocks:
+            with np.load(os.path.join(parts, '%d_%d_%d_%d.npz' % block)) \
+                    as part:
+                rows.append(part['row'])
+                cols.append(part['col'])
+                dists.append(part['dist'])
+    row = np.concatenate(rows).astype(np.int64) if rows else np.zeros(0, int)
+    col = np.concatenate(cols).astype(np.int64) if cols else np.zeros(0, int)
+    dist = np.concatenate(dists) if dists else np.zeros(0)
+    print('Kept %d of %d pairs' % (len(dist), n * (n - 1) // 2))
+    if outfile:
+        np.savez(outfile, row=row, col=col, dist=dist, n=n,
+                 corr_floor=corr_floor)
+    return _edges_to_csr(row, col, dist, n)
+
+
+def _edges_to_csr(row, col, dist, n):
+    from scipy.sparse import coo_matrix
+
+    # Both triangles, keeping explicit zero distances (identical templates)
+    return coo_matrix((np.concatenate((dist, dist)),
+                       (np.concatenate((row, col)),
+                        np.concatenate((col, row)))),
+                      shape=(n, n)).tocsr()
+
+
+def load_sparse_distance_matrix(filename):
+    """
+    Read an edge list written by sparse_distance_matrix
+
+    :param filename: .npz file
+    :return: scipy.sparse.csr_matrix of distances (symmetric)
+    """
+    with np.load(filename) as f:
+        return _edges_to_csr(f['row'], f['col'], f['dist'], int(f['n']))
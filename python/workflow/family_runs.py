@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+Run a function over the Families of a Party in a pool of processes
+
+Families are independent for relative magnitudes and lag calc, so each is
+handed to a worker on its own. Results come back in Family order whatever
+order they finish in, along with how long each Family took and any error,
+so one bad Family doesn't take down the rest of the run.
+
+Large read-only data needed by every Family (e.g. a day of waveforms) can
+be passed as shared: it is set in each worker once, when the pool starts,
+rather than sent with every task, and read there with shared_data().
+"""
+from __future__ import division
+
+import os
+import traceback
+
+from timeit import default_timer as timer
+from multiprocessing import Pool
+
+
+# Data common to all Families, set in each worker by _set_shared
+_shared = None
+
+
+def _set_shared(shared):
+    global _shared
+    _shared = shared
+
+
+def shared_data():
+    """
+    The shared argument given to map_families, from inside a worker
+    """
+    return _shared
+
+
+def _run_family(task):
+    """
+    Run func on one Family, catching any error
+
+    :return: Dict of index, family (template name), result, error, runtime
+        and worker (process id)
+    """
+    i, func, fam, args, kwargs = task
+    tic = timer()
+    record = {'index': i, 'family': fam.template.name, 'result': None,
+              'error': None, 'worker': os.getpid()}
+    try:
+        record['result'] = func(fam, *args, **kwargs)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['runtime'] = timer() - tic
+    return record
+
+
+def map_families(func, families, cores=1, args=(), kwargs=None, shared=None,
+                 timings=None):
+    """
+    Call func(family, *args, **kwargs) for every Family
+
+    func must be a module-level function so it can be sent to the workers.
+    Each Family's time is printed as it finishes and the slowest are listed
+    at the end.
+
+    :param func: Function taking a Family as its first argument
+    :param families: List of eqcorrscan.core.match_filter.Family
+    :param cores: Number of worker processes. 1 runs in this process
+    :param args: Further positional arguments to func
+    :param kwargs: Keyword arguments to func
+    :param shared: Read-only object for shared_data() in the workers
+    :param timings: Optional list to append the per-Family records to
+    :return: List of records (see _run_family), in the order of families
+    """
+    kwargs = kwargs or {}
+    tasks = [(i, func, fam, args, kwargs) for i, fam in enumerate(families)]
+    records = [None] * len(tasks)
+    tic = timer()
+    if cores > 1 and len(tasks) > 1:
+        pool = Pool(processes=min(cores, len(tasks)),
+                    initializer=_set_shared, initargs=(shared,))
+        try:
+            results = pool.imap_unordered(_run_family, tasks)
+            for k, record in enumerate(results):
+                records[record['index']] = record
+                _print_record(record, k + 1, len(tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _set_shared(shared)
+        try:
+            for k, task in enumerate(tasks):
+                records[k] = _run_family(task)
+                _print_record(records[k], k + 1, len(tasks))
+        finally:
+            _set_shared(None)
+    failed = [record for record in records if record['error']]
+    print('%d families in %.1f s with %d cores, %d failed' %
+          (len(records), timer() - tic, cores, len(failed)))
+    for record in sorted(records, key=lambda r: r['runtime'])[::-1][:5]:
+        print('    %s: %.1f s' % (record['family'], record['runtime']))
+    if timings is not None:
+        timings.extend(records)
+    return records
+
+
+def _print_record(record, k, n):
+    if record['error']:
+        print('Family %s failed (%d of %d) after %.1f s:\n%s' %
+              (record['family'], k, n, record['runtime'], record['error']))
+    else:
+        print('Family %s done (%d of %d) in %.1f s' %
+              (record['family'], k, n, record['runtime']))
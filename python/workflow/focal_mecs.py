@@ -30,6 +30,7 @@ from subprocess import Popen, PIPE
 from matplotlib import patches, transforms
 from mplstereonet import StereonetAxes
 from shelly_focmecs import cluster_to_consensus
+from waveform_index import grab_day_wavs
 from obspy import read, Catalog, UTCDateTime
 from scipy.signal import argrelmax, argrelmin
 from scipy.stats import circmean, circstd
@@ -61,62 +62,6 @@ except:
     print('MTfit not installed in this env, fool')
 
 
-def grab_day_wavs(wav_dirs, dto, stachans):
-    # Helper to recursively crawl paths searching for waveforms from a dict of
-    # stachans for one day
-    import os
-    import fnmatch
-    from itertools import chain
-    from obspy import read, Stream
-
-    st = Stream()
-    wav_files = []
-    wav_ds = ['%s/%d' % (d, dto.year) for d in wav_dirs]
-    for path, dirs, files in chain.from_iterable(os.walk(path)
-                                                 for path in wav_ds):
-        print('Looking in %s' % path)
-        for sta, chans in iter(stachans.items()):
-            for chan in chans:
-                for filename in fnmatch.filter(files,
-                                               '*.%s.*.%s*%d.%03d'
-                                                       % (
-                                               sta, chan, dto.year,
-                                               dto.julday)):
-                    wav_files.append(os.path.join(path, filename))
-    print('Reading into memory')
-    for wav in wav_files:
-        st += read(wav)
-    stachans = [(tr.stats.station, tr.stats.channel) for tr in st]
-    for stachan in list(set(stachans)):
-        tmp_st = st.select(station=stachan[0], channel=stachan[1])
-        if len(tmp_st) > 1 and len(set([tr.stats.sampling_rate
-                                        for tr in tmp_st])) > 1:
-            print('Traces from %s.%s have differing samp rates'
-                  % (stachan[0], stachan[1]))
-            for tr in tmp_st:
-                st.remove(tr)
-            tmp_st.resample(sampling_rate=100.)
-            st += tmp_st
-    st.merge(fill_value='interpolate')
-    print('Checking for trace length. Removing if too short')
-    rm_trs = []
-    for tr in st:
-        if len(tr.data) < (86400 * tr.stats.sampling_rate * 0.8):
-            rm_trs.append(tr)
-        if tr.stats.starttime != dto:
-            print('Trimming trace %s.%s with starttime %s to %s'
-                  % (tr.stats.station, tr.stats.channel,
-                     str(tr.stats.starttime), str(dto)))
-            tr.trim(starttime=dto, endtime=dto + 86400,
-                    nearest_sample=False)
-    if len(rm_trs) != 0:
-        print('Removing traces shorter than 0.8 * daylong')
-        for tr in rm_trs:
-            st.remove(tr)
-    else:
-        print('All traces long enough to proceed to dayproc')
-    return st
-
 def cluster_cat_distance(catalog, d_thresh=None, g_thresh=None,
                          method='kmeans',plot=False, field='Nga',
                          title='distance clusters', dd_only=False,
@@ -1458,7 +1403,8 @@ def plot_network_arrivals(wav_dirs, lowcut, highcut, start, end, sta_list=None,
     dto_start.minute = 0
     dto_start.second = 0
     dto_start.microsecond = 0
-    st = grab_day_wavs(wav_dirs, dto_start, stachans)
+    wav_ds = ['%s/%d' % (d, dto_start.year) for d in wav_dirs]
+    st = grab_day_wavs(wav_ds, dto_start, stachans)
     pf_dict = {'MERC': [0.001, 1.0, 35., 45.],
                'WPRZ': [0.001, 0.5, 35., 45.],
                'GEONET': [0.001, 0.01, 40., 48.]}
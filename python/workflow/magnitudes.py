@@ -16,6 +16,7 @@ from eqcorrscan.utils.clustering import cross_chan_coherence
 from eqcorrscan.utils.pre_processing import shortproc
 from eqcorrscan.utils.clustering import svd
 from eqcorrscan.utils.mag_calc import svd_moments
+from family_runs import map_families
 
 def local_to_moment(mag, m=0.88, c=0.73):
     """
@@ -52,6 +53,51 @@ def cc_coh_dets(streams, length, wav_prepick, corr_prepick, shift):
         cccohs.append(coh)
     return cccohs
 
+def family_relative_amps(svd_streams, min_amps):
+    """
+    Relative amplitudes of every event in a family to the template, per
+    Shelly et al., 2016 eq. 4, for all events and channels at once
+
+    For each template channel the detection windows are stacked into one
+    array. The first right singular vector of the two column [template,
+    detection] matrix has the closed form (cos(theta), sin(theta)) with
+    tan(2 * theta) = 2 * t.d / (t.t - d.d), so the amplitude ratio
+    Vt[0][1] / Vt[0][0] is tan(theta) and no per-pair svd is needed.
+
+    :param svd_streams: List of aligned, trimmed Streams, template first
+    :param min_amps: Minimum number of channels for an event to be kept
+    :return: (list of median relative amplitudes, list of the indices into
+        svd_streams of the events they belong to)
+    """
+    template = svd_streams[0]
+    # First trace of each stachan per stream, as Stream.select()[0] gave
+    lookups = []
+    for st in svd_streams:
+        lookup = {}
+        for tr in st:
+            lookup.setdefault((tr.stats.station, tr.stats.channel), tr.data)
+        lookups.append(lookup)
+    ratios = np.full((len(svd_streams), len(template)), np.nan)
+    for j, tr in enumerate(template):
+        key = (tr.stats.station, tr.stats.channel)
+        inds = [i for i, lookup in enumerate(lookups) if key in lookup]
+        npts = min([len(tr.data)] + [len(lookups[i][key]) for i in inds])
+        temp_data = tr.data[:npts].astype(np.float64)
+        det_data = np.array([lookups[i][key][:npts] for i in inds],
+                            dtype=np.float64)
+        t_t = np.dot(temp_data, temp_data)
+        t_d = np.dot(det_data, temp_data)
+        d_d = np.sum(det_data ** 2, axis=1)
+        ratios[inds, j] = np.tan(0.5 * np.arctan2(2 * t_d, t_t - d_d))
+    n_amps = np.sum(~np.isnan(ratios), axis=1)
+    keep = [i for i, st in enumerate(svd_streams)
+            if len(st) > 0 and n_amps[i] >= min_amps]
+    print('%d of %d events have at least %d amplitude picks' %
+          (len(keep), len(svd_streams), min_amps))
+    M = [np.median(ratios[i][~np.isnan(ratios[i])]) for i in keep]
+    return M, keep
+
+
 def plot_displacement_spectra(trace, ev, inv, savefig=False):
     """
     Simple function to plot the displacement spectra of a trace
@@ -96,9 +142,180 @@ def plot_displacement_spectra(trace, ev, inv, savefig=False):
         plt.show()
     return
 
+
+def _family_relative_mags(fam, selfs, shift_len, align_len, svd_len, reject,
+                          sac_dir, min_amps, calibrate, method):
+    """
+    Relative magnitudes for one Family. See party_relative_mags
+
+    Runs in a worker process, so the Family isn't changed here.
+
+    :return: None if the Family was skipped, otherwise a dict of 'cccohs'
+        (list of coherence with the template per event) and 'mags' (list of
+        (event index, Mw, ML) for calibrated events)
+    """
+    print('Starting work on family %s' % fam.template.name)
+    if len(fam) == 1:
+        print('Only self-detection. Moving on.')
+        return None
+    temp = fam.template
+    prepick = temp.prepick
+    events = [det.event for det in fam.detections]
+    # Here we'll read in the waveforms and trim from stefan's directory
+    # of SAC files so as not to duplicate data
+    ev_dirs = ['%s%s' % (sac_dir, str(ev.resource_id).split('/')[-1])
+               for ev in events]
+    streams = []
+    if len([i for i, ev_dir in enumerate(ev_dirs)
+                if ev_dir.split('/')[-1] in selfs]) == 0:
+        print('Family %s has no self detection. Investigate'
+              % fam.template.name)
+        return None
+    self_ind = [i for i, ev_dir in enumerate(ev_dirs)
+                if ev_dir.split('/')[-1] in selfs][0]
+    # Read in Z components of events which we wrote for stefan
+    # Many of these ev_dirs will not exist!
+    for i, ev_dir in enumerate(ev_dirs):
+        raw_st = Stream()
+        print('Reading %s' % ev_dir)
+        for wav_file in glob('%s/*Z.sac' % ev_dir):
+            print('...file %s' % wav_file)
+            raw_tr = read(wav_file)[0]
+            start = raw_tr.stats.starttime + raw_tr.stats.sac['a'] - 3.
+            end = start + 10
+            raw_tr.trim(starttime=start, endtime=end)
+            raw_st.traces.append(raw_tr)
+        streams.append(raw_st)
+    print('Moved self detection to top of list')
+    # Move the self detection to the first element
+    streams.insert(0, streams.pop(self_ind))
+    print('Template Stream: %s' % str(streams[0]))
+    if len(streams[0]) == 0:
+        print('Template %s waveforms did not get written to SAC.' %
+              temp.name)
+        return None
+    # Front/back clip hardcoded relative to wavs starting 3 s before pick
+    front_clip = 3.0 - shift_len - 0.05 - prepick
+    back_clip = front_clip + align_len + (2 * shift_len) + 0.05
+    wrk_streams = [] # For aligning
+    # Process streams then copy to both ccc_streams and svd_streams
+    bad_streams = []
+    for i, st in enumerate(list(streams)):
+        try:
+            shortproc(st=streams[i], lowcut=temp.lowcut,
+                      highcut=temp.highcut, filt_order=temp.filt_order,
+                      samp_rate=temp.samp_rate)
+            wrk_streams.append(st.copy())
+        except ValueError as e:
+            print('ValueError reads:')
+            print(str(e))
+            print('Attempting to remove bad trace at {}'.format(
+                str(e).split(' ')[-1]))
+            bad_tr = str(e).split(' ')[-1][:-1] # Eliminate trailing "'"
+            print('Sta and chan names: {}'.format(bad_tr.split('.')))
+            try:
+                tr = streams[i].select(station=bad_tr.split('.')[0],
+                                       channel=bad_tr.split('.')[1])[0]
+                streams[i].traces.remove(tr)
+                shortproc(st=streams[i], lowcut=temp.lowcut,
+                          highcut=temp.highcut,
+                          filt_order=temp.filt_order,
+                          samp_rate=temp.samp_rate)
+                wrk_streams.append(st.copy())
+            except IndexError as e:
+                print(str(e))
+                print('Funkyness. Removing entire stream')
+                bad_streams.append(st)
+    if len(bad_streams) > 0:
+        for bst in bad_streams:
+            streams.remove(bst)
+    svd_streams = copy.deepcopy(streams) # For svd
+    ccc_streams = copy.deepcopy(streams)
+    # work out cccoh for each event with template
+    cccohs = cc_coh_dets(streams=ccc_streams, shift=shift_len,
+                         length=svd_len, wav_prepick=3.,
+                         corr_prepick=0.05)
+    for st in wrk_streams:
+        for tr in st:
+            tr.trim(starttime=tr.stats.starttime + front_clip,
+                    endtime=tr.stats.starttime + back_clip)
+    st_chans = list(set([(tr.stats.station, tr.stats.channel)
+                         for st in wrk_streams for tr in st]))
+    st_chans.sort()
+    # Align streams with just P arrivals, then use longer st for svd
+    print('Now aligning svd_streams')
+    shift_inds = int(shift_len * fam.template.samp_rate)
+    for st_chan in st_chans:
+        trs = []
+        for i, st in enumerate(wrk_streams):
+            if len(st.select(station=st_chan[0], channel=st_chan[-1])) > 0:
+                trs.append((i, st.select(station=st_chan[0],
+                                         channel=st_chan[-1])[0]))
+        inds, traces = zip(*trs)
+        shifts, ccs = stacking.align_traces(trace_list=list(traces),
+                                            shift_len=shift_inds,
+                                            positive=True,
+                                            master=traces[0].copy())
+        # We now have shifts based on P correlation, shift and trim
+        # larger wavs for svd
+        for j, shift in enumerate(shifts):
+            st = svd_streams[inds[j]]
+            if ccs[j] < reject:
+                svd_streams[inds[j]].remove(st.select(
+                    station=st_chan[0], channel=st_chan[-1])[0])
+                print('Removing trace due to low cc value: %s' % ccs[j])
+                continue
+            strt_tr = st.select(
+                station=st_chan[0], channel=st_chan[-1])[0].stats.starttime
+            strt_tr += (3.0 - prepick - shift)
+            st.select(station=st_chan[0],
+                      channel=st_chan[-1])[0].trim(strt_tr,strt_tr
+                                                   + svd_len)
+    if method == 'LSQR':
+        print('Using least-squares method')
+        event_list = []
+        for stachan in st_chans:
+            st_list = []
+            for i, st in enumerate(svd_streams):
+                if len(st.select(station=stachan[0],
+                                 channel=stachan[-1])) > 0:
+                    st_list.append(i)
+            event_list.append(st_list)
+        # event_list = np.asarray(event_list).tolist()
+        u, sigma, v, sta_chans = svd(stream_list=svd_streams, full=True)
+        try:
+            M, events_out = svd_moments(u, sigma, v, sta_chans, event_list)
+        except IOError as e:
+            print('Family %s raised error %s' % (fam.template.name, e))
+            return None
+    elif method == 'PCA':
+        print('Using principal component method')
+        # All template:detection pairs (including temp:temp) at once
+        M, events_out = family_relative_amps(svd_streams, min_amps)
+    mags = []
+    # If we have a Mag for template, calibrate moments
+    if calibrate and len(fam.template.event.magnitudes) > 0:
+        # Convert the template magnitude to seismic moment
+        temp_mag = fam.template.event.magnitudes[-1].mag
+        temp_mo = local_to_moment(temp_mag)
+        # Extrapolate from the template moment - relative moment relationship to
+        # Get the moment for relative moment = 1.0
+        norm_mo = temp_mo / M[0]
+        # Template is the last event in the list
+        # Now these are weights which we can multiple the moments by
+        moments = np.multiply(M, norm_mo)
+        # Now convert to Mw
+        Mw = [2.0 / 3.0 * (np.log10(m) - 9.0) for m in moments]
+        Mw2, evs2 = remove_outliers(Mw, events_out)
+        # Convert to local
+        Ml = [0.88 * m + 0.73 for m in Mw2]
+        mags = [(eind, Mw2[i], Ml[i]) for i, eind in enumerate(evs2)]
+    return {'cccohs': cccohs, 'mags': mags}
+
+
 def party_relative_mags(party, self_files, shift_len, align_len, svd_len,
                         reject, sac_dir, min_amps, calibrate=False,
-                        method='PCA'):
+                        method='PCA', cores=1):
     """
     Calculate the relative moments for detections in a Family using
     mag_calc.svd_moments()
@@ -112,7 +329,10 @@ def party_relative_mags(party, self_files, shift_len, align_len, svd_len,
     :param min_amps: Minimum number of relative measurements per pair
     :param calibrate: Flag for calibration to a priori Ml's
     :param method: 'PCA' or 'LSQR'
-    :return:
+    :param cores: Number of Families to process at once (see family_runs)
+    :return: (party, dict of {template name: list of cccoh with the
+        template for each event}, list of the family_runs records of the
+        Families that failed, whose detections have no new magnitudes)
     """
 
     # First read-in self detection names
@@ -122,198 +342,32 @@ def party_relative_mags(party, self_files, shift_len, align_len, svd_len,
             rdr = csv.reader(f)
             for row in rdr:
                 selfs.append(str(row[0]))
-    for fam in party.families:
-        print('Starting work on family %s' % fam.template.name)
-        if len(fam) == 1:
-            print('Only self-detection. Moving on.')
-            continue
-        temp = fam.template
-        prepick = temp.prepick
-        events = [det.event for det in fam.detections]
-        # Here we'll read in the waveforms and trim from stefan's directory
-        # of SAC files so as not to duplicate data
-        ev_dirs = ['%s%s' % (sac_dir, str(ev.resource_id).split('/')[-1])
-                   for ev in events]
-        streams = []
-        if len([i for i, ev_dir in enumerate(ev_dirs)
-                    if ev_dir.split('/')[-1] in selfs]) == 0:
-            print('Family %s has no self detection. Investigate'
-                  % fam.template.name)
+    records = map_families(
+        _family_relative_mags, party.families, cores=cores,
+        args=(selfs, shift_len, align_len, svd_len, reject, sac_dir,
+              min_amps, calibrate, method))
+    cccohs = {}
+    # Merge back in Family order, whatever order the workers finished in
+    for fam, record in zip(party.families, records):
+        if record['result'] is None:
             continue
-        self_ind = [i for i, ev_dir in enumerate(ev_dirs)
-                    if ev_dir.split('/')[-1] in selfs][0]
-        # Read in Z components of events which we wrote for stefan
-        # Many of these ev_dirs will not exist!
-        for i, ev_dir in enumerate(ev_dirs):
-            raw_st = Stream()
-            print('Reading %s' % ev_dir)
-            for wav_file in glob('%s/*Z.sac' % ev_dir):
-                print('...file %s' % wav_file)
-                raw_tr = read(wav_file)[0]
-                start = raw_tr.stats.starttime + raw_tr.stats.sac['a'] - 3.
-                end = start + 10
-                raw_tr.trim(starttime=start, endtime=end)
-                raw_st.traces.append(raw_tr)
-            streams.append(raw_st)
-        print('Moved self detection to top of list')
-        # Move the self detection to the first element
-        streams.insert(0, streams.pop(self_ind))
-        print('Template Stream: %s' % str(streams[0]))
-        if len(streams[0]) == 0:
-            print('Template %s waveforms did not get written to SAC.' %
-                  temp.name)
+        cccohs[fam.template.name] = record['result']['cccohs']
+        if len(record['result']['mags']) == 0:
             continue
-        # Front/back clip hardcoded relative to wavs starting 3 s before pick
-        front_clip = 3.0 - shift_len - 0.05 - prepick
-        back_clip = front_clip + align_len + (2 * shift_len) + 0.05
-        wrk_streams = [] # For aligning
-        # Process streams then copy to both ccc_streams and svd_streams
-        bad_streams = []
-        for i, st in enumerate(list(streams)):
-            try:
-                shortproc(st=streams[i], lowcut=temp.lowcut,
-                          highcut=temp.highcut, filt_order=temp.filt_order,
-                          samp_rate=temp.samp_rate)
-                wrk_streams.append(st.copy())
-            except ValueError as e:
-                print('ValueError reads:')
-                print(str(e))
-                print('Attempting to remove bad trace at {}'.format(
-                    str(e).split(' ')[-1]))
-                bad_tr = str(e).split(' ')[-1][:-1] # Eliminate trailing "'"
-                print('Sta and chan names: {}'.format(bad_tr.split('.')))
-                try:
-                    tr = streams[i].select(station=bad_tr.split('.')[0],
-                                           channel=bad_tr.split('.')[1])[0]
-                    streams[i].traces.remove(tr)
-                    shortproc(st=streams[i], lowcut=temp.lowcut,
-                              highcut=temp.highcut,
-                              filt_order=temp.filt_order,
-                              samp_rate=temp.samp_rate)
-                    wrk_streams.append(st.copy())
-                except IndexError as e:
-                    print(str(e))
-                    print('Funkyness. Removing entire stream')
-                    bad_streams.append(st)
-        if len(bad_streams) > 0:
-            for bst in bad_streams:
-                streams.remove(bst)
-        svd_streams = copy.deepcopy(streams) # For svd
-        ccc_streams = copy.deepcopy(streams)
-        # work out cccoh for each event with template
-        cccohs = cc_coh_dets(streams=ccc_streams, shift=shift_len,
-                             length=svd_len, wav_prepick=3.,
-                             corr_prepick=0.05)
-        for st in wrk_streams:
-            for tr in st:
-                tr.trim(starttime=tr.stats.starttime + front_clip,
-                        endtime=tr.stats.starttime + back_clip)
-        st_chans = list(set([(tr.stats.station, tr.stats.channel)
-                             for st in wrk_streams for tr in st]))
-        st_chans.sort()
-        # Align streams with just P arrivals, then use longer st for svd
-        print('Now aligning svd_streams')
-        shift_inds = int(shift_len * fam.template.samp_rate)
-        for st_chan in st_chans:
-            trs = []
-            for i, st in enumerate(wrk_streams):
-                if len(st.select(station=st_chan[0], channel=st_chan[-1])) > 0:
-                    trs.append((i, st.select(station=st_chan[0],
-                                             channel=st_chan[-1])[0]))
-            inds, traces = zip(*trs)
-            shifts, ccs = stacking.align_traces(trace_list=list(traces),
-                                                shift_len=shift_inds,
-                                                positive=True,
-                                                master=traces[0].copy())
-            # We now have shifts based on P correlation, shift and trim
-            # larger wavs for svd
-            for j, shift in enumerate(shifts):
-                st = svd_streams[inds[j]]
-                if ccs[j] < reject:
-                    svd_streams[inds[j]].remove(st.select(
-                        station=st_chan[0], channel=st_chan[-1])[0])
-                    print('Removing trace due to low cc value: %s' % ccs[j])
-                    continue
-                strt_tr = st.select(
-                    station=st_chan[0], channel=st_chan[-1])[0].stats.starttime
-                strt_tr += (3.0 - prepick - shift)
-                st.select(station=st_chan[0],
-                          channel=st_chan[-1])[0].trim(strt_tr,strt_tr
-                                                       + svd_len)
-        if method == 'LSQR':
-            print('Using least-squares method')
-            event_list = []
-            for stachan in st_chans:
-                st_list = []
-                for i, st in enumerate(svd_streams):
-                    if len(st.select(station=stachan[0],
-                                     channel=stachan[-1])) > 0:
-                        st_list.append(i)
-                event_list.append(st_list)
-            # event_list = np.asarray(event_list).tolist()
-            u, sigma, v, sta_chans = svd(stream_list=svd_streams, full=True)
-            try:
-                M, events_out = svd_moments(u, sigma, v, sta_chans, event_list)
-            except IOError as e:
-                print('Family %s raised error %s' % (fam.template.name, e))
-                continue
-        elif method == 'PCA':
-            print('Using principal component method')
-            # Now loop over all detections and do svd for each matching
-            # chan with temp
-            events_out = []
-            template = svd_streams[0]
-            M = []
-            for i, st in enumerate(svd_streams):
-                if len(st) == 0:
-                    print('Event not located, skipping')
-                    continue
-                ev_r_amps = []
-                # For each pair of template:detection (including temp:temp)
-                for tr in template:
-                    if len(st.select(station=tr.stats.station,
-                                     channel=tr.stats.channel)) > 0:
-                        det_tr = st.select(station=tr.stats.station,
-                                           channel=tr.stats.channel)[0]
-                        # Convoluted way of getting two 'vert' vectors
-                        data_mat = np.vstack((tr.data, det_tr.data)).T
-                        U, sig, Vt = scipy.linalg.svd(data_mat,
-                                                      full_matrices=True)
-                        # Vt is 2x2 for two events
-                        # Per Shelly et al., 2016 eq. 4
-                        ev_r_amps.append(Vt[0][1] / Vt[0][0])
-                if len(ev_r_amps) < min_amps:
-                    print('Fewer than 4 amplitude picks, skipping.')
-                    continue
-                M.append(np.median(ev_r_amps))
-                events_out.append(i)
-        # If we have a Mag for template, calibrate moments
-        if calibrate and len(fam.template.event.magnitudes) > 0:
-            # Convert the template magnitude to seismic moment
-            temp_mag = fam.template.event.magnitudes[-1].mag
-            temp_mo = local_to_moment(temp_mag)
-            # Extrapolate from the template moment - relative moment relationship to
-            # Get the moment for relative moment = 1.0
-            norm_mo = temp_mo / M[0]
-            # Template is the last event in the list
-            # Now these are weights which we can multiple the moments by
-            moments = np.multiply(M, norm_mo)
-            # Now convert to Mw
-            Mw = [2.0 / 3.0 * (np.log10(m) - 9.0) for m in moments]
-            Mw2, evs2 = remove_outliers(Mw, events_out)
-            # Convert to local
-            Ml = [0.88 * m + 0.73 for m in Mw2]
-            #Normalize moments to template mag
-            # Add calibrated mags to detection events
-            for i, eind in enumerate(evs2):
-                fam.detections[eind-1].event.magnitudes = [
-                    Magnitude(mag=Mw2[i], magnitude_type='Mw')]
-                fam.detections[eind-1].event.comments.append(
-                    Comment(text=str(cccohs[eind-1])))
-                fam.detections[eind-1].event.magnitudes.append(
-                    Magnitude(mag=Ml[i], magnitude_type='ML'))
-            fam.catalog = Catalog(events=[det.event for det in fam.detections])
-    return party, cccohs
+        # Add calibrated mags to detection events
+        for eind, mw, ml in record['result']['mags']:
+            fam.detections[eind-1].event.magnitudes = [
+                Magnitude(mag=mw, magnitude_type='Mw')]
+            fam.detections[eind-1].event.comments.append(
+                Comment(text=str(cccohs[fam.template.name][eind-1])))
+            fam.detections[eind-1].event.magnitudes.append(
+                Magnitude(mag=ml, magnitude_type='ML'))
+        fam.catalog = Catalog(events=[det.event for det in fam.detections])
+    failed = [record for record in records if record['error']]
+    if len(failed) > 0:
+        print('Relative magnitudes failed for families: %s'
+              % ', '.join([record['family'] for record in failed]))
+    return party, cccohs, failed
 
 
 def remove_outliers(M, ev_out, m=4):
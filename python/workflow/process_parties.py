@@ -8,79 +8,77 @@ def date_generator(start_date, end_date):
     for n in range(int((end_date - start_date).days) + 1):
         yield start_date + timedelta(n)
 
-def grab_day_wavs(wav_dirs, dto, stachans):
-    # Helper to recursively crawl paths searching for waveforms from a dict of
-    # stachans for one day
-    import os
-    import fnmatch
-    from itertools import chain
-    from obspy import read, Stream
-
-    st = Stream()
-    wav_files = []
-    for path, dirs, files in chain.from_iterable(os.walk(path)
-                                                 for path in wav_dirs):
-        print('Looking in %s' % path)
-        for sta, chans in iter(stachans.items()):
-            for chan in chans:
-                for filename in fnmatch.filter(files,
-                                               '*.%s.*.%s*%d.%03d'
-                                                       % (
-                                               sta, chan, dto.year,
-                                               dto.julday)):
-                    wav_files.append(os.path.join(path, filename))
-    print('Reading into memory')
-    for wav in wav_files:
-        st += read(wav)
-    stachans = [(tr.stats.station, tr.stats.channel) for tr in st]
-    for stachan in list(set(stachans)):
-        tmp_st = st.select(station=stachan[0], channel=stachan[1])
-        if len(tmp_st) > 1 and len(set([tr.stats.sampling_rate
-                                        for tr in tmp_st])) > 1:
-            print('Traces from %s.%s have differing samp rates'
-                  % (stachan[0], stachan[1]))
-            for tr in tmp_st:
-                st.remove(tr)
-            tmp_st.resample(sampling_rate=100.)
-            st += tmp_st
-    st.merge(fill_value='interpolate')
-    print('Checking for trace length. Removing if too short')
-    rm_trs = []
-    for tr in st:
-        if len(tr.data) < (86400 * tr.stats.sampling_rate * 0.8):
-            rm_trs.append(tr)
-        if tr.stats.starttime != dto:
-            print('Trimming trace %s.%s with starttime %s to %s'
-                  % (tr.stats.station, tr.stats.channel,
-                     str(tr.stats.starttime), str(dto)))
-            tr.trim(starttime=dto, endtime=dto + 86400,
-                    nearest_sample=False)
-    if len(rm_trs) != 0:
-        print('Removing traces shorter than 0.8 * daylong')
-        for tr in rm_trs:
-            st.remove(tr)
-    else:
-        print('All traces long enough to proceed to dayproc')
-    return st
+def _family_lag_calc(fam, shift_len, min_cc, debug, plot):
+    """
+    Lag calc for one Family against the shared, pre-processed day (see
+    family_runs.map_families)
+    """
+    from eqcorrscan.core.match_filter import Party
+    from family_runs import shared_data
+
+    return Party(families=[fam]).lag_calc(
+        stream=shared_data(), pre_processed=True, shift_len=shift_len,
+        min_cc=min_cc, cores=1, debug=debug, plot=plot, parallel=False)
+
 
 def lag_calc_daylong(wav_dirs, party, start, end, outdir, shift_len, min_cc,
-                     cores=5, parallel=True, plot=False, debug=1):
+                     cores=5, parallel=True, plot=False, debug=1,
+                     cache_dir=None, family_cores=1):
     """
     Essentially just a day loop to grab the day's waveforms and the day's
     party and then perform the lag calc
     :param wav_dir:
     :param party: eqcorrscane.core.match_filter.Party
-    :return:
+    :param cache_dir: Optional day_cache directory. Processed days are read
+        from (and added to) the cache and passed to lag_calc pre-processed.
+        All templates must share the same processing parameters
+    :param family_cores: Number of Families to lag calc at once, each in
+        its own process (see family_runs). Only used with cache_dir, as the
+        day must already be processed to be shared between Families. The
+        Families that fail are left out of the day's catalogue and listed,
+        with their errors, in a _failed.txt file beside it
+    :return: List of the family_runs records of failed Families, each with
+        the day added as 'day'
     """
+    import os
     import datetime
     from obspy import UTCDateTime
+    from obspy import Catalog
     from eqcorrscan.core.match_filter import Party, Family
+    from waveform_index import prefetch_day_wavs
+    from day_cache import processed_day
+    from family_runs import map_families
 
     cat_start = datetime.datetime.strptime(start, '%d/%m/%Y')
     cat_end = datetime.datetime.strptime(end, '%d/%m/%Y')
-    for date in date_generator(cat_start, cat_end):
-        # Find waveforms and create party for this day
-        dto = UTCDateTime(date)
+    stachans = {tr.stats.station: [] for family in party
+                for tr in family.template.st}
+    for family in party:
+        for tr in family.template.st:
+            # Don't hard code vertical channels!!
+            chan_code = 'EH' + tr.stats.channel[-1]
+            if chan_code not in stachans[tr.stats.station]:
+                stachans[tr.stats.station].append(chan_code)
+    dtos = [UTCDateTime(date) for date in date_generator(cat_start, cat_end)]
+    if cache_dir:
+        proc_params = set([(fam.template.lowcut, fam.template.highcut,
+                            fam.template.filt_order, fam.template.samp_rate)
+                           for fam in party])
+        if len(proc_params) > 1:
+            raise NotImplementedError('Templates processed differently, '
+                                      'cannot use one cached day')
+        lowcut, highcut, filt_order, samp_rate = proc_params.pop()
+        days = ((dto, processed_day([os.path.join(d, str(dto.year))
+                                     for d in wav_dirs], dto, stachans,
+                                    cache_dir, lowcut, highcut, filt_order,
+                                    samp_rate, num_cores=cores))
+                for dto in dtos)
+    else:
+        # Next day's waveforms are read in the background during lag calc
+        days = prefetch_day_wavs(wav_dirs, dtos, stachans, threads=cores)
+    failed = []
+    for dto, st in days:
+        # Create party for this day
         day_fams = []
         for fam in party:
             day_fams.append(Family(detections=[det for det in fam if
@@ -88,29 +86,48 @@ def lag_calc_daylong(wav_dirs, party, start, end, outdir, shift_len, min_cc,
                                                det.detect_time < dto + 86400],
                                    template=fam.template))
         day_party = Party(families=day_fams)
-        stachans = {tr.stats.station: [] for family in day_party
-                    for tr in family.template.st}
-        for family in party:
-            for tr in family.template.st:
-                # Don't hard code vertical channels!!
-                chan_code = 'EH' + tr.stats.channel[-1]
-                if chan_code not in stachans[tr.stats.station]:
-                    stachans[tr.stats.station].append(chan_code)
-        print('Reading waveforms')
-        wav_ds = ['%s%d' % (d, dto.year) for d in wav_dirs]
-        st = grab_day_wavs(wav_dirs=wav_ds, dto=dto, stachans=stachans)
         print('Running lag calc')
-        day_cat = day_party.lag_calc(stream=st, pre_processed=False,
-                                     shift_len=shift_len, min_cc=min_cc,
-                                     cores=cores, debug=debug, plot=plot,
-                                     parallel=parallel)
-        day_cat.write('%s/det_cat_mcc%0.3f_shift%0.1f_%s.xml' \
-                      % (outdir,
-                         min_cc,
-                         shift_len,
-                         dto.strftime('%Y-%m-%d')),
-                      format='QUAKEML')
-    return
+        if family_cores > 1 and cache_dir:
+            records = map_families(
+                _family_lag_calc, [fam for fam in day_fams if len(fam) > 0],
+                cores=family_cores, shared=st,
+                args=(shift_len, min_cc, debug, plot))
+            # Catalogs appended in Family order, as from Party.lag_calc
+            day_cat = Catalog()
+            day_failed = []
+            for record in records:
+                if record['error']:
+                    record['day'] = dto.strftime('%Y-%m-%d')
+                    day_failed.append(record)
+                elif record['result'] is not None:
+                    day_cat += record['result']
+        else:
+            if family_cores > 1:
+                print('Family-parallel lag calc needs cache_dir, running '
+                      'all Families together')
+            day_cat = day_party.lag_calc(stream=st,
+                                         pre_processed=bool(cache_dir),
+                                         shift_len=shift_len, min_cc=min_cc,
+                                         cores=cores, debug=debug, plot=plot,
+                                         parallel=parallel)
+            day_failed = []
+        cat_root = '%s/det_cat_mcc%0.3f_shift%0.1f_%s' % (
+            outdir, min_cc, shift_len, dto.strftime('%Y-%m-%d'))
+        day_cat.write('%s.xml' % cat_root, format='QUAKEML')
+        if len(day_failed) > 0:
+            # Catalogue for this day is incomplete, say which Families are
+            # missing from it so they can be rerun
+            print('Lag calc failed for %d families on %s, see %s_failed.txt'
+                  % (len(day_failed), dto.strftime('%Y-%m-%d'), cat_root))
+            with open('%s_failed.txt' % cat_root, 'w') as f:
+                for record in day_failed:
+                    f.write('%s\n%s\n' % (record['family'],
+                                           record['error']))
+            failed.extend(day_failed)
+        elif os.path.isfile('%s_failed.txt' % cat_root):
+            # Left by an earlier run of this day
+            os.remove('%s_failed.txt' % cat_root)
+    return failed
 
 def decluster_day_parties(party_dir, tribe_dir, trig_int, min_chan, metric,
                           start, end):
@@ -7,6 +7,8 @@ Functions for running Shelly et al. focal mechanism methods for MF detections
 # matplotlib.use('Agg')
 
 import os
+import json
+import hashlib
 import random
 import unittest
 import pickle
@@ -33,7 +35,6 @@ from operator import attrgetter
 from collections import OrderedDict
 from subprocess import call
 from multiprocessing import Pool
-from numpy.linalg import LinAlgError
 from scipy.signal import argrelmax
 from scipy.spatial.distance import pdist
 from scipy.cluster.hierarchy import linkage, dendrogram, fcluster,\
@@ -187,6 +188,107 @@ def _rel_polarity(data1, data2, min_cc, m, n, stachan, phase, plotdir,
     return rel_pol
 
 
+def _take_last(arr, idx):
+    # arr[..., idx] element-wise along the last axis
+    flat = arr.reshape(-1, arr.shape[-1])
+    return flat[np.arange(flat.shape[0]), idx.ravel()].reshape(idx.shape)
+
+
+def _batch_rel_polarity(temp_traces, det_traces, min_cc, chunk_size=None):
+    """
+    Relative polarities for every template/detection pair of a stachan
+
+    Array version of _rel_polarity: the sliding normalized correlations of
+    all pairs are computed with one FFT of each trace, then the max abs
+    peak, its sign and the margin over the neighbouring peaks of abs(ccc)
+    (argrelmax order=2) found with array operations.
+
+    :type temp_traces: numpy.ndarray
+    :param temp_traces: Template data, shape (n_templates, temp_len)
+    :type det_traces: numpy.ndarray
+    :param det_traces: Detection data, shape (n_detections, det_len)
+    :type min_cc: float
+    :param min_cc: Minimum accepted cros-correlation value for a polarity pick
+    :type chunk_size: int
+    :param chunk_size: Templates correlated at once. Defaults to keeping
+        each batch of correlations to about 10 million samples
+
+    :returns: Relative polarities, shape (n_detections, n_templates)
+    :rtype: numpy.ndarray
+    """
+    temps = np.asarray(temp_traces, dtype=np.float64)
+    dets = np.asarray(det_traces, dtype=np.float64)
+    n_temps, temp_len = temps.shape
+    n_dets, det_len = dets.shape
+    n_lags = det_len - temp_len + 1
+    pol_array = np.zeros((n_dets, n_temps))
+    if n_temps == 0 or n_dets == 0 or n_lags < 1:
+        return pol_array
+    if not chunk_size:
+        chunk_size = max(1, int(1e7 // (n_dets * n_lags)))
+    # Templates demeaned and normalized; detection window energies from
+    # running sums, as in normxcorr2
+    temps = temps - temps.mean(axis=1)[:, None]
+    temp_norm = np.sqrt(np.sum(temps ** 2, axis=1))
+    cum = np.cumsum(np.pad(dets, ((0, 0), (1, 0)), mode='constant'), axis=1)
+    cum2 = np.cumsum(np.pad(dets ** 2, ((0, 0), (1, 0)), mode='constant'),
+                     axis=1)
+    win_sum = cum[:, temp_len:] - cum[:, :n_lags]
+    win_var = (cum2[:, temp_len:] - cum2[:, :n_lags]) - \
+        win_sum ** 2 / temp_len
+    win_norm = np.sqrt(np.maximum(win_var, 0))
+    tol = 1e-10 * max(np.max(np.abs(win_var)), 1e-300)
+    nfft = int(2 ** np.ceil(np.log2(det_len + temp_len)))
+    det_fft = np.fft.rfft(dets, nfft)
+    lags = np.arange(n_lags)
+    for c0 in range(0, n_temps, chunk_size):
+        c1 = min(c0 + chunk_size, n_temps)
+        temp_fft = np.conj(np.fft.rfft(temps[c0:c1], nfft))
+        # (n_chunk, n_dets, n_lags) sliding dot products
+        num = np.fft.irfft(temp_fft[:, None, :] * det_fft[None, :, :],
+                           nfft)[:, :, :n_lags]
+        denom = temp_norm[c0:c1, None, None] * win_norm[None, :, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ccc = np.where(np.logical_and(denom > 0, win_var[None] > tol),
+                           num / denom, 0.)
+        ccc = np.clip(ccc, -1., 1.)
+        abs_ccc = np.abs(ccc)
+        raw_max = np.argmax(abs_ccc, axis=-1)
+        max_val = _take_last(ccc, raw_max)
+        # argrelmax(order=2, mode='clip') of abs(ccc)
+        peaks = np.ones(abs_ccc.shape, dtype=bool)
+        for shift in (1, 2):
+            for step in (shift, -shift):
+                peaks &= abs_ccc > abs_ccc[..., np.clip(lags + step, 0,
+                                                        n_lags - 1)]
+        # Nearest peaks either side of the max
+        prev_pk = np.maximum.accumulate(np.where(peaks, lags, -1), axis=-1)
+        next_pk = np.minimum.accumulate(
+            np.where(peaks, lags, n_lags)[..., ::-1], axis=-1)[..., ::-1]
+        prev_ind = _take_last(prev_pk, np.maximum(raw_max - 1, 0))
+        prev_ind[raw_max == 0] = -1
+        next_ind = _take_last(next_pk, np.minimum(raw_max + 1, n_lags - 1))
+        next_ind[raw_max == n_lags - 1] = n_lags
+        prev_val = np.where(prev_ind >= 0,
+                            _take_last(abs_ccc, np.maximum(prev_ind, 0)),
+                            -np.inf)
+        next_val = np.where(next_ind < n_lags,
+                            _take_last(abs_ccc,
+                                       np.minimum(next_ind, n_lags - 1)),
+                            -np.inf)
+        with np.errstate(invalid='ignore'):
+            rel_pol = np.sign(max_val) * (np.abs(max_val) -
+                                          np.maximum(prev_val, next_val))
+        # Same skips as _rel_polarity: no data, max at either end, max
+        # below min_cc, only one peak or the max not picked as a peak
+        ok = (raw_max > 0) & (raw_max < n_lags - 1) & \
+            (np.abs(max_val) >= min_cc) & (peaks.sum(axis=-1) > 1) & \
+            _take_last(peaks, raw_max) & \
+            temps[c0:c1].any(axis=1)[:, None] & dets.any(axis=1)[None, :]
+        pol_array[:, c0:c1] = np.where(ok, rel_pol, 0.).T
+    return pol_array
+
+
 def _rel_pol_plot(temp, image, ccc, sec_pk_locs, raw_max, pk_locs, pk_ind,
                   rel_pol, second_pk_vals, m, n, stachan, phase, plotdir):
     # Plot shifted waveforms and the correlation coefficient with time
@@ -337,10 +439,16 @@ def _stachan_loop(phase, stachan, temp_traces, det_traces, min_cc, plotdir,
                   debug):
     """
     Inner loop to parallel over stachan matrices
+
+    All pairs are done at once by _batch_rel_polarity, unless debug > 1 in
+    which case each pair goes through _rel_polarity so it can be plotted
     :return:
     """
-    pol_array = np.zeros((len(det_traces), len(temp_traces)))
     print('Looping stachan: {}'.format(stachan))
+    if debug <= 1:
+        return phase, stachan, _batch_rel_polarity(temp_traces, det_traces,
+                                                   min_cc)
+    pol_array = np.zeros((len(det_traces), len(temp_traces)))
     for m in range(len(temp_traces)):
         for n in range(len(det_traces)):
             pol = _rel_polarity(temp_traces[m], det_traces[n], min_cc, m, n,
@@ -349,6 +457,120 @@ def _stachan_loop(phase, stachan, temp_traces, det_traces, min_cc, plotdir,
     return phase, stachan, pol_array
 
 
+class TraceBank(object):
+    """
+    Template and detection trace matrices for every phase/stachan packed
+    into one block of shared memory so pool workers attach to it by name
+    rather than being sent a pickled copy of both matrices with every task
+
+    Uses multiprocessing.shared_memory where available (python >= 3.8) and
+    otherwise a RawArray inherited by the forked pool workers. Data are
+    stored as float32, as in match_filter's TemplateBank, halving the
+    memory; correlations are still computed in float64 (see get), so
+    polarities agree with the cores=1 path to float32 precision
+    """
+    def __init__(self, temp_traces, det_traces):
+        """
+        :type temp_traces: dict
+        :param temp_traces: {phase: {stachan: np.ndarray}} of template data
+        :type det_traces: dict
+        :param det_traces: {phase: {stachan: np.ndarray}} of detection data
+        """
+        self.table = {}
+        offset = 0
+        arrays = []
+        for kind, traces in (('temp', temp_traces), ('det', det_traces)):
+            for phase, stachans in traces.items():
+                for stachan, arr in stachans.items():
+                    self.table[(phase, stachan, kind)] = (offset, arr.shape)
+                    arrays.append((offset, arr))
+                    offset += arr.size
+        self.size = offset
+        self._shm = None
+        self._raw = None
+        self.name = None
+        try:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=max(offset, 1) * 4)
+            self.name = self._shm.name
+            self._buf = self._shm.buf
+        except ImportError:
+            from multiprocessing.sharedctypes import RawArray
+            self._raw = RawArray('f', max(offset, 1))
+            self._buf = self._raw
+        self._owner = True
+        data = np.frombuffer(self._buf, dtype=np.float32, count=offset)
+        for start, arr in arrays:
+            data[start:start + arr.size] = arr.ravel()
+        del data
+
+    def get(self, phase, stachan, kind):
+        """
+        Return one trace matrix as float64
+
+        :param phase: 'P' or 'S'
+        :param stachan: 'STA.CHAN' string
+        :param kind: 'temp' or 'det'
+        :return: np.ndarray of shape (n_events, n_samples)
+        """
+        offset, shape = self.table[(phase, stachan, kind)]
+        view = np.frombuffer(self._buf, dtype=np.float32,
+                             count=int(np.prod(shape)),
+                             offset=offset * 4).reshape(shape)
+        # One stachan's worth is copied out per task, the bank stays float32
+        return view.astype(np.float64)
+
+    def close(self):
+        """Detach, freeing the memory if this is the creating process"""
+        self._buf = None
+        self._raw = None
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __getstate__(self):
+        # Only the name and offsets go to the workers (the RawArray can only
+        # be inherited, not pickled)
+        return {'table': self.table, 'size': self.size, 'name': self.name,
+                '_raw': self._raw}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        self._shm = None
+        if self.name is not None:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            self._buf = self._shm.buf
+        else:
+            self._buf = self._raw
+
+
+# TraceBank attached in each pool worker by _attach_bank
+_worker_bank = None
+
+
+def _attach_bank(bank):
+    """Pool initializer storing the shared TraceBank for the worker"""
+    global _worker_bank
+    _worker_bank = bank
+
+
+def _bank_stachan_loop(phase, stachan, min_cc, plotdir, debug):
+    """
+    _stachan_loop reading the trace matrices from the worker's TraceBank
+    :return:
+    """
+    return _stachan_loop(phase, stachan,
+                         _worker_bank.get(phase, stachan, 'temp'),
+                         _worker_bank.get(phase, stachan, 'det'),
+                         min_cc, plotdir, debug)
+
+
 def make_corr_matrices(template_streams, detection_streams, template_cat,
                        detection_cat, corr_dict, filt_params,
                        phases=('P', 'S'), cores=4, debug=0, save=False,
@@ -387,8 +609,8 @@ def make_corr_matrices(template_streams, detection_streams, template_cat,
     :param debug: Debugging level for print output
     :type save: bool or str
     :param save: If a directory is provided, will save the relative polarity
-        array to a pickle object called 'rel_pols.pkl' for later, repeated use
-        by svd_matrix()
+        matrices there with write_rel_pols for later, repeated use by
+        svd_matrix()
     :return:
     """
     # Get unique sta.chan combos
@@ -431,66 +653,377 @@ def make_corr_matrices(template_streams, detection_streams, template_cat,
     if cores > 1:
         print('Starting up pool')
         rel_pols = []
-        pool = Pool(processes=cores)
-        results = [pool.apply_async(
-            _stachan_loop,
-            (phase, stachan,
-             temp_traces[phase][stachan],
-             det_traces[phase][stachan]),
-             {'min_cc': corr_dict[phase]['min_cc'],
-              'debug': debug,
-              'plotdir': plotdir})
-            for phase in phases
-            for stachan in ph_stachans[phase]]
-        pool.close()
-        print('Retrieving results')
-        rel_pols.extend([p.get() for p in results])
-        pool.join()
+        # Share the trace matrices once instead of pickling them per task
+        bank = TraceBank(temp_traces, det_traces)
+        pool = Pool(processes=cores, initializer=_attach_bank,
+                    initargs=(bank,))
+        try:
+            results = [pool.apply_async(
+                _bank_stachan_loop,
+                (phase, stachan),
+                {'min_cc': corr_dict[phase]['min_cc'],
+                 'debug': debug,
+                 'plotdir': plotdir})
+                for phase in phases
+                for stachan in ph_stachans[phase]]
+            pool.close()
+            print('Retrieving results')
+            rel_pols.extend([p.get() for p in results])
+            pool.join()
+        finally:
+            pool.terminate()
+            bank.close()
     else:
-        # Python loop..?
         rel_pols = []
         for phase in phases:
             for stachan in ph_stachans[phase]:
-                print('Looping stachan: {}'.format(stachan))
-                pol_array = np.zeros((len(detection_streams),
-                                      len(template_streams)))
-                for m in range(len(template_streams)):
-                    for n in range(len(detection_streams)):
-                        pol = _rel_polarity(temp_traces[phase][stachan][m],
-                                            det_traces[phase][stachan][n],
-                                            corr_dict[phase]['min_cc'], m, n,
-                                            stachan, phase, plotdir, debug)
-                        pol_array[n][m] = pol
-                rel_pols.append((phase, stachan, pol_array))
+                rel_pols.append(_stachan_loop(
+                    phase, stachan, temp_traces[phase][stachan],
+                    det_traces[phase][stachan], corr_dict[phase]['min_cc'],
+                    plotdir, debug))
     if save:
-        with open('{}/rel_pols.pkl'.format(save), 'wb') as f:
-            pickle.dump(rel_pols, f)
+        write_rel_pols(rel_pols, save, template_cat, detection_cat)
     return rel_pols
 
 
-def svd_matrix(rel_pols):
+REL_POLS_INDEX = 'rel_pols.json'
+
+
+def _event_ids(catalog):
+    return [str(ev.resource_id) for ev in catalog] if catalog else None
+
+
+def write_rel_pols(rel_pols, out_dir, template_cat=None, detection_cat=None):
+    """
+    Save relative polarity matrices as one .npy file per phase/stachan
+
+    An index (rel_pols.json) holds the phase, stachan, file, shape and dtype
+    of each matrix plus the event ids of the rows (detections) and columns
+    (templates), so single stachans can be read back, memory-mapped,
+    without loading the rest.
+
+    :param rel_pols: Output of make_corr_matrices
+    :param out_dir: Directory to write to
+    :type template_cat: obspy.core.event.Catalog
+    :param template_cat: Catalog the matrix columns correspond to
+    :type detection_cat: obspy.core.event.Catalog
+    :param detection_cat: Catalog the matrix rows correspond to
+    :return: Path to the index file
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    index = {'templates': _event_ids(template_cat),
+             'detections': _event_ids(detection_cat), 'matrices': []}
+    for rel_pol in rel_pols:
+        pol_array = _pol_matrix(rel_pol)
+        filename = 'rel_pols_{}_{}.npy'.format(rel_pol[0], rel_pol[1])
+        np.save(os.path.join(out_dir, filename), pol_array)
+        index['matrices'].append({'phase': rel_pol[0],
+                                  'stachan': rel_pol[1], 'file': filename,
+                                  'shape': list(pol_array.shape),
+                                  'dtype': str(pol_array.dtype)})
+    # Index goes last so a half-written directory isn't read as complete
+    index_file = os.path.join(out_dir, REL_POLS_INDEX)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(index_file + '.tmp', index_file)
+    return index_file
+
+
+def read_rel_pols_index(in_dir):
+    """
+    Read the index written by write_rel_pols
+
+    :param in_dir: Directory the matrices were saved to
+    :return: Dict with keys 'templates', 'detections' (lists of event ids,
+        or None) and 'matrices' (list of dicts of phase, stachan, file,
+        shape and dtype)
+    """
+    with open(os.path.join(in_dir, REL_POLS_INDEX), 'r') as f:
+        return json.load(f)
+
+
+def read_rel_pols(in_dir, stachans=None, phases=None, mmap=True):
+    """
+    Read relative polarity matrices saved by write_rel_pols
+
+    Directories holding only an old rel_pols.pkl are read in full.
+
+    :param in_dir: Directory the matrices were saved to
+    :type stachans: list
+    :param stachans: Only read these 'STA.CHAN' strings
+    :type phases: list
+    :param phases: Only read these phases
+    :param mmap: Memory-map the matrices (read-only) rather than reading them
+    :return: List of (phase, stachan, ndarray) as from make_corr_matrices
+    """
+    if not os.path.isfile(os.path.join(in_dir, REL_POLS_INDEX)):
+        with open(os.path.join(in_dir, 'rel_pols.pkl'), 'rb') as f:
+            rel_pols = pickle.load(f)
+        return [rel_pol for rel_pol in rel_pols
+                if (not stachans or rel_pol[1] in stachans) and
+                (not phases or rel_pol[0] in phases)]
+    rel_pols = []
+    for entry in read_rel_pols_index(in_dir)['matrices']:
+        if (stachans and entry['stachan'] not in stachans) or \
+                (phases and entry['phase'] not in phases):
+            continue
+        pol_array = np.load(os.path.join(in_dir, entry['file']),
+                            mmap_mode='r' if mmap else None)
+        if list(pol_array.shape) != entry['shape']:
+            raise IOError('{} is {}, index says {}'.format(
+                entry['file'], pol_array.shape, entry['shape']))
+        rel_pols.append((entry['phase'], entry['stachan'], pol_array))
+    return rel_pols
+
+
+def update_corr_matrices(rel_pols, template_streams, detection_streams,
+                         template_cat, detection_cat, corr_dict, filt_params,
+                         new_temps=0, new_dets=0, phases=('P', 'S'), cores=4,
+                         debug=0, save=False, plotdir='.'):
+    """
+    Add new detections (rows) and/or templates (columns) to saved relative
+    polarity matrices without recomputing the pairs already done
+
+    The new templates/detections must be the last new_temps/new_dets
+    entries of the stream lists and catalogs, which otherwise are the ones
+    rel_pols was made from. Only the new detections against all templates
+    and the new templates against the old detections are correlated.
+
+    :type rel_pols: list or str
+    :param rel_pols: Output of make_corr_matrices, or the directory it was
+        saved to
+    :type new_temps: int
+    :param new_temps: Number of templates added to the end of the lists
+    :type new_dets: int
+    :param new_dets: Number of detections added to the end of the lists
+    :type save: bool or str
+    :param save: Directory to save the updated matrices to (write_rel_pols)
+
+    See make_corr_matrices for the other parameters
+    :return: Updated rel_pols list
+    """
+    if isinstance(rel_pols, str):
+        rel_pols = read_rel_pols(rel_pols)
+    n_temps = len(template_streams)
+    n_dets = len(detection_streams)
+    old_temps = n_temps - new_temps
+    old_dets = n_dets - new_dets
+    old = OrderedDict(((rel_pol[0], rel_pol[1]), _pol_matrix(rel_pol))
+                      for rel_pol in rel_pols)
+    new_rows = {}
+    new_cols = {}
+    if new_dets > 0:
+        print('Correlating {} new detections'.format(new_dets))
+        for phase, stachan, pol_array in make_corr_matrices(
+                template_streams, detection_streams[old_dets:],
+                template_cat, detection_cat[old_dets:], corr_dict,
+                filt_params, phases=phases, cores=cores, debug=debug,
+                plotdir=plotdir):
+            new_rows[(phase, stachan)] = pol_array
+    if new_temps > 0 and old_dets > 0:
+        print('Correlating {} new templates'.format(new_temps))
+        for phase, stachan, pol_array in make_corr_matrices(
+                template_streams[old_temps:], detection_streams[:old_dets],
+                template_cat[old_temps:],
+                detection_cat[:old_dets], corr_dict, filt_params,
+                phases=phases, cores=cores, debug=debug, plotdir=plotdir):
+            new_cols[(phase, stachan)] = pol_array
+    keys = list(old.keys()) + [key for key in list(new_rows.keys()) +
+                               list(new_cols.keys()) if key not in old]
+    updated = []
+    for key in OrderedDict.fromkeys(keys):
+        # Stachans missing from any part (no picks) are zero there
+        top = np.column_stack((
+            old.get(key, np.zeros((old_dets, old_temps))),
+            new_cols.get(key, np.zeros((old_dets, new_temps)))))
+        bottom = new_rows.get(key, np.zeros((new_dets, n_temps)))
+        updated.append((key[0], key[1], np.row_stack((top, bottom))))
+    if save:
+        write_rel_pols(updated, save, template_cat, detection_cat)
+    return updated
+
+
+def _svd_append(u, s, vt, cols, rank):
+    """
+    Update a truncated SVD when columns are appended to the matrix
+
+    Brand (2006) style update: the new columns are split into the part in
+    the span of u and the orthogonal remainder, so only a small
+    (rank + n_cols) square matrix has to be decomposed.
+
+    :param u: Left singular vectors (m, k)
+    :param s: Singular values (k,)
+    :param vt: Right singular vectors (k, n)
+    :param cols: New columns (m, c)
+    :param rank: Number of singular triplets to keep
+    :return: u, s, vt of the (m, n + c) matrix
+    """
+    k = len(s)
+    n_new = cols.shape[1]
+    proj = np.dot(u.T, cols)
+    resid = cols - np.dot(u, proj)
+    q, r = np.linalg.qr(resid)
+    middle = np.zeros((k + q.shape[1], k + n_new))
+    middle[:k, :k] = np.diag(s)
+    middle[:k, k:] = proj
+    middle[k:, k:] = r
+    u_m, s_m, vt_m = np.linalg.svd(middle, full_matrices=False)
+    u_new = np.dot(np.column_stack((u, q)), u_m)
+    v_big = np.zeros((vt.shape[1] + n_new, k + n_new))
+    v_big[:vt.shape[1], :k] = vt.T
+    v_big[vt.shape[1]:, k:] = np.eye(n_new)
+    vt_new = np.dot(v_big, vt_m.T).T
+    return u_new[:, :rank], s_m[:rank], vt_new[:rank]
+
+
+def _svd_update(pol_array, state, rank):
+    """
+    Truncated SVD of pol_array, updated from the SVD of its top-left block
+    (state) when it has only grown by rows and/or columns
+
+    :return: (u, s, vt)
+    """
+    n_rows, n_cols = pol_array.shape
+    u, s, vt = state
+    old_rows, old_cols = u.shape[0], vt.shape[1]
+    if n_cols > old_cols:
+        u, s, vt = _svd_append(u, s, vt, pol_array[:old_rows, old_cols:],
+                               rank)
+    if n_rows > old_rows:
+        # Appending rows is appending columns to the transpose
+        vt_t, s, u_t = _svd_append(vt.T, s, u.T,
+                                   pol_array[old_rows:, :].T, rank)
+        u, vt = u_t.T, vt_t.T
+    return u, s, vt
+
+
+def _truncated_svd(pol_array, rank, n_iter=4, oversample=10):
+    """
+    Leading singular triplets by randomized subspace iteration
+
+    Only the (n x rank) and (rank x m) factors are ever formed, rather than
+    the full n x n U of np.linalg.svd(full_matrices=True).
+
+    :param pol_array: 2D array
+    :param rank: Number of singular triplets to return
+    :param n_iter: Power iterations, sharpening the leading subspace
+    :param oversample: Extra random vectors beyond rank
+    :return: (u, s, vt)
+    """
+    n_rows, n_cols = pol_array.shape
+    k = min(rank + oversample, n_rows, n_cols)
+    # Fixed seed so repeated runs give the same signs
+    omega = np.random.RandomState(42).normal(size=(n_cols, k))
+    q, _ = np.linalg.qr(np.dot(pol_array, omega))
+    for i in range(n_iter):
+        q, _ = np.linalg.qr(np.dot(pol_array.T, q))
+        q, _ = np.linalg.qr(np.dot(pol_array, q))
+    ub, s, vt = np.linalg.svd(np.dot(q.T, pol_array), full_matrices=False)
+    return np.dot(q, ub)[:, :rank], s[:rank], vt[:rank]
+
+
+def _pol_matrix(rel_pol, shape=None):
+    """
+    Return the relative polarity matrix of a rel_pols entry as a 2D array
+
+    Matrices read back as flat buffers (e.g. from marshal) are reshaped to
+    the shape stored as a fourth element of the entry, or to shape.
+    """
+    pol_array = rel_pol[2]
+    if isinstance(pol_array, np.ndarray) and pol_array.ndim == 2:
+        return pol_array
+    if len(rel_pol) > 3:
+        shape = rel_pol[3]
+    if shape is None:
+        raise ValueError('No shape stored for flat matrix of {} {}'.format(
+            rel_pol[0], rel_pol[1]))
+    return np.frombuffer(pol_array).reshape(shape)
+
+
+def _block_checksum(pol_array, shape):
+    """Checksum of the top-left block of pol_array of the given shape"""
+    block = np.ascontiguousarray(pol_array[:shape[0], :shape[1]],
+                                 dtype=np.float64)
+    return hashlib.sha1(block.tobytes()).hexdigest()
+
+
+def _stachan_svd(args):
+    """
+    Leading left singular vector (and svd state) of one stachan matrix
+
+    The state is (u, s, vt, fingerprint), fingerprint being a dict of the
+    shape and checksum of the matrix the state is for and how many updates
+    it has had since it was last decomposed from scratch. The state is only
+    updated from if its matrix is still the top-left block of pol_array
+    (e.g. rel_pols weren't recomputed with a different min_cc), and not
+    after refresh_every updates, so truncation error can't pile up.
+    """
+    pol_array, state, rank, refresh_every = args
+    fingerprint = state[3] if state is not None and len(state) > 3 else None
+    if fingerprint is not None \
+            and fingerprint['updates'] < refresh_every \
+            and fingerprint['shape'][0] <= pol_array.shape[0] \
+            and fingerprint['shape'][1] <= pol_array.shape[1] \
+            and _block_checksum(pol_array, fingerprint['shape']) == \
+            fingerprint['checksum']:
+        u, s, v = _svd_update(pol_array, state[:3], rank)
+        updates = fingerprint['updates'] + 1
+    else:
+        u, s, v = _truncated_svd(pol_array, rank)
+        updates = 0
+    fingerprint = {'shape': pol_array.shape, 'updates': updates,
+                   'checksum': _block_checksum(pol_array, pol_array.shape)}
+    return u[:, 0], (u, s, v, fingerprint)
+
+
+def svd_matrix(rel_pols, svd_state=None, rank=5, shape=None, cores=1,
+               refresh_every=12):
     """
     Make the matrix of left singular vectors from all sta/chan/phase combos
     :param rel_pols: Output from make_corr_matrices
-    :return:
+    :param svd_state: Optional dict of {(phase, stachan): state}
+        truncated SVDs from a previous call. Matrices which have only grown
+        (e.g. by update_corr_matrices) since are updated from these rather
+        than decomposed from scratch. Matrices which have changed in any
+        other way are decomposed from scratch. The dict is updated in
+        place, so keep it (pickle it beside the saved rel_pols) for the
+        next update
+    :param rank: Number of singular triplets kept in svd_state
+    :param shape: (n_detections, n_templates) of matrices stored as flat
+        buffers without their own shape (see _pol_matrix)
+    :param cores: Number of processes to decompose stachans with
+    :param refresh_every: Decompose from scratch after this many updates
+        in a row. 0 forces a full refresh now
+    :return: (n_detections x n_stachans array, list of (phase, stachan))
     """
-    stachans = []
-    for i, rel_pol in enumerate(rel_pols):
+    stachans = [(rel_pol[0], rel_pol[1]) for rel_pol in rel_pols]
+    if svd_state is None:
+        states = [None] * len(rel_pols)
+    else:
+        states = [svd_state.get(key) for key in stachans]
+    args = [(_pol_matrix(rel_pol, shape), state, rank, refresh_every)
+            for rel_pol, state in zip(rel_pols, states)]
+    svd_mat = np.empty((args[0][0].shape[0], len(args)))
+    if cores > 1:
+        pool = Pool(processes=cores)
         try:
-            u, s, v = np.linalg.svd(rel_pol[2], full_matrices=True)
-        # If rel_pols read back in from marshal binary, array is a buffer
-        # Reshape it to size of detection_streams x template_streams
-        # For Rotokawa case: 3114 template streams
-        except LinAlgError:
-            u, s, v = np.linalg.svd(np.frombuffer(rel_pol[2]).reshape(-1, 3114),
-                                    full_matrices=True)
-        lsv = u[:, 0] # First left sigular vector
-        if i == 0:
-            stachans.append((rel_pol[0], rel_pol[1]))
-            svd_mat = lsv[~np.isnan(lsv)]
-        else:
-            stachans.append((rel_pol[0], rel_pol[1]))
-            svd_mat = np.column_stack((svd_mat, lsv[~np.isnan(lsv)]))
+            results = pool.imap(_stachan_svd, args)
+            for i, (lsv, state) in enumerate(results):
+                svd_mat[:, i] = lsv
+                if svd_state is not None:
+                    svd_state[stachans[i]] = state
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i, arg in enumerate(args):
+            lsv, state = _stachan_svd(arg)
+            svd_mat[:, i] = lsv
+            if svd_state is not None:
+                svd_state[stachans[i]] = state
+    # Drop detections with nan in any singular vector
+    svd_mat = svd_mat[~np.isnan(svd_mat).any(axis=1)]
     return svd_mat, stachans
 
 
@@ -1361,6 +1894,83 @@ class TestRelPols(unittest.TestCase):
             det_traces[i][10:] *= rand_pols_dets[1, i]
         return temp_traces, det_traces
 
+    def test_batch_rel_pols(self):
+        # Batched relative polarities should match the pair by pair ones
+        temp_traces, det_traces = self.generate_data()
+        # Templates start just before the P arrival at sample 11
+        temps = np.array([tr[8:38] for tr in temp_traces])
+        dets = np.array([tr[0:50] for tr in det_traces])
+        temps[2] = 0.
+        scalar = np.array([[_rel_polarity(temps[m], dets[n], 0.3, m, n,
+                                          'STA.EHZ', 'P', '.')
+                            for m in range(len(temps))]
+                           for n in range(len(dets))])
+        batch = _batch_rel_polarity(temps, dets, 0.3, chunk_size=3)
+        self.assertEqual(batch.shape, scalar.shape)
+        self.assertTrue(np.any(scalar != 0))
+        self.assertTrue(np.allclose(batch, scalar, atol=1e-4))
+
+    def test_svd_update(self):
+        # Leading left singular vector updated for added rows and columns
+        # should match a full svd of the grown matrix
+        pols = np.outer(np.random.choice((-1, 1), 60),
+                        np.random.choice((-1, 1), 40))
+        rel_pol = pols * np.random.uniform(0.2, 1., pols.shape) + \
+            np.random.normal(0, 0.05, pols.shape)
+        svd_state = {}
+        svd_matrix([('P', 'STA.EHZ', rel_pol[:45, :30])], svd_state)
+        svd_mat, stachans = svd_matrix([('P', 'STA.EHZ', rel_pol)],
+                                       svd_state)
+        u, s, v = np.linalg.svd(rel_pol)
+        self.assertEqual(svd_state[('P', 'STA.EHZ')][0].shape[0], 60)
+        self.assertAlmostEqual(np.abs(np.dot(svd_mat[:, 0], u[:, 0])), 1.,
+                               places=4)
+        self.assertEqual(svd_state[('P', 'STA.EHZ')][3]['updates'], 1)
+        # A changed matrix of the same shape isn't updated from the state
+        changed = rel_pol.copy()
+        changed[:45, :30] *= -1
+        svd_mat, stachans = svd_matrix([('P', 'STA.EHZ', changed)],
+                                       svd_state)
+        self.assertEqual(svd_state[('P', 'STA.EHZ')][3]['updates'], 0)
+        u, s, v = np.linalg.svd(changed)
+        self.assertAlmostEqual(np.abs(np.dot(svd_mat[:, 0], u[:, 0])), 1.,
+                               places=4)
+        # Nor after refresh_every updates
+        svd_matrix([('P', 'STA.EHZ', changed)], svd_state, refresh_every=0)
+        self.assertEqual(svd_state[('P', 'STA.EHZ')][3]['updates'], 0)
+
+    def test_truncated_svd(self):
+        # Leading singular vector matches np.linalg.svd up to sign
+        rel_pol = np.random.uniform(-1, 1, (80, 50))
+        rel_pol[:, 0:10] += np.outer(np.random.choice((-1, 1), 80),
+                                     np.ones(10))
+        svd_mat, stachans = svd_matrix(
+            [('P', 'STA.EHZ', rel_pol), ('S', 'STA.EHN', -rel_pol)])
+        u, s, v = np.linalg.svd(rel_pol)
+        self.assertEqual(svd_mat.shape, (80, 2))
+        self.assertAlmostEqual(np.abs(np.dot(svd_mat[:, 1], u[:, 0])), 1.,
+                               places=6)
+        # Flat buffers are reshaped from the stored shape
+        flat_mat, stachans = svd_matrix(
+            [('P', 'STA.EHZ', rel_pol.tobytes(), rel_pol.shape)])
+        self.assertTrue(np.allclose(flat_mat[:, 0], svd_mat[:, 0]))
+
+    def test_rel_pols_io(self):
+        # Matrices round trip through write/read_rel_pols, one at a time
+        import tempfile
+        import shutil
+        rel_pols = [('P', 'STA.EHZ', np.random.uniform(-1, 1, (20, 10))),
+                    ('S', 'STA.EHN', np.random.uniform(-1, 1, (20, 10)))]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            write_rel_pols(rel_pols, tmp_dir)
+            read_back = read_rel_pols(tmp_dir, stachans=['STA.EHN'])
+            self.assertEqual(len(read_back), 1)
+            self.assertEqual(read_back[0][:2], ('S', 'STA.EHN'))
+            self.assertTrue(np.array_equal(read_back[0][2], rel_pols[1][2]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_rel_pol(self):
         trace_1 = seis_sim(sp=10, amp_ratio=1.2)
         trace_2 = trace_1 * -1.
@@ -6,7 +6,6 @@ for magnitudes and focal mechanisms
 
 import csv
 import copy
-import scipy
 import numpy as np
 
 from glob import glob
@@ -16,6 +15,7 @@ from eqcorrscan.utils import stacking
 from eqcorrscan.utils.mag_calc import svd_moments
 from eqcorrscan.utils.pre_processing import shortproc
 from eqcorrscan.utils.clustering import cross_chan_coherence, svd
+from magnitudes import family_relative_amps
 
 
 def local_to_moment(mag, m=0.88, c=0.73):
@@ -243,34 +243,8 @@ def party_relative_mags(party, self_files, shift_len, align_len, svd_len,
                 continue
         elif method == 'PCA':
             print('Using principal component method')
-            # Now loop over all detections and do svd for each matching
-            # chan with temp
-            events_out = []
-            template = svd_streams[0]
-            M = []
-            for i, st in enumerate(svd_streams):
-                if len(st) == 0:
-                    print('Event not located, skipping')
-                    continue
-                ev_r_amps = []
-                # For each pair of template:detection (including temp:temp)
-                for tr in template:
-                    if len(st.select(station=tr.stats.station,
-                                     channel=tr.stats.channel)) > 0:
-                        det_tr = st.select(station=tr.stats.station,
-                                           channel=tr.stats.channel)[0]
-                        # Convoluted way of getting two 'vert' vectors
-                        data_mat = np.vstack((tr.data, det_tr.data)).T
-                        U, sig, Vt = scipy.linalg.svd(data_mat,
-                                                      full_matrices=True)
-                        # Vt is 2x2 for two events
-                        # Per Shelly et al., 2016 eq. 4
-                        ev_r_amps.append(Vt[0][1] / Vt[0][0])
-                if len(ev_r_amps) < min_amps:
-                    print('Fewer than 4 amplitude picks, skipping.')
-                    continue
-                M.append(np.median(ev_r_amps))
-                events_out.append(i)
+            # All template:detection pairs (including temp:temp) at once
+            M, events_out = family_relative_amps(svd_streams, min_amps)
         # If we have a Mag for template, calibrate moments
         if calibrate and len(fam.template.event.magnitudes) > 0:
             # Convert the template magnitude to seismic moment
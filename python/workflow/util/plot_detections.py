@@ -23,6 +23,7 @@ from eqcorrscan.utils import plotting, pre_processing
 from eqcorrscan.utils.mag_calc import dist_calc
 from eqcorrscan.utils.plotting import detection_multiplot
 from eqcorrscan.core.match_filter import Detection, Family, Party, Template
+from waveform_index import grab_day_wavs
 # Import local stress functions
 try:
     from plot_stresses import parse_arnold_params, parse_arnold_grid
@@ -39,61 +40,6 @@ def date_generator(start_date, end_date):
     for n in range(int ((end_date - start_date).days)):
         yield start_date + timedelta(n)
 
-def grab_day_wavs(wav_dirs, dto, stachans):
-    # Helper to recursively crawl paths searching for waveforms from a dict of
-    # stachans for one day
-    import os
-    import fnmatch
-    from itertools import chain
-    from obspy import read, Stream
-
-    st = Stream()
-    wav_files = []
-    for path, dirs, files in chain.from_iterable(os.walk(path)
-                                                 for path in wav_dirs):
-        print('Looking in %s' % path)
-        for sta, chans in iter(stachans.items()):
-            for chan in chans:
-                for filename in fnmatch.filter(files,
-                                               '*.%s.*.%s*%d.%03d'
-                                                       % (
-                                               sta, chan, dto.year,
-                                               dto.julday)):
-                    wav_files.append(os.path.join(path, filename))
-    print('Reading into memory')
-    for wav in wav_files:
-        st += read(wav)
-    stachans = [(tr.stats.station, tr.stats.channel) for tr in st]
-    for stachan in list(set(stachans)):
-        tmp_st = st.select(station=stachan[0], channel=stachan[1])
-        if len(tmp_st) > 1 and len(set([tr.stats.sampling_rate
-                                        for tr in tmp_st])) > 1:
-            print('Traces from %s.%s have differing samp rates'
-                  % (stachan[0], stachan[1]))
-            for tr in tmp_st:
-                st.remove(tr)
-            tmp_st.resample(sampling_rate=100.)
-            st += tmp_st
-    st.merge(fill_value='interpolate')
-    print('Checking for trace length. Removing if too short')
-    rm_trs = []
-    for tr in st:
-        if len(tr.data) < (86400 * tr.stats.sampling_rate * 0.8):
-            rm_trs.append(tr)
-        if tr.stats.starttime != dto:
-            print('Trimming trace %s.%s with starttime %s to %s'
-                  % (tr.stats.station, tr.stats.channel,
-                     str(tr.stats.starttime), str(dto)))
-            tr.trim(starttime=dto, endtime=dto + 86400,
-                    nearest_sample=False)
-    if len(rm_trs) != 0:
-        print('Removing traces shorter than 0.8 * daylong')
-        for tr in rm_trs:
-            st.remove(tr)
-    else:
-        print('All traces long enough to proceed to dayproc')
-    return st
-
 def qgis2temp_list(filename):
     # Read Rot, Nga_N and Nga_S temps from files to temp lists
     with open(filename, 'rb') as f:
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""
+Subspace detection statistic computed in the frequency domain
+
+For a detector with orthonormal basis U (ulen x dimension) the statistic at
+sample i is ||U.T x||^2 / ||x||^2 for the data window x = data[i:i + ulen],
+as in det_statistic in python/testing/subspace_internal.py. Here all basis
+vectors are correlated with the data in one batch of FFTs (overlap-save, so
+a day of data is done in fixed-size segments) and the window energies come
+from a cumulative sum rather than a dot product per sample.
+"""
+from __future__ import division
+
+import numpy as np
+
+
+def _window_energy(data, ulen):
+    # Sum of squares of every window of ulen samples, from one cumsum
+    cumsum = np.concatenate(([0.], np.cumsum(np.square(data))))
+    return cumsum[ulen:] - cumsum[:-ulen]
+
+
+def subspace_statistic(basis, data, inc=1, seg_len=2 ** 16):
+    """
+    Subspace detection statistic of one basis against one data vector
+
+    :type basis: numpy.ndarray
+    :param basis: (ulen, dimension) array with the basis vectors as columns,
+        as in Detector.data
+    :type data: numpy.ndarray
+    :param data: 1D data, multiplexed if the basis is
+    :type inc: int
+    :param inc: Step between windows, the number of channels for
+        multiplexed data
+    :type seg_len: int
+    :param seg_len: Number of windows correlated per FFT segment. Bounds
+        memory at about dimension * (seg_len + ulen) values
+    :return: float32 numpy.ndarray of the statistic at every inc'th window
+    """
+    basis = np.asarray(basis, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    if basis.ndim == 1:
+        basis = basis[:, np.newaxis]
+    ulen = basis.shape[0]
+    n_windows = len(data) - ulen + 1
+    if n_windows < 1:
+        raise ValueError('Data are shorter than the detector')
+    nfft = int(2 ** np.ceil(np.log2(min(seg_len, n_windows) + ulen - 1)))
+    seg_len = nfft - ulen + 1
+    basis_fft = np.conj(np.fft.rfft(basis.T, nfft))
+    projection = np.empty(n_windows)
+    for start in range(0, n_windows, seg_len):
+        n_seg = min(seg_len, n_windows - start)
+        seg = np.fft.rfft(data[start:start + n_seg + ulen - 1], nfft)
+        # Row k, sample i holds sum_t basis[t, k] * data[start + i + t]
+        cross = np.fft.irfft(seg[np.newaxis, :] * basis_fft, nfft)
+        projection[start:start + n_seg] = np.sum(
+            np.square(cross[:, 0:n_seg]), axis=0)
+    energy = _window_energy(data, ulen)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = np.where(energy > 0, projection / energy, 0.)
+    return stats[::inc].astype(np.float32)
+
+
+def multiplex(traces):
+    """
+    Interleave equal-length arrays sample by sample (ch0, ch1, ..., ch0, ...)
+
+    :type traces: list
+    :param traces: List of 1D numpy.ndarray, one per channel
+    :return: 1D numpy.ndarray
+    """
+    npts = min([len(tr) for tr in traces])
+    return np.vstack([tr[0:npts] for tr in traces]).T.ravel()
+
+
+def detector_statistic(detector, stream, seg_len=2 ** 16):
+    """
+    Subspace statistic of an eqcorrscan Detector over a Stream
+
+    Multiplexed detectors are run on the stachans of detector.stachans
+    interleaved in that order, one statistic per multiplexed sample set.
+    Otherwise each stachan's basis is run on its own trace and the
+    statistics averaged over the stachans found in the stream.
+
+    :type detector: eqcorrscan.core.subspace.Detector
+    :param detector: Detector with data (basis) set, e.g. from
+        subspace_util.Tribe_2_Detector
+    :type stream: obspy.core.stream.Stream
+    :param stream: Processed data, at the detector sampling rate
+    :type seg_len: int
+    :param seg_len: See subspace_statistic
+    :return: float32 numpy.ndarray of the statistic
+    """
+    traces = []
+    for stachan in detector.stachans:
+        st = stream.select(station=stachan[0], channel=stachan[1])
+        traces.append(st[0].data if len(st) > 0 else None)
+    if detector.multiplex:
+        if any([tr is None for tr in traces]):
+            raise IndexError('Multiplexed detector needs every stachan, '
+                             'missing %s' % str(
+                                 [stachan for stachan, tr in
+                                  zip(detector.stachans, traces)
+                                  if tr is None]))
+        return subspace_statistic(detector.data[0], multiplex(traces),
+                                  inc=len(traces), seg_len=seg_len)
+    stats = [subspace_statistic(basis, tr, seg_len=seg_len)
+             for basis, tr in zip(detector.data, traces) if tr is not None]
+    if len(stats) == 0:
+        raise IndexError('No detector stachans in stream')
+    n_stats = min([len(stat) for stat in stats])
+    return np.mean([stat[0:n_stats] for stat in stats], axis=0)
@@ -4,6 +4,8 @@ Helper functions for subspace detectors
 """
 import os
 import copy
+import json
+import hashlib
 import fnmatch
 import warnings
 import numpy as np
@@ -16,17 +18,23 @@ except:
 
 from glob import glob
 from itertools import chain
-from obspy import Stream, read, UTCDateTime, Catalog
+from obspy import Stream, Trace, read, UTCDateTime, Catalog
 import datetime
 from datetime import timedelta
 from eqcorrscan.core.match_filter import Tribe, Template
 from eqcorrscan.utils import stacking, clustering
 from eqcorrscan.utils.pre_processing import shortproc
 from eqcorrscan.utils.stacking import align_traces, linstack, PWS_stack
+try:
+    from eqcorrscan.utils.stacking import stack_chunks
+except ImportError:
+    # Chunked stacking is only in the EQcorrscan copy in python/testing
+    stack_chunks = None
 from eqcorrscan.core.subspace import Detector, align_design
-from obspy.signal.trigger import classic_sta_lta
 from scipy.spatial.distance import squareform
+from scipy.sparse import issparse
 from scipy.cluster.hierarchy import linkage, dendrogram, fcluster
+from waveform_index import grab_day_wavs, default_index_file
 
 
 def date_generator(start_date, end_date):
@@ -34,46 +42,6 @@ def date_generator(start_date, end_date):
     for n in range(int((end_date - start_date).days) + 1):
         yield start_date + timedelta(n)
 
-def grab_day_wavs(wav_dirs, dto, stachans):
-    # Helper to recursively crawl paths searching for waveforms for a dict of
-    # stachans for one day
-
-    st = Stream()
-    wav_files = []
-    for path, dirs, files in chain.from_iterable(os.walk(path)
-                                                 for path in wav_dirs):
-        print('Looking in %s' % path)
-        for sta, chans in iter(stachans.items()):
-            for chan in chans:
-                for filename in fnmatch.filter(files,
-                                               '*.%s.*.%s*%d.%03d'
-                                                       % (
-                                               sta, chan, dto.year,
-                                               dto.julday)):
-                    wav_files.append(os.path.join(path, filename))
-    print('Reading into memory')
-    for wav in wav_files:
-        st += read(wav)
-    st.merge(fill_value='interpolate')
-    print('Checking for trace length. Removing if too short')
-    rm_trs = []
-    for tr in st:
-        if len(tr.data) < (86400 * tr.stats.sampling_rate * 0.8):
-            rm_trs.append(tr)
-        if tr.stats.starttime != dto:
-            print('Trimming trace %s.%s with starttime %s to %s'
-                  % (tr.stats.station, tr.stats.channel,
-                     str(tr.stats.starttime), str(dto)))
-            tr.trim(starttime=dto, endtime=dto + 86400,
-                    nearest_sample=False)
-    if len(rm_trs) != 0:
-        print('Removing traces shorter than 0.8 * daylong')
-        for tr in rm_trs:
-            st.remove(tr)
-    else:
-        print('All traces long enough to proceed to dayproc')
-    return st.sort(['starttime'])
-
 def cluster_from_dist_mat(dist_mat, temp_list, corr_thresh,
                           show=False, debug=1, method='single'):
     """
@@ -86,23 +54,33 @@ def cluster_from_dist_mat(dist_mat, temp_list, corr_thresh,
         distance matrix
     :param corr_thresh: Correlation thresholds corresponding to the method
         used in the linkage algorithm
-    :param method: Method fed to scipy.heirarchy.linkage
+    :param method: Method fed to scipy.heirarchy.linkage. For a sparse
+        dist_mat only 'single', 'connected' (the same as 'single') and
+        'complete' are allowed
     :return: Groups of templates
+
+    .. Note: dist_mat may be a scipy.sparse matrix holding only well
+        correlated pairs (see dist_mat.sparse_distance_matrix), made with
+        corr_floor <= corr_thresh. No dendrogram is shown in this case
     """
-    dist_vec = squareform(dist_mat)
-    if debug >= 1:
-        print('Computing linkage')
-    Z = linkage(dist_vec, method=method)
-    if show:
+    if issparse(dist_mat):
+        indices = _sparse_cluster_indices(dist_mat, corr_thresh, method,
+                                          debug=debug)
+    else:
+        dist_vec = squareform(dist_mat)
         if debug >= 1:
-            print('Plotting the dendrogram')
-        dendrogram(Z, color_threshold=1 - corr_thresh,
-                   distance_sort='ascending')
-        plt.show()
-    # Get the indices of the groups
-    if debug >= 1:
-        print('Clustering')
-    indices = fcluster(Z, t=1 - corr_thresh, criterion='distance')
+            print('Computing linkage')
+        Z = linkage(dist_vec, method=method)
+        if show:
+            if debug >= 1:
+                print('Plotting the dendrogram')
+            dendrogram(Z, color_threshold=1 - corr_thresh,
+                       distance_sort='ascending')
+            plt.show()
+        # Get the indices of the groups
+        if debug >= 1:
+            print('Clustering')
+        indices = fcluster(Z, t=1 - corr_thresh, criterion='distance')
     # Indices start at 1...
     group_ids = list(set(indices))  # Unique list of group ids
     if debug >= 1:
@@ -130,6 +108,79 @@ def cluster_from_dist_mat(dist_mat, temp_list, corr_thresh,
     groups.append(group)
     return groups
 
+def _sparse_cluster_indices(dist_mat, corr_thresh, method, debug=1,
+                            max_component=10000):
+    """
+    fcluster-style group ids (from 1) from a sparse distance matrix
+
+    Single linkage cut at 1 - corr_thresh is exactly the connected
+    components of the graph of pairs closer than that, so it is done
+    straight from the graph. Complete linkage is run on each connected
+    component of the stored pairs on its own, with missing pairs as
+    distance 1. As long as the floor the matrix was made with is at or
+    below corr_thresh the missing pairs are above the cut either way, so
+    the groups match full-matrix complete linkage. Average, weighted,
+    centroid etc. linkage depend on the real values of the missing pairs
+    and can't be done from a sparse matrix.
+
+    Complete linkage still needs a condensed matrix per component, so
+    components larger than max_component raise rather than use
+    n * (n - 1) / 2 memory: raise corr_floor or use single linkage.
+
+    :param dist_mat: scipy.sparse distance matrix
+    :param corr_thresh: Correlation threshold for clustering
+    :param method: 'single', 'connected' or 'complete'
+    :param max_component: Largest connected component to run complete
+        linkage on
+    :return: ndarray of group ids
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    dist_mat = csr_matrix(dist_mat)
+    if method in ('single', 'connected'):
+        # Copy the index arrays, eliminate_zeros works in place
+        graph = csr_matrix((dist_mat.data <= 1 - corr_thresh,
+                            dist_mat.indices.copy(), dist_mat.indptr.copy()),
+                           shape=dist_mat.shape)
+        graph.eliminate_zeros()
+        n_groups, labels = connected_components(graph, directed=False)
+        if debug >= 1:
+            print('Found %d connected groups' % n_groups)
+        return labels + 1
+    if method != 'complete':
+        raise NotImplementedError('%s linkage needs the full distance '
+                                  'matrix, only single and complete linkage '
+                                  'can be done from a sparse one' % method)
+    n_comps, comps = connected_components(dist_mat, directed=False)
+    if debug >= 1:
+        print('Linking %d connected components' % n_comps)
+    indices = np.zeros(dist_mat.shape[0], dtype=int)
+    next_id = 1
+    for comp in range(n_comps):
+        members = np.nonzero(comps == comp)[0]
+        if len(members) == 1:
+            indices[members] = next_id
+            next_id += 1
+            continue
+        if len(members) > max_component:
+            raise MemoryError('Connected component of %d templates is '
+                              'larger than max_component (%d)' %
+                              (len(members), max_component))
+        sub = dist_mat[members][:, members].tocoo()
+        upper = sub.row < sub.col
+        row, col = sub.row[upper], sub.col[upper]
+        n = len(members)
+        # Condensed (upper triangle) index of each stored pair
+        condensed = np.ones(n * (n - 1) // 2)
+        condensed[n * row - row * (row + 1) // 2 + col - row - 1] = \
+            sub.data[upper]
+        Z = linkage(condensed, method=method)
+        sub_ids = fcluster(Z, t=1 - corr_thresh, criterion='distance')
+        indices[members] = sub_ids + next_id - 1
+        next_id += sub_ids.max()
+    return indices
+
 def heatmap_plot(dmat_file, big_tribe, raw_wav_dir, tick_int=20,
                  title=None, show=True):
     mat = 1.0 - np.load(dmat_file) # More intuitive to use CCC
@@ -305,9 +356,35 @@ def stack_plot(tribe, wav_dir_pat, station, channel, title, shift=True,
         plt.show()
     return
 
+def _family_z_streams(det_dirs, filt_params, prepick, postpick):
+    """
+    Generator of the processed, pick-trimmed Stream of each detection
+    directory, read one at a time
+    """
+    for s_dir in det_dirs:
+        raw = read('{}/*'.format(s_dir)).merge(fill_value='interpolate')
+        # Remove all traces without 3001 samples
+        for tr in raw.copy():
+            if len(tr.data) != 3001:
+                raw.remove(tr)
+        if filt_params and len(raw) > 0:
+            shortproc(raw, lowcut=filt_params['lowcut'],
+                      highcut=filt_params['highcut'],
+                      filt_order=filt_params['filt_order'],
+                      samp_rate=filt_params['samp_rate'])
+        z_stream = Stream()
+        for tr in raw:
+            if 'a' in tr.stats.sac:
+                strt = tr.stats.starttime
+                z_stream += tr.trim(
+                    starttime=strt + tr.stats.sac['a'] - prepick,
+                    endtime=strt + tr.stats.sac['a'] + postpick)
+        if len(z_stream) > 0:
+            yield z_stream
+
 def stack_party(party, sac_dir, method='linear', filt_params=None, align=True,
                 shift_len=0.1, prepick=2., postpick=5., reject=0.7,
-                normalize=False, plot=False, outdir=None):
+                normalize=False, plot=False, outdir=None, chunk_size=100):
     """
     Return a stream for the linear stack of the templates in a multiplet.
 
@@ -327,6 +404,10 @@ def stack_party(party, sac_dir, method='linear', filt_params=None, align=True,
     :param reject: Correlation coefficient cutoff in aligning
     :param normalize: Whether to normalize before stacking
     :param plot: Alignment plot flag
+    :param chunk_size: Detections read and added to the stack at a time
+        (see stacking.stack_chunks). Without align, and where the EQcorrscan
+        in use has stack_chunks, only this many are in memory at once (the
+        detections are read twice, once to pick the stack template)
     :return:
     """
 
@@ -336,47 +417,37 @@ def stack_party(party, sac_dir, method='linear', filt_params=None, align=True,
         fam_id = fam.template.event.resource_id
         print('For Family {}'.format(fam_id))
         eids = [str(ev.resource_id).split('/')[-1] for ev in fam.catalog]
-        raws = []
-        for s_dir in sac_dirs:
-            if s_dir.split('/')[-1] in eids:
-                raws.append(read('{}/*'.format(s_dir)).merge(
-                    fill_value='interpolate'))
-        # Stupid check for empty det directories. Not yet resolved
-        lens = [len(raw) for raw in raws]
-        if len(lens) == 0: continue
-        if max(lens) == 0: continue
-        print('Removing all traces without 3001 samples')
-        for st in raws:
-            for tr in st.copy():
-                if len(tr.data) != 3001:
-                    st.remove(tr)
-        if filt_params:
-            for raw in raws:
-                shortproc(raw, lowcut=filt_params['lowcut'],
-                          highcut=filt_params['highcut'],
-                          filt_order=filt_params['filt_order'],
-                          samp_rate=filt_params['samp_rate'])
-        print('Now trimming around pick times')
-        z_streams = []
-        for raw in raws:
-            z_stream = Stream()
-            for tr in raw.copy():
-                if 'a' in tr.stats.sac:
-                    strt = tr.stats.starttime
-                    z_stream += tr.trim(
-                        starttime=strt + tr.stats.sac['a'] - prepick,
-                        endtime=strt + tr.stats.sac['a'] + postpick)
-            if len(z_stream) > 0:
-                z_streams.append(z_stream)
-        # At the moment, the picks are based on P-arrival correlation already!
-        if align:
-            z_streams = align_design(z_streams, shift_len=shift_len,
-                                     reject=reject, multiplex=False,
-                                     no_missed=False, plot=plot)
-        if method == 'linear':
-            fam_stacks[fam_id] = linstack(z_streams, normalize=normalize)
-        elif method == 'PWS':
-            fam_stacks[fam_id] = PWS_stack(z_streams, normalize=normalize)
+        det_dirs = [s_dir for s_dir in sac_dirs
+                    if s_dir.split('/')[-1] in eids]
+        if align or stack_chunks is None:
+            # Alignment is done on all detections together, so here they
+            # are all held in memory
+            z_streams = list(_family_z_streams(det_dirs, filt_params,
+                                               prepick, postpick))
+            if align and len(z_streams) > 0:
+                z_streams = align_design(z_streams, shift_len=shift_len,
+                                         reject=reject, multiplex=False,
+                                         no_missed=False, plot=plot)
+            if len(z_streams) == 0:
+                continue
+            if method == 'linear':
+                fam_stacks[fam_id] = linstack(z_streams, normalize=normalize)
+            elif method == 'PWS':
+                fam_stacks[fam_id] = PWS_stack(z_streams, normalize=normalize)
+            continue
+        # First pass keeps only the processed detection with the most
+        # channels, the template linstack would use, then the second stacks
+        template = None
+        for z_stream in _family_z_streams(det_dirs, filt_params, prepick,
+                                          postpick):
+            if template is None or len(z_stream) > len(template):
+                template = z_stream
+        if template is None:
+            continue
+        fam_stacks[fam_id] = stack_chunks(
+            _family_z_streams(det_dirs, filt_params, prepick, postpick),
+            template, method=method, normalize=normalize,
+            chunk_size=chunk_size)
     if plot:
         # Plot up the stacks of the Families first
         for id, fam_stack in fam_stacks.items():
@@ -401,8 +472,10 @@ def cluster_cat(catalog, corr_thresh, corr_params=None, raw_wav_dir=None,
         lowcut, highcut, samp_rate, filt_order, pre_pick, length, shift_len,
         cores
     :param raw_wav_dir: Directory of waveforms to take from
-    :param dist_mat: If there's a precomputed distance matrix, use this
-        instead of doing all the correlations
+    :param dist_mat: If there's a precomputed distance matrix (dense or
+        scipy.sparse), use this instead of doing all the correlations. A
+        sparse matrix needs method 'single' or 'complete' (see
+        cluster_from_dist_mat)
     :param out_cat: Output catalog corresponding to the events
     :param show: Show the dendrogram? Careful as this can exceed max recursion
     :param wavs: Should we even bother with processing waveforms? Otherwise
@@ -477,7 +550,7 @@ def cluster_cat(catalog, corr_thresh, corr_params=None, raw_wav_dir=None,
     print(new_cat)
     new_cat.write(out_cat, format="QUAKEML")
     print('Clustering')
-    if isinstance(dist_mat, np.ndarray):
+    if isinstance(dist_mat, np.ndarray) or issparse(dist_mat):
         print('Assuming the tribe provided is the same shape as dist_mat')
         # Dummy streams
         temp_list = [(Stream(), ev) for ev in catalog]
@@ -576,7 +649,259 @@ def rewrite_subspace(detector, outfile):
     new_det.write(outfile)
     return
 
-def get_nullspace(wav_dirs, detector, start, end, n, sta, lta, limit):
+def _stalta_max(windows, sta_samps, lta_samps):
+    """
+    Maximum of the classic STA/LTA (as obspy's classic_sta_lta) of each row
+    of a 2D array of windows, all rows at once
+    """
+    energy = np.cumsum(np.square(windows, dtype=np.float64), axis=-1)
+    sta = energy.copy()
+    sta[:, sta_samps:] -= energy[:, :-sta_samps]
+    sta /= sta_samps
+    lta = energy
+    lta[:, lta_samps:] -= energy[:, :-lta_samps].copy()
+    lta /= lta_samps
+    sta[:, :lta_samps - 1] = 0
+    lta[lta < np.finfo(0.0).tiny] = np.finfo(0.0).tiny
+    return np.max(sta / lta, axis=-1)
+
+
+def _stachan_windows(day_wavs, dto, stachan, win_len, samp_rate):
+    """
+    Cut one stachan of a day of data into windows of win_len seconds from dto
+
+    :return: (float32 array (n_windows, npts), boolean array (n_windows) of
+        which windows have data)
+    """
+    npts = int(round(win_len * samp_rate))
+    n_win = int(86400 // win_len)
+    data = np.zeros((n_win, npts), dtype=np.float32)
+    present = np.zeros(n_win, dtype=bool)
+    for tr in day_wavs.select(station=stachan[0], channel=stachan[1]):
+        offset = int(round((dto - tr.stats.starttime) * samp_rate))
+        for w in range(n_win):
+            i0 = offset + (w * npts)
+            if present[w] or i0 < 0 or i0 + npts > tr.stats.npts:
+                continue
+            data[w] = tr.data[i0:i0 + npts]
+            present[w] = True
+    return data, present
+
+
+def sample_nullspace(wav_dirs, stachans, start, end, n, sta, lta, limit,
+                     win_len=3600., samp_rate=100., cache_dir=None,
+                     index_file=None, max_memory=2e9):
+    """
+    Draw a pool of quiet (noise) windows for a set of stachans
+
+    n random days are read once each, merged, detrended and resampled as in
+    get_nullspace and cut into windows of win_len seconds. Each channel of
+    each window is screened with STA/LTA, all windows of a channel at once,
+    and only those that have data and stay under limit are marked valid.
+    Only one stachan's windows of a day are held while screening, and the
+    windows kept are written straight into the pool (on disk with
+    cache_dir).
+
+    With cache_dir the pool is written there as one float32 .npy of kept
+    windows per day plus a json index (written last), named from a hash of
+    the arguments, the waveform directories and the waveform index(es)
+    used. Calling again with the same arguments
+    memory-maps the cached pool instead of reading any waveforms.
+
+    Without cache_dir the whole pool is held in memory, so a pool larger
+    than max_memory (e.g. the union of many detectors' stachans) must be
+    cached.
+
+    :type wav_dirs: list
+    :param wav_dirs: Waveform directories, to which the year is appended
+    :type stachans: list
+    :param stachans: List of (station, channel), e.g. the union of the
+        stachans of all the detectors to calibrate
+    :type start: obspy.core.event.UTCDateTime
+    :param start: Start of range from which to draw random days
+    :type end: obspy.core.event.UTCDateTime
+    :param end: End of range for random days
+    :type n: int
+    :param n: Number of days to draw
+    :type sta: float
+    :param sta: STA length (seconds)
+    :type lta: float
+    :param lta: LTA length (seconds)
+    :type limit: float
+    :param limit: Maximum STA/LTA of a quiet window. None keeps all windows
+        with data
+    :type win_len: float
+    :param win_len: Window length (seconds)
+    :type samp_rate: float
+    :param samp_rate: Sampling rate to resample to
+    :type cache_dir: str
+    :param cache_dir: Optional directory to cache the pool in
+    :type index_file: str
+    :param index_file: Waveform index passed to grab_day_wavs. Defaults to
+        the index of each year's directory
+    :type max_memory: float
+    :param max_memory: Largest pool (bytes) to hold in memory when no
+        cache_dir is given
+    :return: dict of stachans, samp_rate, starttimes (list of UTCDateTime
+        per window), data (list of float32 arrays or memmaps (n_windows,
+        n_stachans, npts), one per day) and valid (list of boolean arrays
+        (n_windows, n_stachans))
+    """
+    stachans = [tuple(stachan) for stachan in stachans]
+    if index_file:
+        index_files = [index_file]
+    else:
+        index_files = [default_index_file(['%s%d' % (wav_dirs[0], year)])
+                       for year in range(start.year, end.year + 1)]
+    key = json.dumps([sorted(stachans), str(start), str(end), n, sta, lta,
+                      limit, win_len, samp_rate, list(wav_dirs),
+                      index_files], sort_keys=True)
+    pool_file = None
+    if cache_dir:
+        base = 'nullspace_%s' % hashlib.sha1(
+            key.encode('utf-8')).hexdigest()[:16]
+        pool_file = os.path.join(cache_dir, base + '.json')
+        if os.path.isfile(pool_file):
+            return _read_nullspace(pool_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    else:
+        pool_bytes = (4. * n * (86400 // win_len) * len(stachans) *
+                      int(round(win_len * samp_rate)))
+        if pool_bytes > max_memory:
+            raise MemoryError('Null-space pool of %.1f GB is larger than '
+                              'max_memory, give a cache_dir' %
+                              (pool_bytes / 1e9))
+    npts = int(round(win_len * samp_rate))
+    n_win = int(86400 // win_len)
+    day_range = (end.datetime - start.datetime).days
+    rands = np.random.choice(day_range, size=n, replace=False)
+    dtos = [start + (86400 * rand) for rand in sorted(rands)]
+    sta_dict = {}
+    for station, channel in stachans:
+        sta_dict.setdefault(station, []).append(channel)
+    days = []
+    for dto in dtos:
+        wav_ds = ['%s%d' % (d, dto.year) for d in wav_dirs]
+        day_wavs = grab_day_wavs(wav_ds, dto, sta_dict,
+                                 index_file=index_file)
+        if len(day_wavs) == 0:
+            print('No data for %s' % dto)
+            continue
+        day_wavs.merge(fill_value='interpolate')
+        day_wavs.detrend('simple')
+        day_wavs.resample(samp_rate)
+        # Screened one stachan at a time so only one stachan's windows of
+        # the day are held at once
+        valid = np.zeros((n_win, len(stachans)), dtype=bool)
+        for j, stachan in enumerate(stachans):
+            windows, valid[:, j] = _stachan_windows(day_wavs, dto, stachan,
+                                                    win_len, samp_rate)
+            if limit is None:
+                continue
+            quiet = _stalta_max(windows, int(sta * samp_rate),
+                                int(lta * samp_rate)) <= limit
+            for w in np.nonzero(valid[:, j] & ~quiet)[0]:
+                print('%s.%s fails sta/lta req of %s at %s' %
+                      (stachan[0], stachan[1], limit, dto + (w * win_len)))
+            valid[:, j] &= quiet
+        keep = np.nonzero(valid.any(axis=1))[0]
+        if len(keep) == 0:
+            print('No quiet windows for %s' % dto)
+            continue
+        # Kept windows are cut again straight into the pool, on disk if
+        # caching
+        shape = (len(keep), len(stachans), npts)
+        if cache_dir:
+            day_base = '%s_%s' % (base, dto.strftime('%Y-%m-%d'))
+            data = np.lib.format.open_memmap(
+                os.path.join(cache_dir, day_base + '_data.npy'), mode='w+',
+                dtype=np.float32, shape=shape)
+        else:
+            day_base = None
+            data = np.zeros(shape, dtype=np.float32)
+        for j, stachan in enumerate(stachans):
+            data[:, j] = _stachan_windows(day_wavs, dto, stachan, win_len,
+                                          samp_rate)[0][keep]
+        if cache_dir:
+            data.flush()
+            del data
+            np.save(os.path.join(cache_dir, day_base + '_valid.npy'),
+                    valid[keep])
+            data = None
+        days.append((dto, keep, data, valid[keep], day_base))
+    starttimes = [dto + (w * win_len) for dto, keep, d, v, b in days
+                  for w in keep]
+    if not cache_dir:
+        return {'stachans': stachans, 'samp_rate': samp_rate,
+                'starttimes': starttimes,
+                'data': [d for dto, keep, d, v, b in days],
+                'valid': [v for dto, keep, d, v, b in days]}
+    index = {'stachans': stachans, 'samp_rate': samp_rate, 'days': []}
+    for dto, keep, data, valid, day_base in days:
+        index['days'].append({'file': day_base,
+                              'starttimes': [str(dto + (w * win_len))
+                                             for w in keep]})
+    with open(pool_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(pool_file + '.tmp', pool_file)
+    return _read_nullspace(pool_file)
+
+
+def _read_nullspace(index_file):
+    # Pool written by sample_nullspace, data memory-mapped day by day
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+    path = os.path.dirname(index_file)
+    stachans = [tuple(stachan) for stachan in index['stachans']]
+    starttimes = []
+    data = []
+    valid = []
+    for day in index['days']:
+        starttimes.extend([UTCDateTime(t) for t in day['starttimes']])
+        data.append(np.load(os.path.join(path, day['file'] + '_data.npy'),
+                            mmap_mode='r'))
+        valid.append(np.load(os.path.join(path, day['file'] + '_valid.npy')))
+    return {'stachans': stachans, 'samp_rate': index['samp_rate'],
+            'starttimes': starttimes, 'data': data, 'valid': valid}
+
+
+def nullspace_streams(pool, stachans):
+    """
+    Streams of the windows in a null-space pool valid for every stachan given
+
+    :type pool: dict
+    :param pool: From sample_nullspace
+    :type stachans: list
+    :param stachans: List of (station, channel), e.g. detector.stachans
+    :return: list of obspy.core.stream.Stream
+    """
+    cols = [pool['stachans'].index(tuple(stachan)) for stachan in stachans]
+    data = pool['data']
+    valid = pool['valid']
+    if not isinstance(data, list):
+        data = [data]
+        valid = [valid]
+    streams = []
+    w = 0
+    for day_data, day_valid in zip(data, valid):
+        for k in range(len(day_valid)):
+            starttime = pool['starttimes'][w + k]
+            if not day_valid[k, cols].all():
+                continue
+            streams.append(Stream([Trace(
+                data=np.array(day_data[k, j]),
+                header={'station': pool['stachans'][j][0],
+                        'channel': pool['stachans'][j][1],
+                        'starttime': starttime,
+                        'sampling_rate': pool['samp_rate']})
+                for j in cols]))
+        w += len(day_valid)
+    return streams
+
+
+def get_nullspace(wav_dirs, detector, start, end, n, sta, lta, limit,
+                  cache_dir=None):
     """
     Function to grab a random sample of data from our dataset, check that
     it doesn't contain amplitude spikes (STA/LTA?), then feed it to subspace
@@ -589,78 +914,42 @@ def get_nullspace(wav_dirs, detector, start, end, n, sta, lta, limit):
     :param start: Start of range from which to draw random samples
     :type end: obspy.core.event.UTCDateTime
     :param end: End of range for random samples
-    :type
+    :type cache_dir: str
+    :param cache_dir: Optional directory to cache the windows in (see
+        sample_nullspace)
     :return: list of obspy.core.stream.Stream
     """
-    import numpy as np
+    pool = sample_nullspace(wav_dirs, detector.stachans, start, end, n, sta,
+                            lta, limit, cache_dir=cache_dir)
+    return nullspace_streams(pool, detector.stachans)
 
-    day_range = (end.datetime - start.datetime).days  # Number of days in range
-    # Take a random sample of days since start of range
-    rands = np.random.choice(day_range, size=n, replace=False)
-    dtos = [start + (86400 * rand) for rand in rands]
-    nullspace = []
-    for dto in dtos:
-        wav_ds = ['%s%d' % (d, dto.year) for d in wav_dirs]
-        stachans = {stachan[0]: [stachan[1]] for stachan in detector.stachans}
-        day_wavs = grab_day_wavs(wav_ds, dto, stachans)
-        day_wavs.merge(fill_value='interpolate')
-        day_wavs.detrend('simple')
-        day_wavs.resample(100.)
-        # Loop over the hours of this day and take ones with no events
-        day_start = day_wavs[0].stats.starttime
-        for hr in range(24):
-            slice_start = day_start + (hr * 3600)
-            slice_end = day_start + (hr * 3600) + 3600
-            wav = day_wavs.slice(starttime=slice_start, endtime=slice_end,
-                                 nearest_sample=True)
-            # Check STA/LTA
-            if _check_stalta(wav, sta, lta, limit):
-                nullspace.append(wav)
-            else:
-                print('STA/LTA fail for %s' % slice_start)
-                continue
-    return nullspace
-
-def calculate_threshold(wav_dirs, detector, start, end, n, Pf, plot=False):
-    st = get_nullspace(wav_dirs=wav_dirs, detector=detector, start=start,
-                       end=end, n=n)
-    detector.set_threshold(streams=st, Pf=Pf, plot=plot)
-    return
-
-def _check_stalta(st, STATime, LTATime, limit):
+def calculate_threshold(wav_dirs, detectors, start, end, n, Pf, sta, lta,
+                        limit, plot=False, cache_dir=None):
     """
-    Take a stream and make sure it's vert. component (or first comp
-    if no vert) does not exceed limit given STATime and LTATime
-    Return True if passes, false if fails
+    Set the thresholds of one or more detectors from one null-space pool
 
-    .. Note: Taken from detex.fas
-    """
+    The pool is drawn once for all the detectors' stachans (see
+    sample_nullspace) and each detector given the windows valid on its own
+    stachans.
 
-    if limit is None:
-        return True
-    if len(st) < 1:
-        return None
-    try:
-        stz = st.select(component='Z')[0]
-    except IndexError:  # if no Z found on trace
-        return None
-    if len(stz) < 1:
-        stz = st[0]
-    sz = stz.copy()
-    sr = sz.stats.sampling_rate
-    ltaSamps = LTATime * sr
-    staSamps = STATime * sr
-    try:
-        cft = classic_sta_lta(sz.data, staSamps, ltaSamps)
-    except:
-        return False
-    if np.max(cft) <= limit:
-        return True
-    else:
-        sta = sz.stats.station
-        t1 = sz.stats.starttime
-        t2 = sz.stats.endtime
-        msg = ('%s fails sta/lta req of %d between %s and %s' % (sta, limit,
-                                                                 t1, t2))
-        print(msg)
-        return False
+    :type detectors: list
+    :param detectors: eqcorrscan.core.subspace.Detector or list of them
+    :type Pf: float
+    :param Pf: False alarm probability for Detector.set_threshold
+    :type cache_dir: str
+    :param cache_dir: Optional directory to cache the pool in
+    """
+    if isinstance(detectors, Detector):
+        detectors = [detectors]
+    stachans = []
+    for detector in detectors:
+        stachans.extend([tuple(stachan) for stachan in detector.stachans
+                         if tuple(stachan) not in stachans])
+    pool = sample_nullspace(wav_dirs, stachans, start, end, n, sta, lta,
+                            limit, cache_dir=cache_dir)
+    for detector in detectors:
+        st = nullspace_streams(pool, detector.stachans)
+        print('Setting threshold for %s from %d windows' %
+              (detector.name, len(st)))
+        detector.set_threshold(streams=st, Pf=Pf, plot=plot)
+    return
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+"""
+Persistent sqlite index of a miniseed archive so that day-long waveforms
+can be grabbed without crawling the archive on every call
+"""
+from __future__ import division
+
+import os
+import fcntl
+import shutil
+import sqlite3
+import fnmatch
+import traceback
+
+from timeit import default_timer as timer
+from multiprocessing.pool import ThreadPool
+from obspy import read, Stream
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    root TEXT,
+    mtime REAL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS traces (
+    path TEXT,
+    network TEXT,
+    station TEXT,
+    location TEXT,
+    channel TEXT,
+    starttime REAL,
+    endtime REAL,
+    byte_offset INTEGER,
+    byte_length INTEGER
+);
+CREATE INDEX IF NOT EXISTS sta_chan_time
+    ON traces (station, channel, starttime, endtime);
+CREATE INDEX IF NOT EXISTS trace_path ON traces (path);
+"""
+
+
+def default_index_file(wav_dirs):
+    # Index lives alongside the first waveform directory unless told otherwise
+    return os.path.join(wav_dirs[0], '.waveform_index.sqlite')
+
+
+def _connect(index_file):
+    # Generous timeout as many array jobs may read while one is refreshing
+    conn = sqlite3.connect(index_file, timeout=300.)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def update_index(wav_dirs, index_file=None, pattern='*', missing_only=False,
+                 debug=0):
+    """
+    Build or incrementally refresh a waveform index for a list of directories
+
+    Only files which are new or whose size/mtime have changed since the last
+    refresh have their headers read. Files which no longer exist on disk are
+    dropped from the index.
+
+    The index is built in a temporary copy and renamed into place once
+    committed, under an exclusive lock on <index_file>.lock, so many array
+    tasks can call this at once: one builds, the rest wait on the lock and
+    none of them ever queries a half-built index.
+
+    :param wav_dirs: List of directories to (recursively) index
+    :param index_file: Path to the sqlite index. Defaults to a hidden file
+        in the first of wav_dirs
+    :param pattern: fnmatch pattern for files to consider
+    :param missing_only: Only build the index if it doesn't exist yet (once
+        the lock is held, so a build by another task is picked up)
+    :param debug: Verbosity
+    :return: Path to the index file
+    """
+    if not index_file:
+        index_file = default_index_file(wav_dirs)
+    with open(index_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if missing_only and os.path.isfile(index_file):
+                return index_file
+            tmp_file = '%s.tmp%d' % (index_file, os.getpid())
+            if os.path.isfile(index_file):
+                shutil.copyfile(index_file, tmp_file)
+            elif os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            try:
+                added, gone = _update_index_file(wav_dirs, tmp_file, pattern,
+                                                 debug)
+                os.rename(tmp_file, index_file)
+            finally:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    if debug > 0:
+        print('Indexed %d new/changed files, dropped %d from %s'
+              % (added, gone, index_file))
+    return index_file
+
+
+def _update_index_file(wav_dirs, index_file, pattern, debug):
+    """
+    Refresh the index in index_file (see update_index)
+
+    :return: (number of files added or changed, number dropped)
+    """
+    conn = _connect(index_file)
+    known = {row[0]: (row[1], row[2]) for row in
+             conn.execute('SELECT path, mtime, size FROM files')}
+    seen = set()
+    added = 0
+    for root in wav_dirs:
+        root = os.path.abspath(root)
+        for path, dirs, files in os.walk(root):
+            for filename in fnmatch.filter(files, pattern):
+                if filename.startswith('.waveform_index'):
+                    continue
+                wav = os.path.join(path, filename)
+                seen.add(wav)
+                stat = os.stat(wav)
+                if known.get(wav) == (stat.st_mtime, stat.st_size):
+                    continue
+                try:
+                    st = read(wav, headonly=True)
+                except Exception as e:
+                    if debug > 0:
+                        print('Could not read header of %s: %s' % (wav, e))
+                    continue
+                conn.execute('DELETE FROM traces WHERE path = ?', (wav,))
+                conn.executemany(
+                    'INSERT INTO traces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(wav, tr.stats.network, tr.stats.station,
+                      tr.stats.location, tr.stats.channel,
+                      tr.stats.starttime.timestamp,
+                      tr.stats.endtime.timestamp, 0, stat.st_size)
+                     for tr in st])
+                conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                             (wav, root, stat.st_mtime, stat.st_size))
+                added += 1
+    roots = [os.path.abspath(d) for d in wav_dirs]
+    gone = [path for path in known
+            if path not in seen and
+            any(path.startswith(r + os.sep) for r in roots)]
+    for path in gone:
+        conn.execute('DELETE FROM traces WHERE path = ?', (path,))
+        conn.execute('DELETE FROM files WHERE path = ?', (path,))
+    conn.commit()
+    conn.close()
+    return added, len(gone)
+
+
+def query_index(index_file, stachans, starttime, endtime, wav_dirs=None):
+    """
+    Return the files holding data for stachans between starttime and endtime
+
+    :param index_file: Path to sqlite index made by update_index
+    :param stachans: Dict of {station: [channels]}. Channels are matched as
+        prefixes, as in the old fnmatch pattern
+    :param starttime: obspy.UTCDateTime
+    :param endtime: obspy.UTCDateTime
+    :param wav_dirs: Optionally restrict to files under these directories
+    :return: list of (path, byte_offset, byte_length)
+    """
+    if not os.path.isfile(index_file):
+        # Don't let sqlite create (and the caller query) an empty index
+        raise IOError('No waveform index %s, run update_index' % index_file)
+    conn = _connect(index_file)
+    sql = ('SELECT DISTINCT path, byte_offset, byte_length FROM traces '
+           'WHERE station = ? AND channel LIKE ? '
+           'AND starttime < ? AND endtime > ?')
+    root_args = []
+    if wav_dirs:
+        root_args = ['%s%s%%' % (os.path.abspath(d), os.sep)
+                     for d in wav_dirs]
+        sql += ' AND (%s)' % ' OR '.join(['path LIKE ?'] * len(root_args))
+    wav_files = []
+    for sta, chans in iter(stachans.items()):
+        for chan in chans:
+            args = [sta, '%s%%' % chan, endtime.timestamp,
+                    starttime.timestamp] + root_args
+            wav_files.extend(conn.execute(sql, args).fetchall())
+    conn.close()
+    return sorted(set(wav_files))
+
+
+def merge_day(st, samp_rate=100.):
+    """
+    Resample stachans with mixed sampling rates, then merge, in place
+
+    :param st: obspy.core.stream.Stream of one day of raw data
+    :param samp_rate: Rate to resample to for mixed-rate stachans
+    :return: The merged Stream
+    """
+    stachans = [(tr.stats.station, tr.stats.channel) for tr in st]
+    for stachan in list(set(stachans)):
+        tmp_st = st.select(station=stachan[0], channel=stachan[1])
+        if len(tmp_st) > 1 and len(set([tr.stats.sampling_rate
+                                        for tr in tmp_st])) > 1:
+            print('Traces from %s.%s have differing samp rates'
+                  % (stachan[0], stachan[1]))
+            for tr in tmp_st:
+                st.remove(tr)
+            tmp_st.resample(sampling_rate=samp_rate)
+            st += tmp_st
+    st.merge(fill_value='interpolate')
+    return st
+
+
+def grab_day_wavs(wav_dirs, dto, stachans, index_file=None, clean=True,
+                  samp_rate=100., refresh=False, threads=1):
+    """
+    Grab one day of waveforms for a dict of stachans from the waveform index
+
+    The index is built on first use and can be refreshed with refresh=True
+    (or by calling update_index once before looping over days). Array tasks
+    starting together wait on the one building it (see update_index).
+
+    :param wav_dirs: List of waveform directories
+    :param dto: UTCDateTime of the start of the day
+    :param stachans: Dict of {station: [channels]}
+    :param index_file: Path to the sqlite index. See update_index
+    :param clean: Resample mixed-rate traces and merge (see merge_day), trim
+        to the day and remove traces shorter than 0.8 * daylong. If False,
+        return the raw Stream as read
+    :param samp_rate: Rate to resample to for mixed-rate stachans
+    :param refresh: Re-scan wav_dirs for new/changed files before querying
+    :param threads: Number of threads used to read the day's files
+    :return: obspy.core.stream.Stream
+    """
+    if not index_file:
+        index_file = default_index_file(wav_dirs)
+    if refresh or not os.path.isfile(index_file):
+        print('Updating waveform index %s' % index_file)
+        update_index(wav_dirs, index_file, missing_only=not refresh)
+    st = Stream()
+    # Shave a second off either end so the neighbouring day files, which
+    # often overlap midnight by a sample or two, aren't pulled in as well
+    wav_files = query_index(index_file, stachans, dto + 1, dto + 86399,
+                            wav_dirs=wav_dirs)
+    print('Reading into memory')
+    if threads > 1 and len(wav_files) > 1:
+        # libmseed decoding releases the GIL so threads overlap fine here
+        pool = ThreadPool(min(threads, len(wav_files)))
+        for wav_st in pool.map(read, [wav[0] for wav in wav_files]):
+            st += wav_st
+        pool.close()
+        pool.join()
+    else:
+        for wav, offset, length in wav_files:
+            st += read(wav)
+    if not clean:
+        return st
+    merge_day(st, samp_rate)
+    print('Checking for trace length. Removing if too short')
+    rm_trs = []
+    for tr in st:
+        if len(tr.data) < (86400 * tr.stats.sampling_rate * 0.8):
+            rm_trs.append(tr)
+        if tr.stats.starttime != dto:
+            print('Trimming trace %s.%s with starttime %s to %s'
+                  % (tr.stats.station, tr.stats.channel,
+                     str(tr.stats.starttime), str(dto)))
+            tr.trim(starttime=dto, endtime=dto + 86400,
+                    nearest_sample=False)
+    if len(rm_trs) != 0:
+        print('Removing traces shorter than 0.8 * daylong')
+        for tr in rm_trs:
+            st.remove(tr)
+    else:
+        print('All traces long enough to proceed to dayproc')
+    return st
+
+
+def prefetch_day_wavs(wav_dirs, dates, stachans, threads=4, timings=None,
+                      skip_errors=False, **kwargs):
+    """
+    Generator yielding (UTCDateTime, Stream) for each day in dates
+
+    Day N+1 is read, merged, resampled and length-checked in a background
+    thread while the caller works on day N, so I/O and correlation overlap.
+    This means two days of data are held in memory at once.
+
+    Per-day timings are printed and, if a list is given as timings, appended
+    to it as dicts with keys: date, read, wait, compute, overlap. 'wait' is
+    how long the caller sat idle waiting on the read, 'overlap' is the
+    amount of the read hidden behind the previous day's compute.
+
+    :param wav_dirs: List of waveform root directories. The year is appended
+        to each for every day, as in the existing date loops
+    :param dates: List (or iterator) of UTCDateTimes for the start of each day
+    :param stachans: Dict of {station: [channels]}
+    :param threads: Number of threads used to read each day's files
+    :param timings: Optional list to append the per-day timings to
+    :param skip_errors: If True, a day that can't be read (corrupt files,
+        I/O errors) is printed and yielded with None in place of the Stream
+        rather than raising and ending the loop
+    :param kwargs: Passed on to grab_day_wavs
+    """
+    def _load(dto):
+        read_start = timer()
+        wav_ds = [os.path.join(d, str(dto.year)) for d in wav_dirs]
+        try:
+            st = grab_day_wavs(wav_ds, dto, stachans, threads=threads,
+                               **kwargs)
+        except Exception:
+            if not skip_errors:
+                raise
+            print('Reading %s failed:\n%s' % (dto.strftime('%Y-%m-%d'),
+                                               traceback.format_exc()))
+            st = None
+        return st, timer() - read_start
+
+    # dates may be an iterator (e.g. claims from a day queue), so only ask
+    # for the next day once the previous one has been handed out
+    dates = iter(dates)
+    dto = next(dates, None)
+    if dto is None:
+        return
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(_load, (dto,))
+        while pending is not None:
+            wait_start = timer()
+            st, read_time = pending.get()
+            wait = timer() - wait_start
+            next_dto = next(dates, None)
+            pending = None
+            if next_dto is not None:
+                pending = pool.apply_async(_load, (next_dto,))
+            compute_start = timer()
+            yield dto, st
+            compute = timer() - compute_start
+            day_time = {'date': dto, 'read': read_time, 'wait': wait,
+                        'compute': compute,
+                        'overlap': max(read_time - wait, 0.)}
+            print('%s: read %.3f s, waited %.3f s, compute %.3f s, '
+                  'overlapped %.3f s' % (dto.strftime('%Y-%m-%d'), read_time,
+                                         wait, compute, day_time['overlap']))
+            if timings is not None:
+                timings.append(day_time)
+            dto = next_dto
+    finally:
+        pool.close()
+        pool.join()